@@ -0,0 +1,154 @@
+# answer_cache.py
+"""
+質問 → 回答 の永続キャッシュ (SQLite)。
+
+キーは「正規化した質問文 + コーパスの版」。ドキュメントが更新されて版が
+変わると、古い版の回答は自動的に捨てられる。
+
+  - 完全一致: 全角/半角・大文字小文字・空白・末尾の「？」などの違いは無視
+  - 近似一致: similarity を指定すると、rag_index のトークンで作った
+              質問ベクトルのコサイン類似度がそれ以上の回答も再利用する
+  - 破棄    : max_entries を超えたら最後に使われた時刻が古いものから (LRU)、
+              ttl 秒を過ぎたものは期限切れとして削除
+"""
+import hashlib
+import json
+import math
+import sqlite3
+import time
+import unicodedata
+
+import telemetry
+from rag_index import tokenize
+
+DEFAULT_DB_PATH = "answer_cache.sqlite"
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_TTL = 7 * 24 * 3600   # 1 週間
+
+_TRAILING_PUNCT = "?？!！。.、,， "
+
+
+def normalize_question(question: str) -> str:
+    text = unicodedata.normalize("NFKC", question).lower()
+    text = " ".join(text.split())
+    return text.rstrip(_TRAILING_PUNCT)
+
+
+def question_vector(question: str) -> dict:
+    """質問の単語頻度ベクトル (L2 正規化済み)"""
+    vec = {}
+    for t in tokenize(normalize_question(question)):
+        vec[t] = vec.get(t, 0) + 1
+    norm = math.sqrt(sum(v * v for v in vec.values()))
+    if norm == 0:
+        return {}
+    return {t: v / norm for t, v in vec.items()}
+
+
+def cosine(a: dict, b: dict) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(v * b.get(t, 0.0) for t, v in a.items())
+
+
+class AnswerCache:
+    def __init__(self, path=DEFAULT_DB_PATH, corpus_version="",
+                 max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL, similarity=None):
+        self.corpus_version = corpus_version
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                corpus_version TEXT,
+                question TEXT,
+                vector TEXT,
+                answer TEXT,
+                created_at REAL,
+                last_used REAL
+            )
+        """)
+        with self.conn:
+            # コーパスが更新されていたら古い版の回答はすべて無効
+            self.conn.execute(
+                "DELETE FROM answers WHERE corpus_version != ?", (corpus_version,)
+            )
+            self.conn.execute(
+                "DELETE FROM answers WHERE created_at < ?", (time.time() - ttl,)
+            )
+
+        # 近似一致用に、現在の版の質問ベクトルをメモリに載せておく
+        self.vectors = {}
+        if similarity is not None:
+            for key, vector in self.conn.execute("SELECT key, vector FROM answers"):
+                self.vectors[key] = json.loads(vector)
+
+    def close(self):
+        self.conn.close()
+
+    def _key(self, normalized):
+        return hashlib.sha1(f"{self.corpus_version}\0{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, question: str):
+        """キャッシュ済みの回答を返す。無ければ None"""
+        now = time.time()
+        key = self._key(normalize_question(question))
+        row = self.conn.execute(
+            "SELECT answer, created_at FROM answers WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None and self.similarity is not None and self.vectors:
+            vec = question_vector(question)
+            best_key, best_score = None, 0.0
+            for other_key, other_vec in self.vectors.items():
+                score = cosine(vec, other_vec)
+                if score > best_score:
+                    best_key, best_score = other_key, score
+            if best_score >= self.similarity:
+                key = best_key
+                row = self.conn.execute(
+                    "SELECT answer, created_at FROM answers WHERE key = ?", (key,)
+                ).fetchone()
+
+        if row is None or row[1] < now - self.ttl:
+            self.misses += 1
+            telemetry.count("answer_cache_lookups", result="miss")
+            return None
+
+        with self.conn:
+            self.conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        telemetry.count("answer_cache_lookups", result="hit")
+        return row[0]
+
+    def put(self, question: str, answer: str) -> None:
+        now = time.time()
+        normalized = normalize_question(question)
+        key = self._key(normalized)
+        vec = question_vector(question)
+
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT OR REPLACE INTO answers
+                    (key, corpus_version, question, vector, answer, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (key, self.corpus_version, normalized, json.dumps(vec), answer, now, now),
+            )
+            # 上限を超えた分は最後に使われた時刻が古いものから削除 (LRU)
+            evicted = [r[0] for r in self.conn.execute(
+                "SELECT key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?",
+                (self.max_entries,),
+            )]
+            self.conn.executemany("DELETE FROM answers WHERE key = ?", [(k,) for k in evicted])
+
+        if self.similarity is not None:
+            self.vectors[key] = vec
+            for k in evicted:
+                self.vectors.pop(k, None)
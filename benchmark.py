@@ -0,0 +1,523 @@
+# benchmark.py
+"""
+クロール → HTML→TXT 変換 → 索引 → 検索 → 回答 のパイプライン全体のベンチマーク。
+
+チェックイン済みのスナップショット (gas_docs_html / gemini_api_docs_html) と、
+それを --scale 倍に水増しした合成コーパスで各段階を実行し、
+段階ごとのスループット・p50/p95/p99 レイテンシ・ピーク RSS・プロンプトのトークン数 (概算) を
+JSON のレポートに書き出す。--compare で以前のレポートと比べ、劣化を検出できる。
+
+  - crawl     : スナップショットをローカルの HTTP サーバーで配信し、py_wget の並行クローラーで取得
+                (playwright が無い環境では skipped)
+  - html2text : local_html2text.convert_one をプロセスプールで実行 (1 ファイルごとの時間)
+  - index     : rag_index.BM25Index の構築と保存、保存したパックの読み込み時間
+  - retrieval : query_rag.build_context + build_prompt (検索 + プロンプト作成) を質問ごとに
+  - answer    : rag_server.RagService に質問を並行に投げる。Gemini API の代わりに
+                fake_gemini.FakeGemini (遅延・429 エラーを設定できる決定的なスタブ) を使う
+
+ピーク RSS を段階ごとに測るため、各段階は新しいプロセスで実行する。
+
+使い方:
+    python benchmark.py                                # 既定の 200 ページで全段階
+    python benchmark.py --pages 0 --scale 5 -o big.json  # 全ページを 5 倍に水増し
+    python benchmark.py --stages retrieval,answer --fake-error-rate 0.1
+    python benchmark.py -o new.json --compare old.json  # 劣化があれば終了コード 1
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import datetime, timezone
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------
+# 定数
+# ---------------------------
+SNAPSHOT_DIRS = ["gas_docs_html", "gemini_api_docs_html"]
+# スナップショットごとのクロール開始パス
+CRAWL_START_PATHS = {"gas_docs_html": "/apps-script/reference/", "gemini_api_docs_html": "/gemini-api/docs/"}
+STAGES = ["crawl", "html2text", "index", "retrieval", "answer"]
+DEFAULT_PAGES = 200          # 使うページ数 (0 ならスナップショットの全ページ)
+DEFAULT_REPEAT = 5           # 検索・回答の段階で質問リストを繰り返す回数
+REPORT_VERSION = 1
+REGRESSION_THRESHOLD = 0.2   # --compare でこれ以上悪くなった指標を劣化とみなす (20%)
+
+BENCH_QUESTIONS = [
+    "getValues の戻り値は？",
+    "SpreadsheetApp.getActiveRange の使い方",
+    "Range.setValues で二次元配列を書き込むには",
+    "onEdit トリガーで編集されたセルを取得したい",
+    "時間主導型トリガーを作成する方法",
+    "GmailApp でメールを送信する",
+    "DriveApp でフォルダ内のファイルを一覧する",
+    "UrlFetchApp で POST リクエストを送る",
+    "PropertiesService にデータを保存する",
+    "CacheService の有効期限は？",
+    "How do I stream responses from generateContent?",
+    "Gemini API の function calling の使い方",
+]
+
+
+# ---------------------------
+# 計測の道具
+# ---------------------------
+def percentile(sorted_samples, p):
+    """nearest-rank 法のパーセンタイル (sorted_samples は昇順)"""
+    if not sorted_samples:
+        return None
+    rank = max(1, -(-len(sorted_samples) * p // 100))
+    return sorted_samples[int(rank) - 1]
+
+
+def latency_summary(samples):
+    """秒のサンプル列 → ミリ秒の p50 / p95 / p99 / 平均 / 最大"""
+    if not samples:
+        return None
+    s = sorted(samples)
+    return {
+        "p50_ms": round(percentile(s, 50) * 1000, 3),
+        "p95_ms": round(percentile(s, 95) * 1000, 3),
+        "p99_ms": round(percentile(s, 99) * 1000, 3),
+        "mean_ms": round(sum(s) / len(s) * 1000, 3),
+        "max_ms": round(s[-1] * 1000, 3),
+    }
+
+
+def peak_rss_mb():
+    """このプロセスと、終了した子プロセス (プロセスプールなど) の最大 RSS"""
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024   # macOS はバイト、Linux は KB
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(peak / unit, 1)
+
+
+def stage_result(items, seconds, unit, samples=None, **extra):
+    result = {
+        "items": items,
+        "unit": unit,
+        "seconds": round(seconds, 3),
+        "throughput": round(items / seconds, 3) if seconds > 0 else None,
+        "latency": latency_summary(samples or []),
+    }
+    result.update(extra)
+    return result
+
+
+# ---------------------------
+# コーパス
+# ---------------------------
+def select_pages(snapshot_dirs, pages):
+    """スナップショットから pages 件を等間隔に選ぶ (毎回同じページになる)"""
+    from gas_chunker import list_html_files
+
+    files = []
+    for d in snapshot_dirs:
+        if os.path.isdir(d):
+            files.extend(list_html_files(d))
+    files.sort()
+    if pages and pages < len(files):
+        step = len(files) / pages
+        files = [files[int(i * step)] for i in range(pages)]
+    return files
+
+
+def build_corpus(files, dest, scale):
+    """
+    ページを scale 倍に水増しした合成コーパスを dest に作る。
+    コピーごとに canonical URL などの絶対リンクを書き換え、重複ページとして除かれないようにする。
+    """
+    if scale <= 1:
+        return list(files)
+    out = []
+    for copy in range(scale):
+        prefix = f"https://developers.google.com/copy{copy}/"
+        for path in files:
+            target = os.path.join(dest, f"copy{copy}", path)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(path, "r", encoding="utf-8") as f:
+                html = f.read()
+            html = html.replace('href="https://developers.google.com/', f'href="{prefix}')
+            html = html.replace('href="https://ai.google.dev/', f'href="{prefix}ai/')
+            with open(target, "w", encoding="utf-8") as f:
+                f.write(html)
+            out.append(target.replace(os.sep, "/"))
+    return out
+
+
+# ---------------------------
+# 各段階
+# ---------------------------
+class _SnapshotHandler(SimpleHTTPRequestHandler):
+    """URL のパスを保存済み HTML に対応させる (py_wget.local_file_path の逆)"""
+
+    def translate_path(self, path):
+        base = super().translate_path(path)
+        for candidate in (base, base + ".html", os.path.join(base, "index.html")):
+            if os.path.isfile(candidate):
+                return candidate
+        return base
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stage_crawl(work, config, corpus):
+    try:
+        import py_wget
+    except ImportError as e:
+        return {"skipped": f"クローラーを読み込めません ({e})"}
+
+    # HTTP 取得 1 回ごとの時間を測る (py_wget のワーカーは呼び出し時にこの名前を引く)
+    samples = []
+    conditional_get = py_wget.conditional_get
+
+    def timed_get(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return conditional_get(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    py_wget.conditional_get = timed_get
+
+    pages = 0
+    started = time.perf_counter()
+    for snapshot_dir in config.snapshot_dirs:
+        if not os.path.isdir(snapshot_dir):
+            continue
+        handler = lambda *a, d=snapshot_dir, **kw: _SnapshotHandler(*a, directory=d, **kw)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host = f"127.0.0.1:{server.server_address[1]}"
+        output_dir = os.path.join(work, "crawl", snapshot_dir)
+        try:
+            asyncio.run(py_wget.async_recursive_download(
+                f"http://{host}{CRAWL_START_PATHS[snapshot_dir]}", output_dir, host,
+                concurrency=config.workers * 2, rate=1e6, burst=1000,
+                state_path=os.path.join(work, "crawl_state.sqlite"),
+            ))
+        finally:
+            server.shutdown()
+            server.server_close()
+        pages += sum(len(names) for _root, _dirs, names in os.walk(output_dir))
+    return stage_result(pages, time.perf_counter() - started, "pages", samples)
+
+
+def _convert_timed(args):
+    from local_html2text import convert_one
+
+    html_file, txt_path, parser = args
+    started = time.perf_counter()
+    _file, text, error = convert_one(html_file, txt_path, parser)
+    return time.perf_counter() - started, len(text or ""), error
+
+
+def stage_html2text(work, config, corpus):
+    from local_html2text import pick_parser
+
+    txt_dir = os.path.join(work, "txt")
+    os.makedirs(txt_dir, exist_ok=True)
+    parser = pick_parser()
+    jobs = [(path, os.path.join(txt_dir, f"{i}.txt"), parser) for i, path in enumerate(corpus)]
+    input_bytes = sum(os.path.getsize(path) for path in corpus)
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=config.workers) as pool:
+        results = list(pool.map(_convert_timed, jobs, chunksize=4))
+    seconds = time.perf_counter() - started
+
+    return stage_result(
+        len(corpus), seconds, "files", [r[0] for r in results],
+        input_mb=round(input_bytes / 1e6, 2),
+        mb_per_second=round(input_bytes / 1e6 / seconds, 3) if seconds > 0 else None,
+        output_chars=sum(r[1] for r in results),
+        errors=sum(1 for r in results if r[2] is not None),
+    )
+
+
+def stage_index(work, config, corpus):
+    import rag_index
+
+    path = os.path.join(work, "bm25.pack")
+    started = time.perf_counter()
+    index = rag_index.BM25Index.build(corpus, rag_index.corpus_fingerprint(corpus))
+    build_seconds = time.perf_counter() - started
+    index.save(path, config.compress)
+    seconds = time.perf_counter() - started
+
+    load_samples = []
+    for _ in range(10):
+        t = time.perf_counter()
+        rag_index.BM25Index.load(path)
+        load_samples.append(time.perf_counter() - t)
+
+    return stage_result(
+        len(corpus), seconds, "files",
+        chunks=len(index.chunks),
+        build_seconds=round(build_seconds, 3),
+        pack_mb=round(os.path.getsize(path) / 1e6, 2),
+        load=latency_summary(load_samples),
+    )
+
+
+def _load_query_rag(work):
+    """ベンチマーク用のインデックスで検索するよう query_rag を設定する"""
+    import query_rag
+    import rag_index
+
+    query_rag.configure_retrieval(index=rag_index.BM25Index.load(os.path.join(work, "bm25.pack")))
+    return query_rag
+
+
+def stage_retrieval(work, config, corpus):
+    from gemini_client import estimate_tokens
+
+    query_rag = _load_query_rag(work)
+    questions = BENCH_QUESTIONS * config.repeat
+    samples, prompt_tokens, degraded = [], [], 0
+
+    started = time.perf_counter()
+    for question in questions:
+        t = time.perf_counter()
+        context, trace = query_rag.build_context(question)
+        prompt, _config = query_rag.build_prompt(question, context)
+        samples.append(time.perf_counter() - t)
+        prompt_tokens.append(estimate_tokens(prompt))
+        degraded += bool(trace["skipped"])
+    seconds = time.perf_counter() - started
+
+    return stage_result(
+        len(questions), seconds, "queries", samples,
+        retriever=query_rag.RETRIEVER.name,
+        prompt_tokens={"total": sum(prompt_tokens), "mean": round(sum(prompt_tokens) / len(prompt_tokens), 1),
+                       "max": max(prompt_tokens)},
+        degraded_queries=degraded,
+    )
+
+
+def stage_answer(work, config, corpus):
+    from fake_gemini import FakeGemini
+    from gemini_client import GeminiClient
+    from rag_server import GeminiModelClient, RagService
+
+    _load_query_rag(work)
+    fake = FakeGemini(latency=config.fake_latency, jitter=config.fake_jitter,
+                      error_rate=config.fake_error_rate, seed=config.seed)
+    gemini = GeminiClient(fake)
+    questions = BENCH_QUESTIONS * config.repeat
+
+    async def run():
+        service = RagService(GeminiModelClient(gemini), max_concurrency=config.concurrency,
+                             retrieval_workers=config.workers)
+        clients = asyncio.Semaphore(config.clients)
+        samples, errors = [], 0
+
+        async def one(question):
+            nonlocal errors
+            async with clients:
+                t = time.perf_counter()
+                entry, _coalesced = service.ask(question)
+                try:
+                    await entry.text()
+                except Exception:
+                    errors += 1
+                samples.append(time.perf_counter() - t)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(q) for q in questions))
+        seconds = time.perf_counter() - started
+        stats = dict(service.stats)
+        await service.close()
+        return samples, errors, seconds, stats
+
+    samples, errors, seconds, stats = asyncio.run(run())
+    return stage_result(
+        len(questions), seconds, "requests", samples,
+        errors=errors,
+        error_rate=round(errors / len(questions), 4),
+        coalesced=stats["coalesced"],
+        model_calls=fake.stats["calls"],
+        retries=gemini.stats["retries"],
+        prompt_tokens={"total": fake.stats["prompt_tokens"],
+                       "mean": round(fake.stats["prompt_tokens"] / max(1, fake.stats["calls"] - fake.stats["errors"]), 1)},
+        output_tokens=fake.stats["output_tokens"],
+    )
+
+
+STAGE_FUNCTIONS = {
+    "crawl": stage_crawl,
+    "html2text": stage_html2text,
+    "index": stage_index,
+    "retrieval": stage_retrieval,
+    "answer": stage_answer,
+}
+
+
+# ---------------------------
+# 実行
+# ---------------------------
+def _stage_child(name, work, config, corpus, conn):
+    try:
+        if config.verbose:
+            result = STAGE_FUNCTIONS[name](work, config, corpus)
+        else:
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull), redirect_stderr(devnull):
+                result = STAGE_FUNCTIONS[name](work, config, corpus)
+        if "skipped" not in result:
+            result["peak_rss_mb"] = peak_rss_mb()
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    conn.send(result)
+    conn.close()
+
+
+def run_stage(name, work, config, corpus):
+    """段階を新しいプロセスで実行する (ピーク RSS を段階ごとに分けて測るため)"""
+    ctx = multiprocessing.get_context("fork" if sys.platform.startswith("linux") else "spawn")
+    parent, child = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_stage_child, args=(name, work, config, corpus, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {"error": f"プロセスが異常終了しました (exit code {process.exitcode})"}
+    process.join()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(config):
+    stages = [s.strip() for s in config.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGE_FUNCTIONS]
+    if unknown:
+        raise ValueError(f"未知の段階です: {', '.join(unknown)} (選択肢: {', '.join(STAGES)})")
+    if {"retrieval", "answer"} & set(stages) and "index" not in stages:
+        stages.insert(0, "index")   # 検索・回答にはこの実行で作ったインデックスが必要
+
+    work = tempfile.mkdtemp(prefix="rag_bench_")
+    try:
+        files = select_pages(config.snapshot_dirs, config.pages)
+        corpus = build_corpus(files, os.path.join(work, "corpus"), config.scale)
+        print(f"📚 コーパス: {len(corpus)} ページ (スナップショット {len(files)} ページ × {config.scale})")
+
+        report = {
+            "version": REPORT_VERSION,
+            "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "git": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {key: value for key, value in vars(config).items()
+                       if key not in ("output", "compare", "verbose")},
+            "corpus_pages": len(corpus),
+            "stages": {},
+        }
+        for name in STAGES:
+            if name not in stages:
+                continue
+            print(f"⏱ {name} ...", flush=True)
+            result = run_stage(name, work, config, corpus)
+            report["stages"][name] = result
+            print(f"  {format_stage(result)}")
+        return report
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def format_stage(result):
+    if "skipped" in result:
+        return f"省略: {result['skipped']}"
+    if "error" in result:
+        return f"❌ {result['error']}"
+    text = f"{result['items']} {result['unit']} / {result['seconds']} s ({result['throughput']} {result['unit']}/s)"
+    if result.get("latency"):
+        lat = result["latency"]
+        text += f", p50 {lat['p50_ms']} ms, p95 {lat['p95_ms']} ms, p99 {lat['p99_ms']} ms"
+    return text + f", RSS {result['peak_rss_mb']} MB"
+
+
+# ---------------------------
+# レポートの比較
+# ---------------------------
+# (指標の取り出し方, 大きいほど良いか)
+COMPARED_METRICS = {
+    "throughput": (lambda r: r.get("throughput"), True),
+    "p95_ms": (lambda r: (r.get("latency") or {}).get("p95_ms"), False),
+    "peak_rss_mb": (lambda r: r.get("peak_rss_mb"), False),
+    "prompt_tokens": (lambda r: (r.get("prompt_tokens") or {}).get("mean"), False),
+}
+
+
+def compare_reports(old, new, threshold=REGRESSION_THRESHOLD):
+    """段階・指標ごとの変化率を表示し、threshold を超えて悪くなったものを返す"""
+    regressions = []
+    for name, new_result in new["stages"].items():
+        old_result = old.get("stages", {}).get(name)
+        if not old_result or "items" not in old_result or "items" not in new_result:
+            continue
+        for metric, (get, higher_is_better) in COMPARED_METRICS.items():
+            before, after = get(old_result), get(new_result)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            mark = "❌" if worse > threshold else ("✔" if worse < -threshold else " ")
+            print(f"  {mark} {name:10s} {metric:14s} {before:>12} → {after:>12} ({change:+.1%})")
+            if worse > threshold:
+                regressions.append((name, metric, before, after))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RAG パイプラインのベンチマーク")
+    parser.add_argument("-o", "--output", default="benchmark_report.json", help="レポートの出力先 (JSON)")
+    parser.add_argument("--compare", default=None, help="比較する以前のレポート")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="劣化とみなす悪化の割合")
+    parser.add_argument("--stages", default=",".join(STAGES), help="実行する段階 (カンマ区切り)")
+    parser.add_argument("--snapshot-dirs", nargs="+", default=SNAPSHOT_DIRS)
+    parser.add_argument("--pages", type=int, default=DEFAULT_PAGES,
+                        help="使うページ数 (0 ならスナップショットの全ページ)")
+    parser.add_argument("--scale", type=int, default=1, help="コーパスを何倍に水増しするか")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="プロセス・スレッド数")
+    parser.add_argument("--compress", choices=["zlib", "zstd"], default=None, help="インデックスの圧縮形式")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="質問リストを繰り返す回数")
+    parser.add_argument("--clients", type=int, default=32, help="回答の段階で同時に質問するクライアント数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に送るモデル呼び出し数")
+    parser.add_argument("--fake-latency", type=float, default=0.2, help="フェイク API の応答時間 (秒)")
+    parser.add_argument("--fake-jitter", type=float, default=0.1, help="フェイク API の応答時間の揺らぎ (秒)")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0,
+                        help="フェイク API が 429 を返す割合")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-v", "--verbose", action="store_true", help="各段階の出力をそのまま表示する")
+    args = parser.parse_args()
+
+    report = run_benchmark(args)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"✔ レポート: {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            old_report = json.load(f)
+        print(f"\n📊 {args.compare} との比較")
+        if compare_reports(old_report, report, args.threshold):
+            sys.exit(1)
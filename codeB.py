@@ -1,12 +1,75 @@
 # codeB.py
 
+import argparse
+import codecs    # UTF-8 の逐次検証に使用
+import glob
+import hashlib   # 差分判定用の内容ハッシュ
+import json
+import mmap      # 大きいファイルのコピーに使用
 import os
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import pathspec  # pathspec をインポート
+import re
 import sys       # sysモジュールをインポート
 
+try:
+    import telemetry  # 処理時間・バイト数の計測 (環境変数で有効にしたときだけ記録される)
+except ImportError:
+    # codeB.py だけを別の場所にコピーして使う場合は計測なしで動かす
+    class telemetry:  # noqa: N801 (モジュールと同じ名前で使うため)
+        class _NoopSpan:
+            def set(self, **attrs):
+                pass
+
+        @staticmethod
+        def traced(name=None, **attrs):
+            return lambda func: func
+
+        @staticmethod
+        def current_span():
+            return telemetry._NoopSpan()
+
 # --- 定数定義 ---
 # PEP 8では定数は大文字スネークケースが推奨される
 DEFAULT_OUTPUT_FILE = "code_output.txt"
+# 出力ファイルの索引 (ファイルごとの size / mtime / ハッシュと、出力内のバイト位置)
+INDEX_SUFFIX = ".index.json"
+INDEX_VERSION = 2
+
+# 出力ストリームのバッファサイズ (ファイルごとに開き直さず、まとめて書き込む)
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+# この大きさ以上のファイルは mmap で開き、チャンク単位でコピーする
+MMAP_THRESHOLD = 4 * 1024 * 1024
+# バイナリ判定・文字コード判定に読む先頭部分の大きさ
+SNIFF_SIZE = 8192
+# 先頭部分に占める制御文字 (タブ・改行・改ページ・ESC 以外) の割合がこれを超えたらバイナリ
+BINARY_CONTROL_RATIO = 0.1
+# UTF-8 でないテキストを変換するときに試す文字コード (順に試す)
+FALLBACK_ENCODINGS = ["cp932", "euc_jp"]  # cp932 は Shift_JIS の Windows 拡張
+# チャンクコピーの単位
+COPY_CHUNK_SIZE = 1024 * 1024
+# ディレクトリ走査・ファイル読み込みのワーカー数 (I/O 待ちが主なので CPU 数より多めに取る)
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# 書き込み待ちで先読みしておくファイル数の上限 (メモリ使用量を抑えるため)
+READ_AHEAD = SCAN_WORKERS * 2
+
+# --- トークン予算モード (--max-tokens / --shard-tokens / --shard-bytes) ---
+# 分割出力のファイル名 (code_output.txt → code_output_001.txt, code_output_002.txt, ...)
+SHARD_FILENAME_FORMAT = "{stem}_{number:03d}{ext}"
+# トークン数の概算に使う先頭部分の大きさ (これより大きいファイルは比率から推定)
+TOKEN_SAMPLE_SIZE = 1024 * 1024
+# 圧縮 (minify) ・自動生成ファイルの判定に使う先頭部分の大きさと閾値
+MINIFIED_SAMPLE_SIZE = 64 * 1024
+MINIFIED_MIN_BYTES = 4096       # これより小さいファイルは判定しない
+MINIFIED_AVG_LINE = 300         # 平均行長 (バイト) がこれを超えたら圧縮ファイルとみなす
+MINIFIED_MAX_LINE = 5000        # 1 行でもこれを超えたら圧縮ファイルとみなす
+# 行が長くても、次のどれかに当たるものは文章とみなして圧縮ファイルにしない
+MINIFIED_MAX_NON_ASCII = 0.3      # 非 ASCII バイトの割合がこれ以上 (日本語の文章など)
+MINIFIED_MIN_WHITESPACE = 0.1     # 空白の割合がこれ以上、かつ
+MINIFIED_MAX_SYMBOLS = 0.1        # 記号 ({}[]();,=:<>"') の割合がこれ未満 (英語の文章など)
+# 判定しない拡張子 (1 段落を 1 行に書くことが多い文書)
+MINIFIED_EXEMPT_EXTENSIONS = [".md"]
 
 # 対象とする拡張子
 TARGET_EXTENSIONS = [
@@ -40,6 +103,8 @@ HARDCODED_EXCLUDE_PATTERNS = [
     "scripts/",
     "output/",
     DEFAULT_OUTPUT_FILE, # 出力ファイル自体を除外
+    DEFAULT_OUTPUT_FILE + INDEX_SUFFIX, # 出力ファイルの索引も除外
+    "{0}_[0-9]*{1}".format(*os.path.splitext(DEFAULT_OUTPUT_FILE)), # 分割出力も除外
     "__pycache__/",
     "node_modules/", # 一般的な除外パターン
     ".env",
@@ -54,6 +119,10 @@ HARDCODED_EXCLUDE_PATTERNS = [
     "*.pdb",
 ]
 
+# 拡張子判定用の集合 (ファイルごとにリストを線形探索しないよう事前に作っておく)
+TARGET_SUFFIXES = frozenset(ext.lower() for ext in TARGET_EXTENSIONS)
+BINARY_SUFFIXES = frozenset(ext.lower() for ext in BINARY_EXTENSIONS)
+
 # --- 関数定義 ---
 
 def read_gitignore(gitignore_path=".gitignore"):
@@ -99,16 +168,252 @@ def read_gitignore(gitignore_path=".gitignore"):
     return patterns
 
 
-def process_file(filepath, output_file, read_content=True):
+def _copy_normalized(outfile, chunks):
+    """
+    バイト列のチャンクを改行コードを LF に統一しながら書き込みます。
+    (テキストモードで読み込んだ場合と同じ結果にするため、CRLF と単独の CR を LF に変換)
+    チャンク末尾の CR は次のチャンク先頭の LF と組になる可能性があるため持ち越します。
+    """
+    pending_cr = False
+    for chunk in chunks:
+        if pending_cr:
+            chunk = b"\r" + chunk
+        pending_cr = chunk.endswith(b"\r")
+        if pending_cr:
+            chunk = chunk[:-1]
+        outfile.write(chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n"))
+    if pending_cr:
+        outfile.write(b"\n")
+
+
+def _mmap_chunks(mm, chunk_size=COPY_CHUNK_SIZE):
+    """mmap をチャンク単位で切り出すジェネレーター"""
+    for start in range(0, len(mm), chunk_size):
+        yield mm[start:start + chunk_size]
+
+
+def _validate_utf8(chunks):
+    """
+    チャンクを順に UTF-8 としてデコードし、不正なバイト列があれば
+    UnicodeDecodeError を送出します (デコード結果は保持しません)。
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in chunks:
+        decoder.decode(chunk)
+    decoder.decode(b"", final=True)
+
+
+_CONTROL_BYTES = bytes(b for b in range(32) if b not in b"\t\n\x0c\r\x1b")
+_BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, "utf-8"),   # BOM もそのまま出力する (従来どおり)
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+class BinaryContentError(ValueError):
+    """先頭部分からバイナリファイルと判定された"""
+
+
+def _decodes(head, encoding, final):
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        decoder.decode(head, final=final)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def sniff_encoding(head, final=False):
+    """
+    ファイル先頭のバイト列だけで、テキストかどうかと文字コードを判定します。
+
+    Args:
+        head (bytes): ファイル先頭 (SNIFF_SIZE バイト程度)。
+        final (bool): head がファイル全体の場合は True (末尾の文字の途中切れを許さない)。
+
+    Returns:
+        str: 文字コード名 ("utf-8", "cp932" など)。
+
+    Raises:
+        BinaryContentError: NUL バイトや制御文字が多い、またはどの文字コードでも読めない場合。
+    """
+    for bom, encoding in _BOM_ENCODINGS:
+        if head.startswith(bom):
+            return encoding
+    if b"\0" in head:
+        raise BinaryContentError("NUL バイトを含む")
+    if head:
+        controls = len(head) - len(head.translate(None, _CONTROL_BYTES))
+        if controls / len(head) > BINARY_CONTROL_RATIO:
+            raise BinaryContentError("制御文字が多い")
+    for encoding in ["utf-8"] + FALLBACK_ENCODINGS:
+        if _decodes(head, encoding, final):
+            return encoding
+    raise BinaryContentError("対応する文字コードが見つからない")
+
+
+def _transcode(raw, encoding):
+    """
+    UTF-8 以外のテキストを UTF-8 に変換します。
+    指定の文字コードで読めない場合は FALLBACK_ENCODINGS の残りも試します。
+    """
+    candidates = [encoding] + [e for e in FALLBACK_ENCODINGS if e != encoding]
+    for candidate in candidates:
+        try:
+            return raw.decode(candidate).encode("utf-8"), candidate
+        except UnicodeDecodeError:
+            continue
+    raise UnicodeDecodeError(encoding, raw, 0, len(raw), "どの文字コードでもデコードできない")
+
+
+def _read_content(filepath):
+    """
+    ファイル内容を書き込み用に準備します。
+
+    まず先頭 SNIFF_SIZE バイトだけでバイナリ判定と文字コード判定を行い、
+    バイナリなら残りは読まずに BinaryContentError を送出します。
+    UTF-8 の小さいファイルは一度に読み込み、MMAP_THRESHOLD 以上のファイルは mmap で
+    開いてチャンク単位で検証・コピーします (ファイル全体をメモリに載せない)。
+    Shift_JIS (cp932) などのテキストは UTF-8 に変換します。先頭だけ UTF-8 として
+    読めた大きいファイルも、検証に失敗したら同じように変換して読み込みます。
+
+    Returns:
+        tuple: (data, mm, f, encoding)。小さいファイルと変換したファイルは data (bytes, UTF-8) のみ、
+               大きい UTF-8 ファイルは mm (mmap) と f (ファイルオブジェクト) が設定される。
+               mm と f は呼び出し側で閉じる必要がある。encoding は元の文字コード。
+
+    Raises:
+        BinaryContentError: 先頭部分からバイナリと判定された場合。
+        UnicodeDecodeError: テキストとしてデコードできない場合。
+        OSError: 読み込みに失敗した場合。
+    """
+    f = open(filepath, "rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        head = f.read(SNIFF_SIZE)
+        encoding = sniff_encoding(head, final=len(head) >= size)
+
+        if encoding != "utf-8":
+            data, encoding = _transcode(head + f.read(), encoding)
+            f.close()
+            return data, None, None, encoding
+
+        if size < MMAP_THRESHOLD:
+            data = head + f.read()
+            f.close()
+            try:
+                data.decode("utf-8")  # 検証のみ
+            except UnicodeDecodeError:
+                # 先頭だけ UTF-8 として読めた Shift_JIS などのテキスト
+                data, encoding = _transcode(data, FALLBACK_ENCODINGS[0])
+            return data, None, None, encoding
+
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            _validate_utf8(_mmap_chunks(mm))
+        except UnicodeDecodeError:
+            # 先頭だけ UTF-8 として読めた Shift_JIS などのテキスト (小さいファイルと同じ扱い)
+            try:
+                data, encoding = _transcode(mm[:], FALLBACK_ENCODINGS[0])
+            finally:
+                mm.close()
+            f.close()
+            return data, None, None, encoding
+        except Exception:
+            mm.close()
+            raise
+        return None, mm, f, encoding
+    except Exception:
+        f.close()
+        raise
+
+
+def load_file(filepath, read_content=True):
+    """
+    ファイル内容を出力用に読み込みます (書き込みは行いません)。
+    ワーカースレッドから呼ばれ、読み込みを出力の書き込みと並行して進めます。
+
+    Args:
+        filepath (str): 処理対象のファイルのパス。
+        read_content (bool): Falseの場合は内容を読まず、省略メッセージだけを返す。
+
+    Returns:
+        tuple: (read_content, content_message, data, mm, f)
+            read_content は読み込みに成功した場合のみ True。
+            data / mm / f は _read_content() の戻り値 (読まなかった場合は None)。
+    """
+    data = mm = f = None
+    content_message = "- 内容:\n" # デフォルトの内容ヘッダー
+
+    # read_content が True の場合のみファイル内容を試行的に読み込む
+    if read_content:
+        try:
+            data, mm, f, encoding = _read_content(filepath)
+            if encoding != "utf-8":
+                print(
+                    f"情報: '{filepath}' は {encoding} として読み込み、UTF-8 に変換しました。",
+                    file=sys.stderr
+                )
+        except BinaryContentError as e:
+            # 先頭部分だけでバイナリと判定した場合 (残りは読んでいない)
+            print(
+                f"警告: '{filepath}' はバイナリファイルと判定しました ({e})。"
+                "内容は省略します。",
+                file=sys.stderr
+            )
+            read_content = False
+            content_message = "- 内容: (バイナリファイルのため省略)\n"
+        except UnicodeDecodeError:
+            # UTF-8でデコードできないバイナリファイルなどの場合
+            print(
+                f"警告: '{filepath}' はUTF-8でデコードできませんでした。"
+                "内容は省略します。",
+                file=sys.stderr
+            )
+            read_content = False  # 内容は読み込めなかったのでフラグをFalseに
+            content_message = "- 内容: (バイナリファイルまたはデコードエラーのため省略)\n"
+        except OSError as e:
+            # ファイル読み込みに関する他のOSエラー (アクセス権限など)
+            print(
+                f"エラー: '{filepath}' の内容読み込み中にOSエラーが"
+                f"発生しました: {e}",
+                file=sys.stderr
+            )
+            read_content = False
+            content_message = f"- 内容: (読み込みエラーのため省略: {e})\n"
+        except Exception as e:
+            # その他の予期せぬ読み込みエラー
+            print(
+                f"エラー: '{filepath}' の内容読み込み中に予期せぬエラーが"
+                f"発生しました: {e}",
+                file=sys.stderr
+            )
+            read_content = False
+            content_message = f"- 内容: (予期せぬ読み込みエラーのため省略: {e})\n"
+    else:
+        # 最初から内容を読み込まない場合
+        content_message = "- 内容: (指定により省略)\n"
+
+    return read_content, content_message, data, mm, f
+
+
+@telemetry.traced("codeB.process_file")
+def process_file(filepath, outfile, read_content=True, loaded=None):
     """
     指定されたファイルの情報（内容を含むか含まないか選択可能）を
-    指定されたフォーマットで出力ファイルに書き込みます。
+    指定されたフォーマットで出力ストリームに書き込みます。
 
     Args:
         filepath (str): 処理対象のファイルの絶対パスまたは相対パス。
-        output_file (str): 出力先のファイルパス。
+        outfile (BinaryIO): 出力先のバイナリストリーム。main() で一度だけ開かれ、
+                            すべてのファイルで共有される (ファイルごとに開き直さない)。
         read_content (bool): Trueの場合、ファイル内容を読み込んで出力する。
                              Falseの場合、内容は省略する。
+        loaded (tuple | None): load_file() で読み込み済みの結果。
+                               None の場合はここで読み込む。
     """
     try:
         # ファイルパスからルートディレクトリとファイル名を分離
@@ -117,76 +422,51 @@ def process_file(filepath, output_file, read_content=True):
         if not root:
             root = '.'
 
-        content = None
-        content_message = "- 内容:\n" # デフォルトの内容ヘッダー
+        if loaded is None:
+            loaded = load_file(filepath, read_content)
+        read_content, content_message, data, mm, f = loaded
 
-        # read_content が True の場合のみファイル内容を試行的に読み込む
-        if read_content:
-            try:
-                # UTF-8でファイルを開く
-                with open(filepath, "r", encoding="utf-8") as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                # UTF-8でデコードできないバイナリファイルなどの場合
-                print(
-                    f"警告: '{filepath}' はUTF-8でデコードできませんでした。"
-                    "内容は省略します。",
-                    file=sys.stderr
-                )
-                read_content = False  # 内容は読み込めなかったのでフラグをFalseに
-                content_message = "- 内容: (バイナリファイルまたはデコードエラーのため省略)\n"
-            except OSError as e:
-                # ファイル読み込みに関する他のOSエラー (アクセス権限など)
-                print(
-                    f"エラー: '{filepath}' の内容読み込み中にOSエラーが"
-                    f"発生しました: {e}",
-                    file=sys.stderr
-                )
-                read_content = False
-                content_message = f"- 内容: (読み込みエラーのため省略: {e})\n"
-            except Exception as e:
-                # その他の予期せぬ読み込みエラー
-                print(
-                    f"エラー: '{filepath}' の内容読み込み中に予期せぬエラーが"
-                    f"発生しました: {e}",
-                    file=sys.stderr
-                )
-                read_content = False
-                content_message = f"- 内容: (予期せぬ読み込みエラーのため省略: {e})\n"
-        else:
-            # 最初から内容を読み込まない場合
-            content_message = "- 内容: (指定により省略)\n"
-
-        # --- 出力ファイルへの書き込み ---
+        # --- 出力ストリームへの書き込み ---
         try:
-            with open(output_file, "a", encoding="utf-8") as outfile:
-                # パス区切り文字を POSIX スタイル ('/') に統一して出力
-                posix_root = root.replace(os.sep, '/')
+            # パス区切り文字を POSIX スタイル ('/') に統一して出力
+            posix_root = root.replace(os.sep, '/')
 
-                # ファイル情報の書き込み
-                outfile.write("\n\n\n---\n\n\n")
-                outfile.write(f"- フォルダ名: {posix_root}\n")
-                outfile.write(f"- ファイル名: {file}\n")
-                outfile.write(content_message) # 内容ヘッダーまたは省略メッセージ
+            # ファイル情報の書き込み
+            header = (
+                "\n\n\n---\n\n\n"
+                f"- フォルダ名: {posix_root}\n"
+                f"- ファイル名: {file}\n"
+                f"{content_message}" # 内容ヘッダーまたは省略メッセージ
+            )
+            outfile.write(header.encode("utf-8"))
 
-                # 内容が存在し、読み込みが成功した場合のみ内容を書き込む
-                if read_content and content is not None:
-                    outfile.write(content)
+            # 内容が存在し、読み込みが成功した場合のみ内容を書き込む
+            if read_content:
+                if mm is not None:
+                    _copy_normalized(outfile, _mmap_chunks(mm))
+                else:
+                    _copy_normalized(outfile, [data])
+                telemetry.current_span().set(bytes=len(mm) if mm is not None else len(data))
 
         except OSError as e:
             # 出力ファイルへの書き込みエラー
             print(
-                f"エラー: 出力ファイル '{output_file}' への書き込み中に"
+                f"エラー: 出力ファイルへの書き込み中に"
                 f"OSエラーが発生しました: {e}",
                 file=sys.stderr
             )
         except Exception as e:
             # その他の予期せぬ書き込みエラー
             print(
-                f"エラー: 出力ファイル '{output_file}' への書き込み中に"
+                f"エラー: 出力ファイルへの書き込み中に"
                 f"予期せぬエラーが発生しました: {e}",
                 file=sys.stderr
             )
+        finally:
+            if mm is not None:
+                mm.close()
+            if f is not None:
+                f.close()
 
     except Exception as e:
         # ファイルパスの処理や予期せぬエラー
@@ -197,6 +477,604 @@ def process_file(filepath, output_file, read_content=True):
         )
 
 
+def _release(loaded):
+    """書き込まれなかった load_file() の結果が持つ mmap / ファイルハンドルを閉じます。"""
+    _, _, _, mm, f = loaded
+    if mm is not None:
+        mm.close()
+    if f is not None:
+        f.close()
+
+
+def file_sha1(filepath):
+    """ファイル内容の SHA-1 (チャンク単位で読み、大きいファイルも一度に載せない)"""
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_index(index_path):
+    """
+    出力ファイルの索引を読み込みます。
+    無い・壊れている・形式が古い場合は None を返します (全件を書き直す)。
+
+    索引の "files" は相対パス ('/' 区切り) をキーに、次の値を持つ:
+        size, mtime, sha1 : 元ファイルの状態 (差分判定用)
+        content           : 内容を出力したか (バイナリ拡張子なら False)
+        offset, length    : 出力ファイル内でのこのファイルの区画のバイト位置
+    """
+    try:
+        with open(index_path, "r", encoding="utf-8") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(index, dict) or index.get("version") != INDEX_VERSION:
+        return None
+    return index
+
+
+def save_index(index_path, index):
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, separators=(",", ":"), sort_keys=True)
+    os.replace(tmp_path, index_path)
+
+
+def read_section(output_file, entry):
+    """
+    索引の 1 エントリが指す区画 (ヘッダーと内容) を出力ファイルから直接読み出します。
+    "---" の区切りを先頭から解析し直さずに、1 ファイル分だけ取り出すためのものです。
+
+    Returns:
+        bytes: 区画のバイト列 (UTF-8)。
+    """
+    with open(output_file, "rb") as f:
+        f.seek(entry["offset"])
+        return f.read(entry["length"])
+
+
+def _check_file(filepath, read_content, old):
+    """
+    前回の索引と比べてファイルが変わったかを判定します (ワーカースレッドから呼ばれる)。
+    size と mtime が同じならハッシュは計算しません。
+
+    Returns:
+        tuple: (meta, unchanged)
+            meta は新しい索引エントリの元 (size, mtime, sha1, content)。
+            stat やハッシュに失敗した場合は sha1 が None になり、次回も書き直す。
+    """
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return {"size": None, "mtime": None, "sha1": None, "content": read_content}, False
+
+    meta = {"size": st.st_size, "mtime": st.st_mtime, "sha1": None, "content": read_content}
+    comparable = old is not None and old.get("sha1") and old.get("content") == read_content
+    if comparable and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+        meta["sha1"] = old["sha1"]
+        return meta, True
+
+    try:
+        meta["sha1"] = file_sha1(filepath)
+    except OSError:
+        return meta, False
+    return meta, bool(comparable) and old["sha1"] == meta["sha1"]
+
+
+def _copy_section(src, outfile, offset, length):
+    """前回の出力ファイルから区画をそのままコピーします。"""
+    src.seek(offset)
+    while length > 0:
+        chunk = src.read(min(COPY_CHUNK_SIZE, length))
+        if not chunk:
+            raise OSError("前回の出力ファイルが索引より短くなっています")
+        outfile.write(chunk)
+        length -= len(chunk)
+
+
+def _write_next(pending, outfile, old_output, entries):
+    """
+    先読みキューの先頭のファイルを出力に書き込み、索引に位置を記録します。
+    変更の無いファイルは前回の出力から区画をコピーし、
+    それ以外は読み込み完了を待ってから書き込みます。
+    """
+    rel, filepath, read_content, future, old = pending.popleft()
+    start = outfile.tell()
+    if future is None:
+        _copy_section(old_output, outfile, old["offset"], old["length"])
+    else:
+        try:
+            loaded = future.result()
+        except Exception as e:
+            # load_file 内で捕捉されなかった予期せぬエラー
+            print(
+                f"エラー: '{filepath}' の内容読み込み中に予期せぬエラーが"
+                f"発生しました: {e}",
+                file=sys.stderr
+            )
+            loaded = (False, f"- 内容: (予期せぬ読み込みエラーのため省略: {e})\n", None, None, None)
+        process_file(filepath, outfile, read_content=read_content, loaded=loaded)
+    entries[rel]["offset"] = start
+    entries[rel]["length"] = outfile.tell() - start
+
+
+def write_output(targets, output_file, pool, incremental=True):
+    """
+    対象ファイルを出力ファイルに書き込み、索引 (output_file + INDEX_SUFFIX) を更新します。
+
+    incremental が True の場合、前回の索引と size / mtime / ハッシュが同じファイルは
+    前回の出力から区画をそのままコピーし、変更されたファイルだけ読み直します。
+    すべて同じなら出力ファイルは書き換えません。
+
+    Args:
+        targets (list): (filepath, filepath_rel_posix, read_content) のリスト (出力順)。
+        output_file (str): 出力ファイルのパス。
+        pool (ThreadPoolExecutor): 差分判定とファイル読み込みに使うワーカープール。
+        incremental (bool): False の場合は索引を無視してすべて書き直す。
+    """
+    index_path = output_file + INDEX_SUFFIX
+    old_entries = {}
+    if incremental and os.path.exists(output_file):
+        index = load_index(index_path)
+        if index is not None:
+            old_entries = index["files"]
+
+    # --- 差分判定 (stat / ハッシュはワーカーで並行して行う) ---
+    checks = list(pool.map(
+        lambda t: _check_file(t[0], t[2], old_entries.get(t[1])), targets
+    ))
+    entries = {rel: meta for (_, rel, _), (meta, _) in zip(targets, checks)}
+    changed = sum(1 for _, unchanged in checks if not unchanged)
+    removed = sum(1 for rel in old_entries if rel not in entries)
+
+    if old_entries and not changed and not removed:
+        for rel, entry in entries.items():
+            entry["offset"] = old_entries[rel]["offset"]
+            entry["length"] = old_entries[rel]["length"]
+        save_index(index_path, {"version": INDEX_VERSION, "files": entries})
+        print(f"変更なし: {output_file} を書き換えずに終了します。")
+        return
+
+    if old_entries:
+        print(f"差分更新: 変更 {changed} 件 / 削除 {removed} 件 (全 {len(targets)} 件)")
+
+    # --- 出力ファイルの書き込み ---
+    # 一時ファイルに書いてから置き換える (前回の出力から区画をコピーするため)。
+    # 出力ファイルは一度だけ開き、すべてのファイルで同じバッファ付きストリームに書き込む
+    tmp_path = output_file + ".tmp"
+    try:
+        outfile = open(tmp_path, "wb", buffering=OUTPUT_BUFFER_SIZE)
+    except OSError as e:
+        print(
+            f"エラー: 出力ファイル '{output_file}' のオープン中に"
+            f"OSエラーが発生しました: {e}",
+            file=sys.stderr
+        )
+        # 出力先がないと処理を続けられないので終了する
+        sys.exit(1)
+
+    old_output = open(output_file, "rb") if old_entries else None
+    pending = deque()  # 読み込み中 (または読み込み済み) で書き込み待ちのファイル
+    completed = False
+    try:
+        for (filepath, rel, read_content), (_, unchanged) in zip(targets, checks):
+            if unchanged:
+                pending.append((rel, filepath, read_content, None, old_entries[rel]))
+            else:
+                # 読み込みはワーカーに任せ、先読みが上限に達したら古い順に書き出す
+                future = pool.submit(load_file, filepath, read_content)
+                pending.append((rel, filepath, read_content, future, None))
+            if len(pending) >= READ_AHEAD:
+                _write_next(pending, outfile, old_output, entries)
+
+        while pending:
+            _write_next(pending, outfile, old_output, entries)
+        completed = True
+    finally:
+        # エラー時に残った先読み分の mmap / ファイルハンドルも閉じる
+        for _, _, _, future, _ in pending:
+            if future is not None and future.cancel() is False and future.exception() is None:
+                _release(future.result())
+        outfile.close()
+        if old_output is not None:
+            old_output.close()
+        if not completed:
+            # 途中で失敗した場合は前回の出力と索引を残す
+            os.remove(tmp_path)
+
+    os.replace(tmp_path, output_file)
+    save_index(index_path, {"version": INDEX_VERSION, "files": entries})
+
+
+_ASCII_BYTES = bytes(range(128))
+
+
+def estimate_tokens(data):
+    """
+    バイト列のトークン数を概算します (API を呼ばない)。
+    ASCII はおよそ 4 バイト、日本語などの非 ASCII 文字 (UTF-8 で約 3 バイト) は
+    およそ 1 文字で 1 トークンとして数えます。
+    """
+    non_ascii = len(data.translate(None, _ASCII_BYTES))
+    return (len(data) - non_ascii) // 4 + non_ascii // 3 + 1
+
+
+_WHITESPACE_BYTES = b" \t"
+_SYMBOL_BYTES = b"{}[]();,=:<>\"'"
+
+
+def looks_minified(sample, filepath):
+    """
+    先頭部分の内容から、圧縮 (minify) ・自動生成されたファイルかを判定します。
+    拡張子に頼らず、行が長く (平均 MINIFIED_AVG_LINE / 最長 MINIFIED_MAX_LINE 超)、
+    しかも文章らしくない (空白が少ない・記号が多い) ものを圧縮ファイルとみなします。
+    1 行に詰め込まれた .js / .json / .css / .svg や base64 の埋め込みを検出し、
+    1 段落が 1 行になっている日本語・英語の文章は残します。
+    """
+    if os.path.splitext(filepath)[1].lower() in MINIFIED_EXEMPT_EXTENSIONS:
+        return False
+    if len(sample) < MINIFIED_MIN_BYTES:
+        return False
+    lines = sample.split(b"\n")
+    if len(sample) / len(lines) <= MINIFIED_AVG_LINE and max(len(line) for line in lines) <= MINIFIED_MAX_LINE:
+        return False
+
+    size = len(sample)
+    if len(sample.translate(None, _ASCII_BYTES)) / size >= MINIFIED_MAX_NON_ASCII:
+        return False
+    whitespace = (size - len(sample.translate(None, _WHITESPACE_BYTES))) / size
+    symbols = (size - len(sample.translate(None, _SYMBOL_BYTES))) / size
+    return not (whitespace >= MINIFIED_MIN_WHITESPACE and symbols < MINIFIED_MAX_SYMBOLS)
+
+
+def _load_budgeted(filepath, read_content, max_file_tokens):
+    """
+    load_file() に加えて、トークン数の概算と圧縮ファイル・巨大ファイルの扱いを決めます
+    (ワーカースレッドから呼ばれる)。
+
+    Returns:
+        tuple: (loaded, tokens, note)
+            loaded は load_file() と同じ形式、tokens は内容の概算トークン数。
+            note は "minified" (内容を省略), "truncated" (先頭だけ残した), None のいずれか。
+    """
+    loaded = load_file(filepath, read_content)
+    ok, content_message, data, mm, f = loaded
+    if not ok:
+        return loaded, 0, None
+
+    source = data if mm is None else mm
+    sample = source[:TOKEN_SAMPLE_SIZE]
+    if looks_minified(sample[:MINIFIED_SAMPLE_SIZE], filepath):
+        print(
+            f"情報: '{filepath}' は圧縮・自動生成されたファイルと判定しました。内容は省略します。",
+            file=sys.stderr
+        )
+        _release(loaded)
+        return (False, "- 内容: (圧縮・自動生成されたファイルと判定したため省略)\n",
+                None, None, None), 0, "minified"
+
+    tokens = estimate_tokens(sample)
+    if len(source) > len(sample):
+        tokens = tokens * len(source) // len(sample)
+
+    if max_file_tokens is None or tokens <= max_file_tokens:
+        return loaded, tokens, None
+
+    # 上限を超える分は切り捨てる。行の途中 (と UTF-8 の文字の途中) で切らないよう、
+    # 上限に収まる最後の改行までを残す
+    limit = len(source) * max_file_tokens // tokens
+    head = source[:limit]
+    cut = head.rfind(b"\n")
+    head = head[:cut + 1] if cut >= 0 else b""
+    _release(loaded)
+    content_message = f"- 内容: (先頭のみ。全体は約 {tokens} トークン)\n"
+    return (True, content_message, head, None, None), estimate_tokens(head), "truncated"
+
+
+def shard_path(output_file, number):
+    stem, ext = os.path.splitext(output_file)
+    return SHARD_FILENAME_FORMAT.format(stem=stem, number=number, ext=ext)
+
+
+# process_file() が書くヘッダーのうち、パスと内容メッセージ以外の部分
+_HEADER_OVERHEAD = len("\n\n\n---\n\n\n- フォルダ名: \n- ファイル名: \n".encode("utf-8"))
+
+
+def _section_size(filepath, loaded):
+    """
+    process_file() が書く区画 (ヘッダーと内容) のバイト数の上限と、
+    ヘッダー部分の概算トークン数を返します。
+    """
+    _, content_message, data, mm, _ = loaded
+    header_size = _HEADER_OVERHEAD + len(filepath.encode("utf-8")) + len(content_message.encode("utf-8"))
+    size = header_size + (len(data) if data is not None else len(mm) if mm is not None else 0)
+    return size, header_size // 3
+
+
+class ShardWriter:
+    """
+    分割出力の書き込み先。次のファイルを書くと上限を超える場合は、
+    新しい分割ファイルに切り替えてから書き込みます。
+    """
+
+    def __init__(self, output_file, shard_tokens=None, shard_bytes=None):
+        self.output_file = output_file
+        self.shard_tokens = shard_tokens
+        self.shard_bytes = shard_bytes
+        self.shards = []      # [パス, 概算トークン数, バイト数]
+        self.outfile = None
+
+    def _overflows(self, tokens, size):
+        _, used_tokens, used_bytes = self.shards[-1]
+        return (
+            (self.shard_tokens is not None and used_tokens + tokens > self.shard_tokens) or
+            (self.shard_bytes is not None and used_bytes + size > self.shard_bytes)
+        )
+
+    def write(self, filepath, read_content, loaded, tokens, size):
+        """
+        1 ファイル分を書き込みます。
+
+        Args:
+            tokens (int): ヘッダーを含めた概算トークン数。
+            size (int): ヘッダーを含めたバイト数 (_section_size() の値)。
+        """
+        if self.outfile is not None and self._overflows(tokens, size):
+            self.close()
+        if self.outfile is None:
+            path = shard_path(self.output_file, len(self.shards) + 1)
+            self.outfile = open(path, "wb", buffering=OUTPUT_BUFFER_SIZE)
+            self.shards.append([path, 0, 0])
+
+        start = self.outfile.tell()
+        process_file(filepath, self.outfile, read_content=read_content, loaded=loaded)
+        self.shards[-1][1] += tokens
+        self.shards[-1][2] += self.outfile.tell() - start
+
+    def close(self):
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+
+def write_sharded(targets, output_file, pool, max_tokens=None, shard_tokens=None,
+                  shard_bytes=None, max_file_tokens=None):
+    """
+    トークン予算モードで出力します。LLM のコンテキストやアップロードの上限に収まるよう、
+    分割した出力ファイル (shard_path() の名前) に書き込みます。
+
+      - max_tokens      : 全体のトークン数の上限。収まらないファイルは出力しない
+      - shard_tokens    : 1 ファイルあたりのトークン数の上限
+      - shard_bytes     : 1 ファイルあたりのバイト数の上限
+      - max_file_tokens : 1 ファイルの内容の上限。超える分は先頭だけ残す
+    圧縮・自動生成と判定したファイルは内容を省略します。
+    このモードでは索引による差分更新は行いません。
+
+    Args:
+        targets (list): (filepath, filepath_rel_posix, read_content) のリスト (出力順)。
+        output_file (str): 分割前の出力ファイル名 (分割出力の名前の元)。
+        pool (ThreadPoolExecutor): ファイル読み込みに使うワーカープール。
+
+    Returns:
+        dict: shards ([パス, 概算トークン数, バイト数] のリスト) と、
+              over_budget / minified / truncated (該当したファイルの相対パス)
+    """
+    # 前回の実行で作られた分割出力が残らないよう消しておく
+    stem, ext = os.path.splitext(output_file)
+    for old_shard in glob.glob(glob.escape(stem) + "_[0-9]*" + glob.escape(ext)):
+        os.remove(old_shard)
+
+    result = {"over_budget": [], "minified": [], "truncated": []}
+    writer = ShardWriter(output_file, shard_tokens, shard_bytes)
+    total_tokens = 0
+
+    def write_next():
+        nonlocal total_tokens
+        filepath, rel, read_content, future = pending.popleft()
+        loaded, tokens, note = future.result()
+        if note is not None:
+            result[note].append(rel)
+        size, header_tokens = _section_size(filepath, loaded)
+        tokens += header_tokens
+        if max_tokens is not None and total_tokens + tokens > max_tokens:
+            # 予算に収まらないファイルは飛ばし、後続の小さいファイルで予算を使い切る
+            _release(loaded)
+            result["over_budget"].append(rel)
+            return
+        writer.write(filepath, read_content, loaded, tokens, size)
+        total_tokens += tokens
+
+    pending = deque()
+    try:
+        for filepath, rel, read_content in targets:
+            future = pool.submit(_load_budgeted, filepath, read_content, max_file_tokens)
+            pending.append((filepath, rel, read_content, future))
+            if len(pending) >= READ_AHEAD:
+                write_next()
+        while pending:
+            write_next()
+    finally:
+        # エラー時に残った先読み分の mmap / ファイルハンドルも閉じる
+        for _, _, _, future in pending:
+            if future.cancel() is False and future.exception() is None:
+                _release(future.result()[0])
+        writer.close()
+
+    result["shards"] = writer.shards
+    result["total_tokens"] = total_tokens
+    return result
+
+
+def has_suffix(file_lower, suffixes):
+    """
+    file_lower が suffixes のいずれかで終わるかを判定します。
+    拡張子はすべて '.' で始まるので、ファイル名中の '.' の位置ごとに
+    集合を引くだけでよい (拡張子の数に依存しない)。
+    """
+    i = file_lower.find('.')
+    while i != -1:
+        if file_lower[i:] in suffixes:
+            return True
+        i = file_lower.find('.', i + 1)
+    return False
+
+
+def _compile_segments(patterns):
+    """
+    gitignore 形式のパターンを、除外/再包含 (!) が同じ連続部分ごとに
+    1 つの正規表現にまとめます。
+
+    Returns:
+        list: (include, regex) のリスト。include が True なら除外、False なら再包含。
+    """
+    segments = []
+    for line in patterns:
+        pattern = pathspec.patterns.GitWildMatchPattern(line)
+        if pattern.include is None:
+            continue  # 空行・コメント
+        # 名前付きグループは結合すると重複するので、ただのグループにする
+        source = pattern.regex.pattern.replace("(?P<ps_d>", "(?:")
+        if segments and segments[-1][0] == pattern.include:
+            segments[-1][1].append(source)
+        else:
+            segments.append((pattern.include, [source]))
+    return [
+        (include, re.compile("|".join(f"(?:{src})" for src in sources)))
+        for include, sources in segments
+    ]
+
+
+class ExcludeMatcher:
+    """
+    除外パターンを事前にコンパイルした判定器。
+    pathspec.PathSpec.match_file と同じ結果を、パターン数によらず
+    数回の正規表現マッチで返します。
+
+    サブディレクトリの .gitignore は child() で層として重ね、
+    深い層の判定を優先します (git と同じく、そのディレクトリからの相対パスで判定)。
+    """
+
+    def __init__(self, patterns, base="", parent=None):
+        self.base = base          # パターンの基準ディレクトリ ('/' 区切り、ルートは "")
+        self.parent = parent      # 親ディレクトリの判定器 (ルートは None)
+        self.segments = _compile_segments(patterns)
+        self._dir_cache = {}      # ディレクトリの相対パス -> 除外するか
+
+    def child(self, base, patterns):
+        """base ディレクトリの .gitignore を重ねた判定器を返します。"""
+        return ExcludeMatcher(patterns, base, self)
+
+    def _decide(self, rel):
+        """この層での判定。どのパターンにも一致しなければ None。"""
+        if self.base:
+            rel = rel[len(self.base) + 1:]
+        # 後に書かれたパターンほど優先 (gitignore の規則)
+        for include, regex in reversed(self.segments):
+            if regex.match(rel):
+                return include
+        return None
+
+    def match_file(self, rel):
+        """rel (カレントディレクトリからの相対パス、'/' 区切り) を除外するか"""
+        matcher = self
+        while matcher is not None:
+            decision = matcher._decide(rel)
+            if decision is not None:
+                return decision
+            matcher = matcher.parent
+        return False
+
+    def match_dir(self, rel):
+        """ディレクトリ rel を除外するか (結果はキャッシュし、同じ判定を繰り返さない)"""
+        excluded = self._dir_cache.get(rel)
+        if excluded is None:
+            excluded = self.match_file(rel + '/')
+            self._dir_cache[rel] = excluded
+        return excluded
+
+
+def _scan_dir(dirpath, dirrel, matcher):
+    """
+    1 ディレクトリ分を os.scandir で走査します (ワーカースレッドから呼ばれる)。
+
+    Args:
+        dirpath (str): 走査するディレクトリのパス ("./sub" の形式)。
+        dirrel (str): カレントディレクトリからの相対パス ('/' 区切り、ルートは "")。
+        matcher (ExcludeMatcher): 親ディレクトリまでの除外パターン。
+
+    Returns:
+        tuple: (subdirs, files)
+            subdirs は次に走査する (dirpath, dirrel, matcher) のリスト、
+            files は (filepath, filepath_rel_posix, file, matcher) のリスト。
+    """
+    with os.scandir(dirpath) as it:
+        entries = list(it)
+
+    # サブディレクトリの .gitignore は、このディレクトリ以下にだけ適用する
+    # (ルートの .gitignore は main() で読み込み済み)
+    if dirrel:
+        for entry in entries:
+            if entry.name == ".gitignore" and entry.is_file():
+                matcher = matcher.child(dirrel, read_gitignore(entry.path))
+                break
+
+    subdirs = []
+    files = []
+    for entry in entries:
+        rel = f"{dirrel}/{entry.name}" if dirrel else entry.name
+        try:
+            # os.walk と同じく、シンボリックリンクのディレクトリはたどらない
+            is_dir = entry.is_dir(follow_symlinks=False)
+        except OSError:
+            is_dir = False
+        if is_dir:
+            # 除外パターンにマッチするディレクトリは、配下に一切入らない
+            if not matcher.match_dir(rel):
+                subdirs.append((os.path.join(dirpath, entry.name), rel, matcher))
+        else:
+            files.append((os.path.join(dirpath, entry.name), rel, entry.name, matcher))
+    return subdirs, files
+
+
+def scan_tree(matcher, pool, root="."):
+    """
+    root 以下をディレクトリ単位で並列に走査し、ファイルを相対パス順に返します。
+
+    Args:
+        matcher (ExcludeMatcher): ルートの除外パターン。
+        pool (ThreadPoolExecutor): 走査に使うワーカープール。
+        root (str): 探索を開始するディレクトリ。
+
+    Returns:
+        list: (filepath, filepath_rel_posix, file, matcher) のリスト
+              (filepath_rel_posix の昇順)。matcher はそのファイルに適用する判定器。
+    """
+    found = []
+    running = {pool.submit(_scan_dir, root, "", matcher): root}
+    while running:
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            dirpath = running.pop(future)
+            try:
+                subdirs, files = future.result()
+            except OSError as e:
+                # os.walk と同様、読めないディレクトリは警告だけ出して飛ばす
+                print(
+                    f"警告: ディレクトリ '{dirpath}' を読み込めませんでした: {e}",
+                    file=sys.stderr
+                )
+                continue
+            found.extend(files)
+            for sub_path, sub_rel, sub_matcher in subdirs:
+                running[pool.submit(_scan_dir, sub_path, sub_rel, sub_matcher)] = sub_path
+
+    # ワーカーの完了順に依存しないよう、出力順は相対パスで決める
+    found.sort(key=lambda item: item[1])
+    return found
+
+
 def main():
     """
     メイン処理関数。
@@ -204,6 +1082,32 @@ def main():
     .gitignore とハードコードされたパターンで除外されていないファイルの
     情報を出力ファイルに書き込みます。
     """
+    arg_parser = argparse.ArgumentParser(description="ソースコードを 1 つのテキストファイルにまとめる")
+    arg_parser.add_argument(
+        "--full", action="store_true",
+        help="索引を無視して出力ファイルを最初から作り直す"
+    )
+    arg_parser.add_argument(
+        "--max-tokens", type=int, default=None,
+        help="全体の概算トークン数の上限 (指定すると分割出力モードになる)"
+    )
+    arg_parser.add_argument(
+        "--shard-tokens", type=int, default=None,
+        help="分割出力 1 ファイルあたりの概算トークン数の上限"
+    )
+    arg_parser.add_argument(
+        "--shard-bytes", type=int, default=None,
+        help="分割出力 1 ファイルあたりのバイト数の上限"
+    )
+    arg_parser.add_argument(
+        "--max-file-tokens", type=int, default=None,
+        help="1 ファイルの内容の概算トークン数の上限 (超える分は先頭だけ出力する)"
+    )
+    args = arg_parser.parse_args()
+    sharded = any(
+        v is not None for v in (args.max_tokens, args.shard_tokens, args.shard_bytes, args.max_file_tokens)
+    )
+
     output_file = DEFAULT_OUTPUT_FILE
 
     # --- 除外パターンの準備 ---
@@ -211,40 +1115,19 @@ def main():
     # ハードコードされたパターンとgitignoreのパターンを結合
     all_exclude_patterns = HARDCODED_EXCLUDE_PATTERNS + gitignore_patterns
 
-    # pathspec オブジェクトを作成 (GitWildMatchPattern を使用)
+    # 除外判定器を作成 (pathspec の GitWildMatchPattern を 1 つの正規表現にまとめる)
     # これが .gitignore のルールを解釈する
     try:
-        spec = pathspec.PathSpec.from_lines(
-            pathspec.patterns.GitWildMatchPattern, all_exclude_patterns
-        )
+        matcher = ExcludeMatcher(all_exclude_patterns)
     except Exception as e:
         print(
             f"エラー: pathspec の初期化中にエラーが発生しました: {e}\n"
             "除外パターンが正しくない可能性があります。",
             file=sys.stderr
         )
-        # spec がないと処理を続けられないので終了する
+        # 判定器がないと処理を続けられないので終了する
         sys.exit(1)
 
-    # --- 出力ファイルの初期化 ---
-    try:
-        # 出力ファイルが既に存在すれば削除 (追記ではなく毎回新規作成)
-        if os.path.exists(output_file):
-            os.remove(output_file)
-    except OSError as e:
-        print(
-            f"エラー: 既存の出力ファイル '{output_file}' の削除中に"
-            f"OSエラーが発生しました: {e}",
-            file=sys.stderr
-        )
-        # 削除できなくても処理は続けられる場合があるが、警告は出す
-    except Exception as e:
-        print(
-            f"エラー: 既存の出力ファイル '{output_file}' の削除中に"
-            f"予期せぬエラーが発生しました: {e}",
-            file=sys.stderr
-        )
-
     # --- 処理結果記録用のリスト ---
     processed_files_content = []  # 内容を含めて処理されたファイル
     processed_files_no_content = [] # 内容を省略して処理されたファイル
@@ -253,76 +1136,51 @@ def main():
 
     # --- ファイルシステムの探索と処理 ---
     print("ファイル探索と処理を開始します...")
+    # ディレクトリ走査とファイル読み込みはワーカープールで並行して行い、
+    # 出力ストリームへの書き込みだけをこのスレッドで相対パス順に行う
+    pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+    targets = []  # 出力対象 (filepath, filepath_rel_posix, read_content)
+    sharded_result = None
     try:
-        # os.walk でカレントディレクトリ (.) 以下を再帰的に探索
-        # topdown=True はデフォルトだが明示
-        for root, dirs, files in os.walk(".", topdown=True):
-
-            # --- ディレクトリの除外 (オプション: パフォーマンス向上) ---
-            # .gitignore パターンにマッチするディレクトリを探索対象から除外する
-            # イテレーション中にリストを変更するため、スライス(dirs[:])を使用
-            dirs[:] = [
-                d for d in dirs
-                if not spec.match_file(
-                    os.path.relpath(os.path.join(root, d), ".").replace(os.sep, '/') + '/'
-                )
-            ]
-            # メモ: 除外されたディレクトリ自体は excluded_files_spec には記録されない
-            # 必要であればここで記録するロジックを追加できる
-
-            # --- ファイルの処理 ---
-            for file in files:
-                # 絶対パスを取得 (エラーメッセージなどで分かりやすいため)
-                filepath_abs = os.path.join(root, file)
-                # pathspec で判定するために、カレントディレクトリからの相対パスに変換し、
-                # 区切り文字を '/' に統一する (Git スタイル)
-                try:
-                    filepath_rel_posix = os.path.relpath(filepath_abs, ".").replace(os.sep, '/')
-                except ValueError as e:
-                    # パスがおかしい場合など
-                    print(
-                        f"警告: 相対パスの取得に失敗しました: {filepath_abs} ({e})。"
-                        "このファイルはスキップされます。",
-                        file=sys.stderr
-                    )
-                    continue # 次のファイルへ
-
-                # 1. 除外パターンによる判定 (pathspec)
-                if spec.match_file(filepath_rel_posix):
-                    excluded_files_spec.append(filepath_rel_posix)
-                    # print(f"除外 (パターン): {filepath_rel_posix}") # 詳細ログ用
-                    continue  # 除外パターンに一致したら次のファイルへ
-
-                # 2. 拡張子による判定
-                file_lower = file.lower() # 比較は小文字で行う
-                is_target_extension = False
-                for ext in TARGET_EXTENSIONS:
-                    if file_lower.endswith(ext):
-                        is_target_extension = True
-                        break # 対象拡張子のいずれかに一致したらループ終了
-
-                if is_target_extension:
-                    # 対象拡張子の場合、バイナリ拡張子かどうかを判定
-                    should_read_content = True # デフォルトは内容を読む
-                    for bin_ext in BINARY_EXTENSIONS:
-                        if file_lower.endswith(bin_ext):
-                            should_read_content = False
-                            break # バイナリ拡張子に一致したらループ終了
-
-                    # ファイル処理関数を呼び出し
-                    process_file(filepath_abs, output_file, read_content=should_read_content)
-
-                    # 処理結果をリストに追加
-                    if should_read_content:
-                        processed_files_content.append(filepath_rel_posix)
-                        # print(f"処理 (内容あり): {filepath_rel_posix}") # 詳細ログ用
-                    else:
-                        processed_files_no_content.append(filepath_rel_posix)
-                        # print(f"処理 (内容省略): {filepath_rel_posix}") # 詳細ログ用
-                else:
-                    # 対象拡張子でない場合
-                    excluded_files_extension.append(filepath_rel_posix)
-                    # print(f"除外 (拡張子): {filepath_rel_posix}") # 詳細ログ用
+        for filepath, filepath_rel_posix, file, file_matcher in scan_tree(matcher, pool):
+
+            # 1. 除外パターンによる判定 (ルートと各階層の .gitignore)
+            if file_matcher.match_file(filepath_rel_posix):
+                excluded_files_spec.append(filepath_rel_posix)
+                # print(f"除外 (パターン): {filepath_rel_posix}") # 詳細ログ用
+                continue  # 除外パターンに一致したら次のファイルへ
+
+            # 2. 拡張子による判定 (比較は小文字で行う)
+            file_lower = file.lower()
+            if not has_suffix(file_lower, TARGET_SUFFIXES):
+                # 対象拡張子でない場合
+                excluded_files_extension.append(filepath_rel_posix)
+                # print(f"除外 (拡張子): {filepath_rel_posix}") # 詳細ログ用
+                continue
+
+            # 対象拡張子の場合、バイナリ拡張子なら内容は読まない
+            should_read_content = not has_suffix(file_lower, BINARY_SUFFIXES)
+
+            targets.append((filepath, filepath_rel_posix, should_read_content))
+
+            # 処理結果をリストに追加
+            if should_read_content:
+                processed_files_content.append(filepath_rel_posix)
+                # print(f"処理 (内容あり): {filepath_rel_posix}") # 詳細ログ用
+            else:
+                processed_files_no_content.append(filepath_rel_posix)
+                # print(f"処理 (内容省略): {filepath_rel_posix}") # 詳細ログ用
+
+        if sharded:
+            sharded_result = write_sharded(
+                targets, output_file, pool,
+                max_tokens=args.max_tokens,
+                shard_tokens=args.shard_tokens,
+                shard_bytes=args.shard_bytes,
+                max_file_tokens=args.max_file_tokens,
+            )
+        else:
+            write_output(targets, output_file, pool, incremental=not args.full)
 
     except Exception as e:
         print(
@@ -330,6 +1188,8 @@ def main():
             file=sys.stderr
         )
         # エラーが発生しても、ここまでの結果は表示する
+    finally:
+        pool.shutdown(wait=True)
 
     # --- 処理結果のサマリー表示 ---
     print("\n--- 処理完了 ---")
@@ -347,7 +1207,19 @@ def main():
     for f in sorted(excluded_files_extension):
         print(f"除外:対象外拡張子- {f}")
 
-    print(f"\n\n出力ファイル: {output_file}")
+    if sharded_result is None:
+        print(f"\n\n出力ファイル: {output_file}")
+    else:
+        for label, key in (("予算超過のため省略", "over_budget"),
+                           ("圧縮・自動生成のため内容省略", "minified"),
+                           ("先頭のみ出力", "truncated")):
+            print(f"\n{label} ({len(sharded_result[key])} 件):")
+            for f in sharded_result[key]:
+                print(f"{label}- {f}")
+
+        print(f"\n\n出力ファイル (分割, 合計 約 {sharded_result['total_tokens']} トークン):")
+        for path, tokens, size in sharded_result["shards"]:
+            print(f"  {path}: 約 {tokens} トークン, {size} バイト")
 
     print(
         f"\n処理されたファイル (内容省略/バイナリ等) "
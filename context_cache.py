@@ -0,0 +1,175 @@
+# context_cache.py
+"""
+プロンプトの「ドキュメント部分」を使い回すためのコンテキストキャッシュ。
+
+同じシステム指示 + 同じドキュメント (検索で選ばれたチャンクの組) が
+セッション中に再び必要になったとき、2 回目以降は送信・再処理せずに
+キャッシュ名だけを指定して質問文だけを送る。
+
+  - GeminiContextCache : Gemini の Context Caching API を gemini_client.GeminiClient
+                         経由で (再試行・流量制御つきで) 使う実装
+  - LocalContextCache  : API を呼ばないローカル実装 (GEMINI_FAKE=1 のフェイクと組み合わせる)
+
+どちらも get() が「キャッシュ名」か None (キャッシュしない) を返す同じ形をしている。
+"""
+import hashlib
+import sys
+import time
+from abc import ABC, abstractmethod
+
+from gemini_client import estimate_tokens
+
+DEFAULT_TTL = 600       # Gemini 側のキャッシュの有効期間 (秒)
+REFRESH_MARGIN = 60     # 期限までこの秒数を切ったキャッシュは期限を延ばしてから使う
+# Gemini のコンテキストキャッシュに必要な最小トークン数。これに満たない内容は作成を試みない
+# (API は必ず 400 を返すので、1 往復と警告の出力が無駄になる)
+MIN_CACHE_TOKENS = 4096
+
+
+def cache_key(model: str, system_instruction: str, context: str) -> str:
+    h = hashlib.sha1()
+    for part in (model, system_instruction, context):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class ContextCache(ABC):
+    """コンテキストキャッシュの共通インターフェース"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abstractmethod
+    def get(self, model: str, system_instruction: str, context: str):
+        """
+        context をキャッシュしたハンドル名を返す。
+        初回は作成し、作成できない場合 (短すぎる等) は None を返す。
+        """
+
+    def close(self) -> None:
+        """作成したキャッシュを破棄する"""
+
+
+class LocalContextCache(ContextCache):
+    """
+    API を使わない実装。作成したキャッシュの内容を手元に保持し、
+    contents_for() で取り出せる (フェイククライアントと組み合わせて使う)。
+    """
+
+    def __init__(self, min_chars: int = 0):
+        super().__init__()
+        self.min_chars = min_chars
+        self.names = {}
+        self.contents = {}
+
+    def get(self, model, system_instruction, context):
+        if len(context) < self.min_chars:
+            return None
+
+        key = cache_key(model, system_instruction, context)
+        name = self.names.get(key)
+        if name is not None:
+            self.hits += 1
+            return name
+
+        self.misses += 1
+        name = f"cachedContents/local-{len(self.names) + 1}"
+        self.names[key] = name
+        self.contents[name] = (model, system_instruction, context)
+        return name
+
+    def contents_for(self, name):
+        return self.contents.get(name)
+
+    def close(self):
+        self.names.clear()
+        self.contents.clear()
+
+
+class GeminiContextCache(ContextCache):
+    """
+    gemini_client.GeminiClient の create_cache / update_cache / delete_cache を使う実装。
+
+    キャッシュは ttl 秒で Gemini 側から消えるので、期限も覚えておき、
+    期限が近いものは ttl を延長して (できなければ作り直して) から使う。
+    min_tokens に満たない内容は API を呼ばずに None を返し、4xx で作成を断られた内容は
+    覚えておいて二度と作成を試みない。
+    """
+
+    def __init__(self, client, ttl: int = DEFAULT_TTL, min_tokens: int = MIN_CACHE_TOKENS):
+        super().__init__()
+        self.client = client
+        self.ttl = ttl
+        self.min_tokens = min_tokens
+        self.names = {}      # key -> (キャッシュ名, 期限の time.time())
+        self.rejected = set()  # 作成を 4xx で断られた key
+        self.skipped = 0     # 短すぎる・断られたためにキャッシュしなかった回数
+
+    def get(self, model, system_instruction, context):
+        key = cache_key(model, system_instruction, context)
+        entry = self.names.get(key)
+        if entry is not None:
+            name, expires_at = entry
+            if expires_at - time.time() > REFRESH_MARGIN:
+                self.hits += 1
+                return name
+            if self._extend(key, name):
+                self.hits += 1
+                return name
+            del self.names[key]
+
+        tokens = estimate_tokens(system_instruction + context)
+        if tokens < self.min_tokens or key in self.rejected:
+            self.skipped += 1
+            return None
+
+        self.misses += 1
+        name = self._create(model, system_instruction, context, key, tokens)
+        if name is not None:
+            self.names[key] = (name, time.time() + self.ttl)
+        return name
+
+    def _create(self, model, system_instruction, context, key, tokens):
+        from google.genai import types
+
+        try:
+            cache = self.client.create_cache(
+                model,
+                config=types.CreateCachedContentConfig(
+                    system_instruction=system_instruction,
+                    contents=[context],
+                    ttl=f"{self.ttl}s",
+                    display_name=f"query-rag-{key[:12]}",
+                ),
+                tokens=tokens,
+            )
+            return cache.name
+        except Exception as e:
+            # キャッシュせず通常のプロンプトで送る。内容が原因の 4xx (429 以外) は
+            # 同じ内容で何度試しても通らないので覚えておく。一時的なエラーは次の機会にまた試す
+            code = getattr(e, "code", None)
+            if isinstance(code, int) and 400 <= code < 500 and code != 429:
+                self.rejected.add(key)
+            print(f"⚠ コンテキストキャッシュを作成できません: {e}", file=sys.stderr)
+            return None
+
+    def _extend(self, key, name):
+        """期限が近い (または切れた) キャッシュの ttl を延ばす。延ばせたら期限を更新して True"""
+        from google.genai import types
+
+        try:
+            self.client.update_cache(name, types.UpdateCachedContentConfig(ttl=f"{self.ttl}s"))
+        except Exception:
+            return False   # もう消えている → 作り直す
+        self.names[key] = (name, time.time() + self.ttl)
+        return True
+
+    def close(self):
+        for name, _expires_at in self.names.values():
+            try:
+                self.client.delete_cache(name)
+            except Exception as e:
+                print(f"⚠ キャッシュ削除に失敗 ({name}): {e}", file=sys.stderr)
+        self.names.clear()
@@ -0,0 +1,330 @@
+# corpus_pack.py
+"""
+RAG インデックス (チャンク本文 + 転置インデックス) をまとめて保存する、
+メモリマップ前提のパック形式。
+
+JSON を丸ごと読み込む形式では、質問に答えるプロセス (複数ワーカーならその全部) が
+起動のたびに全チャンクの本文と転置インデックスを Python のオブジェクトに展開していた。
+パック形式では 1 つのファイルを mmap で読み取り専用に開くだけで、
+
+  - チャンク本文: 連続した UTF-8 の blob + チャンクごとのオフセット表。
+                  アクセスされたチャンクだけをその場でデコードする
+  - ドキュメント: ファイル (source) ごとの最初のチャンク番号の表
+  - 転置インデックス: ソート済みの語の表 + 語ごとのポスティング (chunk_id, tf) の配列。
+                  語は二分探索で引き、配列はコピーせずに mmap から直接読む
+
+ページキャッシュは OS が共有するので、同じファイルを開く複数のプロセスで
+メモリは 1 つ分しか使わない。
+
+チャンク本文は BLOCK_SIZE 前後のブロックごとに圧縮することもできる
+(compression="zstd" は zstandard パッケージが必要。"zlib" は標準ライブラリ)。
+その場合は読んだブロックだけを展開し、最近のブロックをいくつか手元に残す。
+
+ファイルの構成:
+    MAGIC (8 バイト) | ディレクトリの位置と長さ (<QQ) | セクション ... | ディレクトリ (JSON)
+"""
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
+
+MAGIC = b"RAGPACK\0"
+PACK_VERSION = 1
+_HEADER = struct.Struct("<QQ")
+_ALIGN = 8
+
+BLOCK_SIZE = 64 * 1024      # 圧縮するときの 1 ブロックのおおよその大きさ (展開後)
+BLOCK_CACHE_SIZE = 16       # 展開済みのブロックを手元に残す数
+
+# セクション名 → array の型コード
+_SECTIONS = {
+    "doc_first_chunk": "I",   # ドキュメント i のチャンクは [doc_first_chunk[i], doc_first_chunk[i + 1])
+    "doc_name_starts": "I",
+    "doc_names": None,
+    "chunk_starts": "Q",      # チャンク i のレコードは展開後の blob の [chunk_starts[i], chunk_starts[i + 1])
+    "block_starts": "Q",      # ブロック j は展開後の blob の [block_starts[j], block_starts[j + 1])
+    "block_offsets": "Q",     # ブロック j は (圧縮された) blob の [block_offsets[j], block_offsets[j + 1])
+    "blob": None,
+    "doc_lengths": "I",
+    "term_starts": "I",
+    "terms": None,
+    "posting_starts": "I",
+    "posting_ids": "I",
+    "posting_tfs": "I",
+}
+
+
+# ---------------------------
+# 圧縮
+# ---------------------------
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd 圧縮には zstandard パッケージが必要です (pip install zstandard)")
+    return zstandard
+
+
+def _compress(compression, data: bytes) -> bytes:
+    if compression == "zstd":
+        return _zstd().ZstdCompressor(level=3).compress(data)
+    if compression == "zlib":
+        import zlib
+        return zlib.compress(data, 6)
+    raise ValueError(f"未知の圧縮形式です: {compression}")
+
+
+def _decompress(compression, data: bytes, size: int) -> bytes:
+    if compression == "zstd":
+        return _zstd().ZstdDecompressor().decompress(data, max_output_size=size)
+    if compression == "zlib":
+        import zlib
+        return zlib.decompress(data)
+    raise ValueError(f"未知の圧縮形式です: {compression}")
+
+
+COMPRESSIONS = (None, "zlib", "zstd")
+
+
+# ---------------------------
+# 書き込み
+# ---------------------------
+def _encode_record(chunk: dict) -> bytes:
+    """チャンク 1 件 = メタデータの JSON 1 行 + 本文 (JSON は改行を含まない)"""
+    meta = {key: value for key, value in chunk.items() if key != "text"}
+    return (json.dumps(meta, ensure_ascii=False, separators=(",", ":")) + "\n" + chunk["text"]).encode("utf-8")
+
+
+def write_pack(path: str, chunks, postings: dict, doc_lengths, meta: dict,
+               compression=None, block_size: int = BLOCK_SIZE) -> None:
+    """
+    チャンク・転置インデックス・文書長をパック形式で保存する (一時ファイルに書いてから置き換える)。
+    meta は呼び出し側の任意の情報 (版・fingerprint など) で、PackFile.meta でそのまま返る。
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"未知の圧縮形式です: {compression} (選択肢: zlib, zstd)")
+
+    sections = {}
+
+    # --- ドキュメント (連続する同じ source のチャンクをまとめる) ---
+    doc_first_chunk, doc_name_starts, doc_names = array("I"), array("I", [0]), bytearray()
+    previous = None
+    for chunk_id, chunk in enumerate(chunks):
+        if chunk_id == 0 or chunk["source"] != previous:
+            previous = chunk["source"]
+            doc_first_chunk.append(chunk_id)
+            doc_names += previous.encode("utf-8")
+            doc_name_starts.append(len(doc_names))
+    doc_first_chunk.append(len(chunks))
+    sections.update(doc_first_chunk=doc_first_chunk, doc_name_starts=doc_name_starts,
+                    doc_names=bytes(doc_names))
+
+    # --- チャンク本文 (圧縮する場合はチャンクの切れ目でブロックに分ける) ---
+    chunk_starts, block_starts, block_offsets = array("Q", [0]), array("Q", [0]), array("Q", [0])
+    blob, block = bytearray(), bytearray()
+    position = 0
+
+    def flush_block():
+        blob.extend(_compress(compression, bytes(block)) if compression else block)
+        block_starts.append(position)
+        block_offsets.append(len(blob))
+        block.clear()
+
+    for chunk in chunks:
+        record = _encode_record(chunk)
+        block += record
+        position += len(record)
+        chunk_starts.append(position)
+        if compression and len(block) >= block_size:
+            flush_block()
+    if block or len(block_starts) == 1:
+        flush_block()
+    sections.update(chunk_starts=chunk_starts, block_starts=block_starts,
+                    block_offsets=block_offsets, blob=bytes(blob))
+
+    # --- 転置インデックス ---
+    terms = sorted(postings)
+    term_starts, term_blob = array("I", [0]), bytearray()
+    posting_starts, posting_ids, posting_tfs = array("I", [0]), array("I"), array("I")
+    for term in terms:
+        term_blob += term.encode("utf-8")
+        term_starts.append(len(term_blob))
+        for chunk_id, tf in postings[term]:
+            posting_ids.append(chunk_id)
+            posting_tfs.append(tf)
+        posting_starts.append(len(posting_ids))
+    sections.update(doc_lengths=array("I", doc_lengths), term_starts=term_starts, terms=bytes(term_blob),
+                    posting_starts=posting_starts, posting_ids=posting_ids, posting_tfs=posting_tfs)
+
+    # --- ファイルに書き出す ---
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    directory = {
+        "pack_version": PACK_VERSION,
+        "byteorder": sys.byteorder,
+        "compression": compression,
+        "meta": meta,
+        "sections": {},
+    }
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC + _HEADER.pack(0, 0))
+        for name, data in sections.items():
+            f.write(b"\0" * (-f.tell() % _ALIGN))
+            raw = data.tobytes() if isinstance(data, array) else data
+            directory["sections"][name] = [f.tell(), len(raw)]
+            f.write(raw)
+        directory_bytes = json.dumps(directory, ensure_ascii=False).encode("utf-8")
+        directory_offset = f.tell()
+        f.write(directory_bytes)
+        f.seek(len(MAGIC))
+        f.write(_HEADER.pack(directory_offset, len(directory_bytes)))
+    os.replace(tmp_path, path)
+
+
+# ---------------------------
+# 読み込み
+# ---------------------------
+class PackFile:
+    """パック形式のファイルを mmap で開き、各セクションをコピーせずに参照する"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"パック形式のファイルではありません: {path}")
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        offset, length = _HEADER.unpack_from(self._mm, len(MAGIC))
+        directory = json.loads(self._mm[offset:offset + length])
+        if directory.get("pack_version") != PACK_VERSION or directory.get("byteorder") != sys.byteorder:
+            raise ValueError(f"パック形式の版が違います: {path}")
+
+        self.meta = directory["meta"]
+        self.compression = directory["compression"]
+        self._sections = directory["sections"]
+        self._view = memoryview(self._mm)
+
+        self.doc_lengths = self.section("doc_lengths")
+        self.chunks = PackedChunks(self)
+        self.postings = PackedPostings(self)
+
+    def section(self, name: str):
+        """セクションの memoryview (型付きのものは cast 済み)"""
+        offset, length = self._sections[name]
+        view = self._view[offset:offset + length]
+        typecode = _SECTIONS[name]
+        return view.cast(typecode) if typecode else view
+
+    @property
+    def documents(self) -> list[tuple[str, range]]:
+        """(source, チャンク番号の range) のリスト"""
+        first = self.section("doc_first_chunk")
+        starts = self.section("doc_name_starts")
+        names = self.section("doc_names")
+        return [
+            (bytes(names[starts[i]:starts[i + 1]]).decode("utf-8"), range(first[i], first[i + 1]))
+            for i in range(len(first) - 1)
+        ]
+
+
+class PackedChunks(Sequence):
+    """チャンクの dict の列 (アクセスされたものだけをデコードする)"""
+
+    def __init__(self, pack: PackFile):
+        self._pack = pack
+        self._chunk_starts = pack.section("chunk_starts")
+        self._block_starts = pack.section("block_starts")
+        self._block_offsets = pack.section("block_offsets")
+        self._blob = pack.section("blob")
+        self._blocks = OrderedDict()   # 展開済みブロックの LRU
+        self._lock = threading.Lock()  # 複数スレッドから検索される場合 (rag_server.py) の LRU の保護
+
+    def __len__(self):
+        return len(self._chunk_starts) - 1
+
+    def _block(self, block_id):
+        with self._lock:
+            data = self._blocks.get(block_id)
+            if data is not None:
+                self._blocks.move_to_end(block_id)
+                return data
+        compressed = self._blob[self._block_offsets[block_id]:self._block_offsets[block_id + 1]]
+        size = self._block_starts[block_id + 1] - self._block_starts[block_id]
+        data = _decompress(self._pack.compression, compressed, size)
+        with self._lock:
+            self._blocks[block_id] = data
+            if len(self._blocks) > BLOCK_CACHE_SIZE:
+                self._blocks.popitem(last=False)
+        return data
+
+    def _record(self, chunk_id) -> bytes:
+        start, end = self._chunk_starts[chunk_id], self._chunk_starts[chunk_id + 1]
+        if not self._pack.compression:
+            return self._blob[start:end]
+        # start を含むブロックを二分探索する (チャンクはブロックをまたがない)
+        lo, hi = 0, len(self._block_starts) - 2
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if self._block_starts[mid] <= start:
+                lo = mid
+            else:
+                hi = mid - 1
+        base = self._block_starts[lo]
+        return memoryview(self._block(lo))[start - base:end - base]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        meta, _, text = str(self._record(index), "utf-8").partition("\n")
+        chunk = json.loads(meta)
+        chunk["text"] = text
+        return chunk
+
+
+class PackedPostings:
+    """{term: [(chunk_id, tf), ...]} と同じように get() できる転置インデックス"""
+
+    def __init__(self, pack: PackFile):
+        self._term_starts = pack.section("term_starts")
+        self._terms = pack.section("terms")
+        self._posting_starts = pack.section("posting_starts")
+        self._posting_ids = pack.section("posting_ids")
+        self._posting_tfs = pack.section("posting_tfs")
+
+    def __len__(self):
+        return len(self._term_starts) - 1
+
+    def _term(self, i) -> bytes:
+        return self._terms[self._term_starts[i]:self._term_starts[i + 1]].tobytes()
+
+    def _find(self, term: str):
+        """ソート済みの語の表を二分探索する (UTF-8 のバイト順は str の順と同じ)"""
+        key = term.encode("utf-8")
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._term(lo) == key:
+            return lo
+        return None
+
+    def __contains__(self, term):
+        return self._find(term) is not None
+
+    def get(self, term: str, default=None):
+        i = self._find(term)
+        if i is None:
+            return default
+        start, end = self._posting_starts[i], self._posting_starts[i + 1]
+        return list(zip(self._posting_ids[start:end], self._posting_tfs[start:end]))
@@ -0,0 +1,205 @@
+# crawl_state.py
+"""
+ドキュメントクローラー (py_wget.py / playwright_wget.py) の永続状態。
+
+SQLite に以下を保存する:
+  - pages    : 取得済み URL ごとの ETag / Last-Modified / 内容ハッシュ
+  - frontier : 今回のクロールでまだ訪問していない URL (中断時の再開用)
+  - runs     : 開始 URL ごとのクロール回数と完了フラグ
+
+再クロール時は条件付きリクエスト (If-None-Match / If-Modified-Since) を送り、
+304 や内容ハッシュが同じページは保存し直さない。
+200 が返ったページも、JS なしで本文が入った HTML (static_html) ならその本文をそのまま使い、
+ブラウザで開き直さない (1 ページを 2 回取得しない)。
+"""
+import hashlib
+import os
+import sqlite3
+import time
+
+DEFAULT_DB_PATH = "crawl_state.sqlite"
+
+# JS を実行しなくても本文が含まれていると判断する目印 (devsite のページ構造)
+STATIC_CONTENT_MARKERS = ("devsite-article-body", "<article", "<main")
+# これより短い HTML は JS レンダリング前の空ページとみなす
+MIN_STATIC_HTML_BYTES = 5000
+
+
+def content_sha1(html):
+    return hashlib.sha1(html.encode("utf-8")).hexdigest()
+
+
+def looks_static(html):
+    """JS を実行しなくても本文が取れている HTML かどうかの簡易判定"""
+    return len(html) >= MIN_STATIC_HTML_BYTES and any(m in html for m in STATIC_CONTENT_MARKERS)
+
+
+def static_html(resp):
+    """GET の応答 (requests) が、そのまま保存してよい HTML なら本文を、ブラウザで描画が必要なら None を返す"""
+    if "text/html" not in resp.headers.get("Content-Type", ""):
+        return None
+    resp.encoding = resp.encoding or "utf-8"
+    html = resp.text
+    return html if looks_static(html) else None
+
+
+def response_validators(headers):
+    """
+    レスポンスヘッダーから (ETag, Last-Modified) を取り出す。
+    requests の headers でも、Playwright の response.headers (キーが小文字の dict) でもよい。
+    """
+    if headers is None:
+        return None, None
+    lower = {k.lower(): v for k, v in headers.items()}
+    return lower.get("etag"), lower.get("last-modified")
+
+
+class CrawlState:
+    def __init__(self, db_path=DEFAULT_DB_PATH):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                sha1 TEXT,
+                last_run INTEGER,
+                fetched_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS frontier (
+                start_url TEXT,
+                url TEXT,
+                PRIMARY KEY (start_url, url)
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                start_url TEXT PRIMARY KEY,
+                run_id INTEGER,
+                finished INTEGER
+            );
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    # --- クロール単位 ---
+    def begin_run(self, start_url):
+        """
+        クロールを開始する。前回が途中で止まっていればその続きから再開する。
+
+        Returns:
+            tuple: (run_id, resumed)
+        """
+        row = self.conn.execute(
+            "SELECT run_id, finished FROM runs WHERE start_url = ?", (start_url,)
+        ).fetchone()
+
+        if row is not None and not row[1]:
+            return row[0], True
+
+        run_id = (row[0] + 1) if row is not None else 1
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO runs (start_url, run_id, finished) VALUES (?, ?, 0)",
+                (start_url, run_id),
+            )
+            self.conn.execute("DELETE FROM frontier WHERE start_url = ?", (start_url,))
+            self.conn.execute(
+                "INSERT INTO frontier (start_url, url) VALUES (?, ?)", (start_url, start_url)
+            )
+        return run_id, False
+
+    def finish_run(self, start_url):
+        with self.conn:
+            self.conn.execute("UPDATE runs SET finished = 1 WHERE start_url = ?", (start_url,))
+            self.conn.execute("DELETE FROM frontier WHERE start_url = ?", (start_url,))
+
+    # --- フロンティア ---
+    def pending(self, start_url):
+        """未訪問の URL 一覧"""
+        rows = self.conn.execute(
+            "SELECT url FROM frontier WHERE start_url = ? ORDER BY url", (start_url,)
+        )
+        return [r[0] for r in rows]
+
+    def visited(self, run_id):
+        """今回のクロールで訪問済みの URL 集合"""
+        rows = self.conn.execute("SELECT url FROM pages WHERE last_run = ?", (run_id,))
+        return {r[0] for r in rows}
+
+    def add_urls(self, start_url, urls):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO frontier (start_url, url) VALUES (?, ?)",
+                [(start_url, u) for u in urls],
+            )
+
+    def mark_visited(self, start_url, url, run_id, etag=None, last_modified=None, sha1=None):
+        """
+        訪問済みにしてフロンティアから外す。
+        etag などが None の場合 (エラー時など) は前回の値を残す。
+        """
+        with self.conn:
+            self.conn.execute(
+                """
+                INSERT INTO pages (url, etag, last_modified, sha1, last_run, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    etag = COALESCE(excluded.etag, etag),
+                    last_modified = COALESCE(excluded.last_modified, last_modified),
+                    sha1 = COALESCE(excluded.sha1, sha1),
+                    last_run = excluded.last_run,
+                    fetched_at = excluded.fetched_at
+                """,
+                (url, etag, last_modified, sha1, run_id, time.time()),
+            )
+            self.conn.execute(
+                "DELETE FROM frontier WHERE start_url = ? AND url = ?", (start_url, url)
+            )
+
+    # --- 条件付きリクエスト ---
+    def page_info(self, url):
+        row = self.conn.execute(
+            "SELECT etag, last_modified, sha1 FROM pages WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {"etag": row[0], "last_modified": row[1], "sha1": row[2]}
+
+    def conditional_headers(self, url, file_path):
+        """
+        前回の ETag / Last-Modified から条件付きリクエストのヘッダーを作る。
+        ローカルにファイルが無い場合は 304 を受け取っても再利用できないので付けない。
+        """
+        headers = {}
+        if not os.path.exists(file_path):
+            return headers
+        info = self.page_info(url)
+        if info is not None:
+            if info["etag"]:
+                headers["If-None-Match"] = info["etag"]
+            if info["last_modified"]:
+                headers["If-Modified-Since"] = info["last_modified"]
+        return headers
+
+    def is_unchanged(self, url, sha1):
+        info = self.page_info(url)
+        return info is not None and info["sha1"] == sha1
+
+
+def conditional_get(session, url, headers, timeout=30):
+    """
+    CrawlState.conditional_headers() で作ったヘッダーを付けて GET する。
+    SQLite には触らないので、スレッドプールから呼んでもよい。
+
+    Returns:
+        tuple: (status, response)
+            status は "not_modified" (304), "ok", "error"
+    """
+    resp = session.get(url, headers=headers, timeout=timeout)
+    if resp.status_code == 304:
+        return "not_modified", resp
+    if resp.status_code != 200:
+        return "error", resp
+    return "ok", resp
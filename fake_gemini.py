@@ -0,0 +1,369 @@
+# fake_gemini.py
+"""
+Gemini API (google-genai の genai.Client) の代わりに使う、決定的なローカルスタブ。
+
+ベンチマーク (benchmark.py の answer 段階) と、環境変数 GEMINI_FAKE=1 で
+gemini_client.default_client() を差し替えたときに、API キーもネットワークも使わずに
+パイプライン全体を動かすためのもの。client.models / client.aio.models の
+generate_content / generate_content_stream / embed_content / count_tokens と、
+client.files / client.aio.files の upload / get / delete、
+client.caches / client.aio.caches の create / update / delete、
+client.batches / client.aio.batches の create / get だけを真似る (バッチは作成した時点で完了している)。
+gemini_client.GeminiClient の transport に渡すと、再試行や流量制御ごと試せる。
+
+  - latency      : 1 回の呼び出しにかかる秒数 (+ jitter 秒までの揺らぎ)
+  - error_rate   : この割合の呼び出しが 429 RESOURCE_EXHAUSTED で失敗する
+                   (メッセージに "Please retry in ...s" のヒントを含む)
+  - 揺らぎとエラーは seed と「プロンプトの内容 + 同じプロンプトの何回目の呼び出しか」
+    で決まるので、並行に呼んでも実行ごとに同じ結果になる
+
+呼び出し回数・入力トークン数 (概算)・エラー数は stats に集計される。
+"""
+import asyncio
+import datetime
+import hashlib
+import mimetypes
+import os
+import random
+import threading
+import time
+from types import SimpleNamespace
+
+from gemini_client import CHARS_PER_TOKEN, contents_text, estimate_tokens
+
+FILE_TTL = 48 * 3600   # アップロードしたファイルが消えるまでの秒数 (本物と同じ 48 時間)
+MEDIA_TOKENS = 258     # テキスト以外のファイル 1 つを count_tokens で数えたときのトークン数
+
+
+class FakeApiError(Exception):
+    """google.genai の APIError を真似た例外 (code / status 属性を持ち、文字列は "429 RESOURCE_EXHAUSTED. ...")"""
+
+    def __init__(self, code: int, status: str, message: str):
+        super().__init__(f"{code} {status}. {message}")
+        self.code = code
+        self.status = status
+
+
+class FakeGemini:
+    def __init__(self, latency: float = 0.2, jitter: float = 0.0, error_rate: float = 0.0,
+                 retry_hint: float = 0.05, stream_chunks: int = 8, seed: int = 0, dim: int = 768):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_hint = retry_hint
+        self.stream_chunks = stream_chunks
+        self.seed = seed
+        self.dim = dim
+        self.lock = threading.Lock()
+        self.attempts = {}   # プロンプトのハッシュ → 呼び出し回数
+        self.stats = {"calls": 0, "errors": 0, "prompt_tokens": 0, "output_tokens": 0, "uploads": 0}
+        self.files_by_name = {}   # ファイル名 → アップロードしたファイル
+        self.caches_by_name = {}  # キャッシュ名 → 作成時の config
+        self.batches_by_name = {}  # ジョブ名 → バッチジョブ
+
+        self.models = _Models(self)
+        self.files = _Files(self)
+        self.caches = _Caches(self)
+        self.batches = _Batches(self)
+        self.aio = SimpleNamespace(models=_AsyncModels(self), files=_AsyncFiles(self), caches=_AsyncCaches(self),
+                                   batches=_AsyncBatches(self), aclose=self._aclose)
+
+    def close(self):
+        pass
+
+    async def _aclose(self):
+        pass
+
+    # --- 共通の処理 ---
+    def _plan(self, text):
+        """この呼び出しの (待ち時間, 失敗するか) を決める"""
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        with self.lock:
+            attempt = self.attempts.get(key, 0)
+            self.attempts[key] = attempt + 1
+            self.stats["calls"] += 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+        delay = self.latency + rng.random() * self.jitter
+        fail = rng.random() < self.error_rate
+        return delay, fail
+
+    def _result(self, text, fail):
+        if fail:
+            with self.lock:
+                self.stats["errors"] += 1
+            raise FakeApiError(429, "RESOURCE_EXHAUSTED",
+                               f"Quota exceeded (fake). Please retry in {self.retry_hint}s.")
+        prompt_tokens = estimate_tokens(text)
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+        answer = f"（フェイク回答 {digest}）プロンプト {len(text)} 文字を受け取りました。"
+        with self.lock:
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["output_tokens"] += estimate_tokens(answer)
+        return answer, prompt_tokens
+
+    def _pieces(self, answer):
+        step = max(1, -(-len(answer) // self.stream_chunks))
+        return [answer[i:i + step] for i in range(0, len(answer), step)]
+
+    def _embedding(self, text):
+        rng = random.Random(f"{self.seed}:embed:{text}")
+        return [rng.gauss(0.0, 1.0) for _ in range(self.dim)]
+
+    def _upload(self, file, config):
+        config = dict(config or {})
+        path = os.fspath(file)
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        name = config.get("name") or f"files/{digest[:16]}"
+        if not name.startswith("files/"):
+            name = "files/" + name
+        uploaded = SimpleNamespace(
+            name=name,
+            uri=f"https://fake-gemini.invalid/v1beta/{name}",
+            mime_type=config.get("mime_type") or mimetypes.guess_type(path)[0] or "application/octet-stream",
+            display_name=config.get("display_name") or os.path.basename(path),
+            size_bytes=os.path.getsize(path),
+            sha256_hash=digest,
+            expiration_time=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=FILE_TTL),
+        )
+        with self.lock:
+            self.files_by_name[name] = uploaded
+            self.stats["uploads"] += 1
+        return uploaded
+
+    def _get_file(self, name):
+        with self.lock:
+            uploaded = self.files_by_name.get(name)
+        if uploaded is None:
+            raise FakeApiError(404, "NOT_FOUND", f"File {name} not found (fake).")
+        return uploaded
+
+    def _delete_file(self, name):
+        self._get_file(name)
+        with self.lock:
+            self.files_by_name.pop(name, None)
+
+    def _count_tokens(self, contents):
+        """文字列部分は概算、ファイル参照はアップロード済みファイルの大きさと種類から数える"""
+        total = estimate_tokens(contents_text(contents))
+        with self.lock:
+            by_uri = {f.uri: f for f in self.files_by_name.values()}
+        for part in contents if isinstance(contents, (list, tuple)) else [contents]:
+            file_data = getattr(part, "file_data", None)
+            uploaded = by_uri.get(getattr(file_data, "file_uri", None))
+            if uploaded is not None:
+                text = uploaded.mime_type.startswith("text/")
+                total += uploaded.size_bytes // CHARS_PER_TOKEN + 1 if text else MEDIA_TOKENS
+        return SimpleNamespace(total_tokens=total)
+
+    def _embed(self, contents):
+        texts = [contents] if isinstance(contents, str) else list(contents)
+        delay, fail = self._plan("\n".join(texts))
+        return texts, delay, fail
+
+    def _embed_result(self, texts, fail):
+        self._result("\n".join(texts), fail)
+        return SimpleNamespace(embeddings=[SimpleNamespace(values=self._embedding(t)) for t in texts])
+
+    def _create_batch(self, model, src):
+        """インラインのリクエストを順に答え、完了済みのジョブを返す (429 の失敗はリクエストごとの error になる)"""
+        responses = []
+        for request in src:
+            text = "\n".join(part["text"] for content in request["contents"]
+                             for part in content["parts"] if "text" in part)
+            try:
+                answer, prompt_tokens = self._result(text, self._plan(text)[1])
+                responses.append(SimpleNamespace(response=_response(answer, prompt_tokens), error=None))
+            except FakeApiError as e:
+                responses.append(SimpleNamespace(response=None, error=str(e)))
+        with self.lock:
+            name = f"batches/fake-{len(self.batches_by_name) + 1}"
+            job = SimpleNamespace(name=name, model=model, state=SimpleNamespace(name="JOB_STATE_SUCCEEDED"),
+                                  error=None, dest=SimpleNamespace(inlined_responses=responses))
+            self.batches_by_name[name] = job
+        return job
+
+    def _get_batch(self, name):
+        with self.lock:
+            job = self.batches_by_name.get(name)
+        if job is None:
+            raise FakeApiError(404, "NOT_FOUND", f"Batch {name} not found (fake).")
+        return job
+
+    def _create_cache(self, model, config):
+        with self.lock:
+            name = f"cachedContents/fake-{len(self.caches_by_name) + 1}"
+            self.caches_by_name[name] = config
+        return SimpleNamespace(name=name, model=model)
+
+    def _update_cache(self, name, config):
+        with self.lock:
+            if name not in self.caches_by_name:
+                raise FakeApiError(404, "NOT_FOUND", f"CachedContent {name} not found (fake).")
+        return SimpleNamespace(name=name)
+
+    def _delete_cache(self, name):
+        self._update_cache(name, None)
+        with self.lock:
+            self.caches_by_name.pop(name, None)
+
+
+def _response(text, prompt_tokens=0):
+    return SimpleNamespace(
+        text=text,
+        usage_metadata=SimpleNamespace(prompt_token_count=prompt_tokens,
+                                       candidates_token_count=estimate_tokens(text)),
+    )
+
+
+class _Models:
+    """client.models (同期 API) の代わり"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    def generate_content(self, model, contents, config=None):
+        text = contents_text(contents)
+        delay, fail = self.fake._plan(text)
+        time.sleep(delay)
+        answer, prompt_tokens = self.fake._result(text, fail)
+        return _response(answer, prompt_tokens)
+
+    def generate_content_stream(self, model, contents, config=None):
+        text = contents_text(contents)
+        delay, fail = self.fake._plan(text)
+        time.sleep(delay)
+        answer, prompt_tokens = self.fake._result(text, fail)
+        for piece in self.fake._pieces(answer):
+            yield _response(piece, prompt_tokens)
+
+    def count_tokens(self, model, contents, config=None):
+        return self.fake._count_tokens(contents)
+
+    def embed_content(self, model, contents, config=None):
+        texts, delay, fail = self.fake._embed(contents)
+        time.sleep(delay)
+        return self.fake._embed_result(texts, fail)
+
+
+class _AsyncModels:
+    """client.aio.models (非同期 API) の代わり"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    async def generate_content(self, model, contents, config=None):
+        text = contents_text(contents)
+        delay, fail = self.fake._plan(text)
+        await asyncio.sleep(delay)
+        answer, prompt_tokens = self.fake._result(text, fail)
+        return _response(answer, prompt_tokens)
+
+    async def generate_content_stream(self, model, contents, config=None):
+        text = contents_text(contents)
+        delay, fail = self.fake._plan(text)
+        await asyncio.sleep(delay)
+        answer, prompt_tokens = self.fake._result(text, fail)
+
+        async def pieces():
+            for piece in self.fake._pieces(answer):
+                yield _response(piece, prompt_tokens)
+        return pieces()
+
+    async def count_tokens(self, model, contents, config=None):
+        return self.fake._count_tokens(contents)
+
+    async def embed_content(self, model, contents, config=None):
+        texts, delay, fail = self.fake._embed(contents)
+        await asyncio.sleep(delay)
+        return self.fake._embed_result(texts, fail)
+
+
+class _Files:
+    """client.files の代わり (アップロードしたファイルはメモリ上に覚えるだけ)"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    def upload(self, file, config=None):
+        return self.fake._upload(file, config)
+
+    def get(self, name, config=None):
+        return self.fake._get_file(name)
+
+    def delete(self, name, config=None):
+        self.fake._delete_file(name)
+
+
+class _AsyncFiles:
+    """client.aio.files の代わり"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    async def upload(self, file, config=None):
+        return self.fake._upload(file, config)
+
+    async def get(self, name, config=None):
+        return self.fake._get_file(name)
+
+    async def delete(self, name, config=None):
+        self.fake._delete_file(name)
+
+
+class _Caches:
+    """client.caches の代わり (作成したキャッシュは名前だけ覚える)"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    def create(self, model, config=None):
+        return self.fake._create_cache(model, config)
+
+    def update(self, name, config=None):
+        return self.fake._update_cache(name, config)
+
+    def delete(self, name, config=None):
+        self.fake._delete_cache(name)
+
+
+class _AsyncCaches:
+    """client.aio.caches の代わり"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    async def create(self, model, config=None):
+        return self.fake._create_cache(model, config)
+
+    async def update(self, name, config=None):
+        return self.fake._update_cache(name, config)
+
+    async def delete(self, name, config=None):
+        self.fake._delete_cache(name)
+
+
+class _Batches:
+    """client.batches の代わり"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    def create(self, model, src, config=None):
+        return self.fake._create_batch(model, src)
+
+    def get(self, name, config=None):
+        return self.fake._get_batch(name)
+
+
+class _AsyncBatches:
+    """client.aio.batches の代わり"""
+
+    def __init__(self, fake: FakeGemini):
+        self.fake = fake
+
+    async def create(self, model, src, config=None):
+        return self.fake._create_batch(model, src)
+
+    async def get(self, name, config=None):
+        return self.fake._get_batch(name)
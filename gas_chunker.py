@@ -0,0 +1,225 @@
+# gas_chunker.py
+"""
+Apps Script リファレンスの HTML (gas_docs_html) を、ページの構造に沿って分割するモジュール。
+
+固定長の窓で TXT を切ると、巨大なメソッド一覧の途中でシグネチャと説明が
+別々のチャンクに分かれてしまう。ここでは HTML の構造を使い、
+
+  - method  : 詳細説明 (div.function.doc) 1 つ = 1 チャンク
+  - summary : メンバー一覧の表 (table.members) を CHUNK_CHARS 前後ごとに
+  - overview: それ以外の本文 (クラスの説明・サービスの概要など)
+
+に分ける。各チャンクには service / class / method / return_type / url などの
+メタデータを付ける (rag_index.BM25Index のチャンクにそのまま保存される)。
+
+使い方:
+    python gas_chunker.py gas_docs_html/apps-script/reference/spreadsheet/range.html
+"""
+import glob
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlparse
+
+from bs4 import BeautifulSoup
+
+from local_html2text import element_text, main_content, page_title, pick_parser
+from rag_index import CHUNK_CHARS, CHUNK_OVERLAP, chunk_text
+
+GAS_HTML_DIR = "gas_docs_html"
+# メソッドの説明がこれより長い場合 (長いサンプルコードなど) は見出しを付けて分割する
+MAX_METHOD_CHARS = CHUNK_CHARS * 3
+# ページの種類 (<title> の先頭の単語)
+PAGE_KINDS = ("Class", "Enum", "Interface")
+# 中身を別のチャンクに移した後、本文に見出しだけが残るもの
+SECTION_HEADINGS = {"Properties", "Deprecated properties", "Methods", "Deprecated methods",
+                    "Detailed documentation"}
+
+
+def page_info(soup, html_file):
+    """ページ全体のメタデータ (URL, サービス名, クラス名, 種類)"""
+    link = soup.find("link", rel="canonical")
+    url = link["href"] if link is not None and link.get("href") else ""
+
+    # https://developers.google.com/apps-script/reference/spreadsheet/range → spreadsheet
+    parts = [p for p in urlparse(url).path.split("/") if p]
+    if "reference" in parts and parts.index("reference") + 1 < len(parts):
+        service = parts[parts.index("reference") + 1]
+    else:
+        service = ""
+
+    title = page_title(soup)
+    kind, _, name = title.partition(" ")
+    if kind in PAGE_KINDS:
+        kind = kind.lower()
+    else:
+        kind, name = "page", title
+
+    return {
+        "source": html_file.replace(os.sep, "/"),
+        "url": url,
+        "service": service,
+        "class": name if kind != "page" else "",
+        "kind": kind,
+        "title": title,
+    }
+
+
+def _heading_path(info, *parts):
+    """チャンク先頭に付ける見出し ("spreadsheet > Class Range > getValues()")"""
+    return " > ".join(p for p in (info["service"], info["title"], *parts) if p)
+
+
+def _return_type(doc):
+    """メソッドの詳細説明の "Return" 欄から戻り値の型を取り出す"""
+    for h4 in doc.find_all("h4"):
+        if h4.get_text(strip=True) == "Return":
+            value = h4.find_next_sibling()
+            if value is not None:
+                code = value.find("code")
+                text = (code or value).get_text("", strip=True)
+                return text.split("—")[0].strip() or None
+    return None
+
+
+def _chunk(info, kind, heading, lines, **meta):
+    """見出しと本文の行から 1 つ以上のチャンクを作る (長すぎる場合は分割して見出しを付け直す)"""
+    text = "\n".join(lines)
+    limit = MAX_METHOD_CHARS if kind == "method" else CHUNK_CHARS
+    pieces = [text] if len(text) <= limit else chunk_text(text, CHUNK_CHARS, CHUNK_OVERLAP)
+    chunks = []
+    for piece in pieces:
+        chunk = dict(info, kind=kind, text=f"{heading}\n{piece}")
+        chunk.update(meta)
+        chunks.append(chunk)
+    return chunks
+
+
+def _members_table_chunks(info, table):
+    """メンバー一覧の表を、表の見出し行を繰り返しながら CHUNK_CHARS 前後ごとに分ける"""
+    # サービスの概要ページでは表の直前の h2 がクラス名、h3 が "Methods" などの区分
+    h2 = table.find_previous("h2")
+    h3 = table.find_previous("h3")
+    if h3 is not None and h2 is not None and h3.find_previous("h2") is not h2:
+        h3 = None   # 前のクラスの区分
+    heading = _heading_path(info, *(tag.get_text("", strip=True) for tag in (h2, h3) if tag is not None))
+
+    lines = element_text(table)
+    if not lines:
+        return []
+    header, rows = lines[0], lines[1:]
+
+    chunks = []
+    current, size = [], 0
+    for row in rows:
+        if current and size + len(row) > CHUNK_CHARS:
+            chunks.append(dict(info, kind="summary", text="\n".join([heading, header] + current)))
+            current, size = [], 0
+        current.append(row)
+        size += len(row) + 1
+    if current:
+        chunks.append(dict(info, kind="summary", text="\n".join([heading, header] + current)))
+    return chunks
+
+
+def chunk_page(html, html_file, parser=None):
+    """
+    1 ページ分の HTML をチャンクに分ける。
+
+    Returns:
+        list[dict]: {"source", "text", "url", "service", "class", "kind", "title",
+                     "method", "return_type"} のリスト (method / return_type はメソッドのみ)
+    """
+    soup = BeautifulSoup(html, parser or pick_parser())
+    info = page_info(soup, html_file)
+    root = main_content(soup)
+
+    # AI が生成した要約は本文と重複するので使わない
+    for panel in root.find_all("devsite-key-takeaways-panel"):
+        panel.decompose()
+
+    chunks = []
+
+    # --- メソッドの詳細説明 ---
+    for doc in root.select("div.function.doc"):
+        method = doc.get("id") or ""
+        return_type = _return_type(doc)
+        heading = _heading_path(info, method)
+        if return_type:
+            heading += f"\nReturn type: {return_type}"
+        lines = element_text(doc)
+        doc.decompose()
+        chunks.extend(_chunk(info, "method", heading, lines, method=method, return_type=return_type))
+
+    # --- メンバー一覧の表 ---
+    for table in root.select("table.members"):
+        chunks.extend(_members_table_chunks(info, table))
+        table.decompose()
+
+    # --- 残りの本文 (クラスの説明・サービスの概要など) ---
+    # 説明が空になった "Methods" などの見出しだけが残るので捨てる
+    lines = [line for line in element_text(root) if line.strip() not in SECTION_HEADINGS]
+    if lines:
+        overview = _chunk(info, "overview", _heading_path(info), lines)
+        chunks = overview + chunks
+
+    return chunks
+
+
+def chunk_file(html_file, parser=None):
+    with open(html_file, "r", encoding="utf-8") as f:
+        return chunk_page(f.read(), html_file, parser)
+
+
+def _chunk_file_safe(html_file):
+    """chunk_file() のワーカー用。失敗したファイルは (None, エラー) を返す"""
+    try:
+        return chunk_file(html_file), None
+    except (OSError, UnicodeDecodeError) as e:
+        return None, str(e)
+
+
+def chunk_files(html_files, workers=None):
+    """
+    複数ページをまとめて分割する (HTML の解析が重いのでプロセスを分けて並行に行う)。
+    同じページが別のパスにも保存されている場合 (range.html と range/index.html など) は、
+    canonical URL が同じなので最初のファイルだけを使う。
+
+    Returns:
+        list: (html_file, chunks) のリスト (入力順)。読めないファイルは chunks が None。
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(html_files) <= 1:
+        results = map(_chunk_file_safe, html_files)
+        return _dedupe(html_files, results)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return _dedupe(html_files, executor.map(_chunk_file_safe, html_files, chunksize=4))
+
+
+def _dedupe(html_files, results):
+    seen_urls = set()
+    pages = []
+    for html_file, (chunks, error) in zip(html_files, results):
+        if error is not None:
+            print(f"⚠ 読み込みをスキップ ({html_file}): {error}")
+            pages.append((html_file, None))
+            continue
+        url = chunks[0]["url"] if chunks else ""
+        if url and url in seen_urls:
+            pages.append((html_file, []))
+            continue
+        seen_urls.add(url)
+        pages.append((html_file, chunks))
+    return pages
+
+
+def list_html_files(html_dir=GAS_HTML_DIR):
+    files = glob.glob(os.path.join(html_dir, "**", "*.html"), recursive=True)
+    return sorted(path.replace(os.sep, "/") for path in files)
+
+
+if __name__ == "__main__":
+    for path in sys.argv[1:]:
+        for c in chunk_file(path):
+            print(f"\n--- [{c['kind']}] {c.get('method') or c['title']} ({len(c['text'])} 文字)")
+            print(c["text"][:400])
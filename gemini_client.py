@@ -0,0 +1,499 @@
+# gemini_client.py
+"""
+Gemini API を呼ぶ共通クライアント。query_rag.py / rag_server.py / gemini_uploader.py /
+upload_and_ask.py / vector_store.py / context_cache.py はすべてこれを通して API を呼ぶ。
+
+  - 接続の再利用 : google-genai の genai.Client をプロセスで 1 つだけ作り (default_client())、
+                   非同期の呼び出しはすべてクライアント専用のイベントループ (バックグラウンドの
+                   スレッド) で行う。同期のスクリプトからも、別のイベントループからも同じ接続プールを使う
+  - 流量制御     : RPM / TPM の予算 (rate_limit.RateLimiter) をすべての呼び出し元で共有する
+  - 再試行       : 429 / 503 や接続エラーなどの一時的なエラーは指数バックオフで再試行する
+                   (サーバーの "retry in ...s" のヒントがあればそれに従う)
+  - ヘッジ       : generate で応答が直近のレイテンシの p95 を超えても返らないとき、
+                   同じリクエストをもう 1 つ送り、先に返った方を使う (もう一方は取り消す)。
+                   流量の予算に余裕が無いときはヘッジしない
+  - 差し替え     : transport に fake_gemini.FakeGemini を渡すと API を呼ばずに動く
+                   (環境変数 GEMINI_FAKE=1 で default_client() もフェイクになる)
+
+同期版 (generate / stream / embed / count_tokens / upload / create_batch / create_cache ...) と
+非同期版 (agenerate / astream / aembed / acount_tokens / aupload / acreate_batch / acreate_cache ...) があり、どちらも同じ再試行・流量制御を通る。
+
+使い方:
+    client = gemini_client.default_client()
+    response = client.generate("質問", model="gemini-2.0-flash")
+    async for chunk in client.astream(prompt, model=MODEL): ...
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+
+import telemetry
+from rate_limit import RateLimiter, is_quota_error, is_retryable, retry_delay
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+MAX_RETRIES = 6
+
+# --- ヘッジ ---
+HEDGE_QUANTILE = 0.95    # 直近のレイテンシのこの分位点を超えたら 2 本目を送る
+HEDGE_MIN_SAMPLES = 20   # これより記録が少ないうちはヘッジしない (分布がわからない)
+HEDGE_MIN_DELAY = 1.0    # ヘッジまで最低でもこの秒数は待つ
+LATENCY_WINDOW = 200     # 分位点の計算に使う直近の呼び出し数
+
+# 接続まわりの一時的なエラー (httpx / aiohttp の例外名)
+TRANSIENT_EXCEPTION_NAMES = {
+    "ConnectError", "ConnectTimeout", "ReadTimeout", "WriteTimeout", "PoolTimeout",
+    "ReadError", "WriteError", "RemoteProtocolError", "ServerDisconnectedError",
+    "ClientConnectionError", "ClientOSError",
+}
+
+
+# トークン数の概算に使う 1 トークンあたりの文字数
+CHARS_PER_TOKEN = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の概算 (プロジェクト内の概算はすべてこれを使う)。
+    厳密なカウントは API 呼び出しになるので、文字数からの概算で十分
+    """
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def contents_text(contents) -> str:
+    """contents (文字列 / 文字列のリスト / ファイル参照など) のうち文字列の部分をつなげる"""
+    if isinstance(contents, str):
+        return contents
+    if isinstance(contents, (list, tuple)):
+        return "\n".join(contents_text(c) for c in contents)
+    return ""
+
+
+def is_transient(error) -> bool:
+    """再試行すれば通る見込みのあるエラーか"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    return type(error).__name__ in TRANSIENT_EXCEPTION_NAMES or is_retryable(error)
+
+
+def file_part(uploaded):
+    """アップロード済みファイル (uri と mime_type を持つもの) を contents に入れる形にする"""
+    from google.genai import types
+
+    return types.Part.from_uri(file_uri=uploaded.uri, mime_type=uploaded.mime_type)
+
+
+def _copy_outcome(future, task):
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+class GeminiClient:
+    """
+    genai.Client (または同じ形のフェイク) を包み、再試行・流量制御・ヘッジを加えたもの。
+
+    hedge は True (直近のレイテンシから自動で決める)、False (ヘッジしない)、
+    秒数 (その秒数で 2 本目を送る) のどれか。
+    """
+
+    def __init__(self, transport=None, api_key: str = None, rpm: int = None, tpm: int = None,
+                 max_retries: int = MAX_RETRIES, hedge=True):
+        if transport is None:
+            from google import genai
+            transport = genai.Client(api_key=api_key)
+        self.transport = transport
+        self.limiter = None
+        self.set_limits(rpm, tpm)
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.stats = {"requests": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "errors": 0}
+        self._loop = None
+        self._thread = None
+        self._loop_lock = threading.Lock()
+
+    def set_limits(self, rpm: int = None, tpm: int = None) -> None:
+        """RPM / TPM の予算を設定する (どちらも None なら制限しない)"""
+        self.limiter = RateLimiter(rpm or float("inf"), tpm) if rpm or tpm else None
+
+    # ---------------------------
+    # クライアント専用のイベントループ
+    # ---------------------------
+    def _background_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run_loop, args=(self._loop,), daemon=True,
+                                                name="gemini-client")
+                self._thread.start()
+            return self._loop
+
+    @staticmethod
+    def _run_loop(loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+        loop.close()
+
+    def _submit(self, coro) -> concurrent.futures.Future:
+        """coro を専用のループで実行する。呼び出し元のコンテキスト (計測の親スパン) を引き継ぐ"""
+        loop = self._background_loop()
+        context = contextvars.copy_context()
+        future = concurrent.futures.Future()
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                coro.close()
+                return
+            task = loop.create_task(coro, context=context)
+            task.add_done_callback(lambda t: _copy_outcome(future, t))
+
+        loop.call_soon_threadsafe(start)
+        return future
+
+    def _run(self, coro):
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("GeminiClient の同期メソッドは非同期のコードからは呼べません (a で始まる方を使ってください)")
+        return self._submit(coro).result()
+
+    async def _await(self, coro):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is not None and running is self._loop:
+            return await coro
+        return await asyncio.wrap_future(self._submit(coro))
+
+    # ---------------------------
+    # 再試行・流量制御・ヘッジ
+    # ---------------------------
+    async def _acquire(self, tokens):
+        if self.limiter is not None and tokens is not None:
+            await self.limiter.acquire_async(tokens)
+
+    async def _backoff(self, op, error, attempt, span):
+        """一時的なエラーなら待ってから戻り、そうでなければ error を送出する"""
+        if attempt >= self.max_retries or not is_transient(error):
+            self.stats["errors"] += 1
+            telemetry.count("gemini_requests", op=op, result="error")
+            raise error
+        delay = retry_delay(error, attempt)
+        print(f"⏳ 一時的なエラー ({type(error).__name__})。{delay:.1f} 秒後に再試行します", flush=True)
+        if self.limiter is not None and is_quota_error(error):
+            # 429 は全呼び出し元の送信をまとめて止める
+            self.limiter.pause(delay)
+        self.stats["retries"] += 1
+        telemetry.count("gemini_retries", op=op)
+        span.add("backoff_seconds", delay)
+        await asyncio.sleep(delay)
+
+    async def _timed(self, make_call):
+        started = time.perf_counter()
+        result = await make_call()
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def hedge_delay(self):
+        """2 本目を送るまでの秒数 (ヘッジしないなら None)"""
+        if self.hedge is False or self.hedge is None:
+            return None
+        if self.hedge is not True:
+            return float(self.hedge)
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return max(HEDGE_MIN_DELAY, ordered[min(len(ordered) - 1, int(len(ordered) * HEDGE_QUANTILE))])
+
+    async def _hedged(self, make_call, tokens, span):
+        delay = self.hedge_delay()
+        first = asyncio.ensure_future(self._timed(make_call))
+        if delay is None:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or (self.limiter is not None and tokens is not None and not self.limiter.try_acquire(tokens)):
+            return await first
+
+        self.stats["hedges"] += 1
+        span.set(hedged=True)
+        second = asyncio.ensure_future(self._timed(make_call))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        won = task is second
+                        self.stats["hedge_wins"] += won
+                        telemetry.count("gemini_hedges", won=str(won).lower())
+                        span.set(hedge_won=won)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _call(self, op, make_call, tokens=None, hedge=False, **attrs):
+        with telemetry.span(f"gemini.{op}", **attrs) as span:
+            self.stats["requests"] += 1
+            for attempt in range(self.max_retries + 1):
+                span.set(attempts=attempt + 1)
+                await self._acquire(tokens)
+                try:
+                    if hedge:
+                        result = await self._hedged(make_call, tokens, span)
+                    else:
+                        result = await make_call()
+                except Exception as e:
+                    await self._backoff(op, e, attempt, span)
+                    continue
+                telemetry.count("gemini_requests", op=op, result="ok")
+                return result
+
+    # ---------------------------
+    # 専用のループで実行される本体
+    # ---------------------------
+    async def _generate(self, contents, model, config, tokens):
+        if tokens is None:
+            tokens = estimate_tokens(contents_text(contents))
+        return await self._call(
+            "generate",
+            lambda: self.transport.aio.models.generate_content(model=model, contents=contents, config=config),
+            model=model, tokens=tokens, hedge=True,
+        )
+
+    async def _stream(self, contents, model, config, tokens):
+        """ストリーミング。再試行するのは最初の断片が届くまで (ヘッジはしない)"""
+        if tokens is None:
+            tokens = estimate_tokens(contents_text(contents))
+        with telemetry.span("gemini.stream", model=model) as span:
+            self.stats["requests"] += 1
+            for attempt in range(self.max_retries + 1):
+                span.set(attempts=attempt + 1)
+                await self._acquire(tokens)
+                try:
+                    stream = await self.transport.aio.models.generate_content_stream(
+                        model=model, contents=contents, config=config
+                    )
+                    first = await anext(stream)
+                except StopAsyncIteration:
+                    return
+                except Exception as e:
+                    await self._backoff("stream", e, attempt, span)
+                    continue
+                break
+
+            telemetry.count("gemini_requests", op="stream", result="ok")
+            yield first
+            async for chunk in stream:
+                yield chunk
+
+    async def _embed(self, contents, model, config, tokens):
+        if tokens is None:
+            tokens = estimate_tokens(contents_text(contents))
+        return await self._call(
+            "embed",
+            lambda: self.transport.aio.models.embed_content(model=model, contents=contents, config=config),
+            model=model, tokens=tokens,
+        )
+
+    async def _count_tokens(self, contents, model):
+        return await self._call(
+            "count_tokens",
+            lambda: self.transport.aio.models.count_tokens(model=model, contents=contents),
+            model=model,
+        )
+
+    async def _upload(self, path, mime_type, name, display_name):
+        config = {k: v for k, v in (("name", name), ("mime_type", mime_type), ("display_name", display_name))
+                  if v is not None}
+        return await self._call("upload", lambda: self.transport.aio.files.upload(file=path, config=config),
+                                bytes=os.path.getsize(path))
+
+    async def _get_file(self, name):
+        return await self._call("get_file", lambda: self.transport.aio.files.get(name=name))
+
+    async def _delete_file(self, name):
+        return await self._call("delete_file", lambda: self.transport.aio.files.delete(name=name))
+
+    async def _create_batch(self, model, src, config):
+        return await self._call(
+            "create_batch", lambda: self.transport.aio.batches.create(model=model, src=src, config=config),
+            model=model, requests=len(src),
+        )
+
+    async def _get_batch(self, name):
+        return await self._call("get_batch", lambda: self.transport.aio.batches.get(name=name))
+
+    async def _create_cache(self, model, config, tokens):
+        return await self._call(
+            "create_cache", lambda: self.transport.aio.caches.create(model=model, config=config),
+            model=model, tokens=tokens,
+        )
+
+    async def _update_cache(self, name, config):
+        return await self._call("update_cache", lambda: self.transport.aio.caches.update(name=name, config=config))
+
+    async def _delete_cache(self, name):
+        return await self._call("delete_cache", lambda: self.transport.aio.caches.delete(name=name))
+
+    # ---------------------------
+    # 非同期 API
+    # ---------------------------
+    async def agenerate(self, contents, model: str = DEFAULT_MODEL, config=None, tokens: int = None):
+        """generate_content。tokens は TPM の計算に使う入力トークン数 (省略時は文字数から概算)"""
+        return await self._await(self._generate(contents, model, config, tokens))
+
+    async def astream(self, contents, model: str = DEFAULT_MODEL, config=None, tokens: int = None):
+        """generate_content_stream。応答の断片を順に返す"""
+        stream = self._stream(contents, model, config, tokens)
+        try:
+            while True:
+                try:
+                    chunk = await self._await(anext(stream))
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            await self._await(stream.aclose())
+
+    async def aembed(self, contents, model: str = "text-embedding-004", config=None, tokens: int = None):
+        return await self._await(self._embed(contents, model, config, tokens))
+
+    async def acount_tokens(self, contents, model: str = DEFAULT_MODEL):
+        return await self._await(self._count_tokens(contents, model))
+
+    async def aupload(self, path, mime_type: str = None, name: str = None, display_name: str = None):
+        return await self._await(self._upload(str(path), mime_type, name, display_name))
+
+    async def aget_file(self, name: str):
+        return await self._await(self._get_file(name))
+
+    async def adelete_file(self, name: str):
+        return await self._await(self._delete_file(name))
+
+    async def acreate_batch(self, src, model: str = DEFAULT_MODEL, config=None):
+        return await self._await(self._create_batch(model, src, config))
+
+    async def aget_batch(self, name: str):
+        return await self._await(self._get_batch(name))
+
+    async def acreate_cache(self, model: str, config, tokens: int = None):
+        return await self._await(self._create_cache(model, config, tokens))
+
+    async def aupdate_cache(self, name: str, config):
+        return await self._await(self._update_cache(name, config))
+
+    async def adelete_cache(self, name: str):
+        return await self._await(self._delete_cache(name))
+
+    async def aclose(self) -> None:
+        if self._loop is not None:
+            await self._await(self._close_transport())
+        self._stop_loop()
+
+    # ---------------------------
+    # 同期 API (スレッドからも呼べる)
+    # ---------------------------
+    def generate(self, contents, model: str = DEFAULT_MODEL, config=None, tokens: int = None):
+        return self._run(self._generate(contents, model, config, tokens))
+
+    def stream(self, contents, model: str = DEFAULT_MODEL, config=None, tokens: int = None):
+        stream = self._stream(contents, model, config, tokens)
+        try:
+            while True:
+                try:
+                    chunk = self._run(anext(stream))
+                except StopAsyncIteration:
+                    return
+                yield chunk
+        finally:
+            self._run(stream.aclose())
+
+    def embed(self, contents, model: str = "text-embedding-004", config=None, tokens: int = None):
+        return self._run(self._embed(contents, model, config, tokens))
+
+    def count_tokens(self, contents, model: str = DEFAULT_MODEL):
+        return self._run(self._count_tokens(contents, model))
+
+    def upload(self, path, mime_type: str = None, name: str = None, display_name: str = None):
+        return self._run(self._upload(str(path), mime_type, name, display_name))
+
+    def get_file(self, name: str):
+        return self._run(self._get_file(name))
+
+    def delete_file(self, name: str):
+        return self._run(self._delete_file(name))
+
+    def create_batch(self, src, model: str = DEFAULT_MODEL, config=None):
+        """Batch API のジョブを作る (src はリクエストのリスト)。完了は get_batch() で確かめる"""
+        return self._run(self._create_batch(model, src, config))
+
+    def get_batch(self, name: str):
+        return self._run(self._get_batch(name))
+
+    def create_cache(self, model: str, config, tokens: int = None):
+        return self._run(self._create_cache(model, config, tokens))
+
+    def update_cache(self, name: str, config):
+        return self._run(self._update_cache(name, config))
+
+    def delete_cache(self, name: str):
+        return self._run(self._delete_cache(name))
+
+    def close(self) -> None:
+        if self._loop is not None:
+            self._run(self._close_transport())
+        self._stop_loop()
+
+    async def _close_transport(self):
+        aclose = getattr(getattr(self.transport, "aio", None), "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    def _stop_loop(self):
+        with self._loop_lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+        if loop is not None:
+            loop.call_soon_threadsafe(loop.stop)
+            if thread is not threading.current_thread():
+                thread.join(timeout=5)
+
+
+# ---------------------------
+# プロセスで共有するクライアント
+# ---------------------------
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_client():
+    """
+    プロセスで 1 つの GeminiClient (接続プールと流量の予算を共有する)。
+    GEMINI_FAKE=1 ならフェイク (fake_gemini.FakeGemini)、API キーが無ければ None。
+    予算は環境変数 GEMINI_RPM / GEMINI_TPM か、set_limits() で設定する。
+    """
+    global _default
+    with _default_lock:
+        if _default is None:
+            rpm = int(os.environ["GEMINI_RPM"]) if os.getenv("GEMINI_RPM") else None
+            tpm = int(os.environ["GEMINI_TPM"]) if os.getenv("GEMINI_TPM") else None
+            if os.getenv("GEMINI_FAKE"):
+                from fake_gemini import FakeGemini
+                _default = GeminiClient(FakeGemini(), rpm=rpm, tpm=tpm)
+            else:
+                api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
+                if api_key:
+                    _default = GeminiClient(api_key=api_key, rpm=rpm, tpm=tpm)
+        return _default
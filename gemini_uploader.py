@@ -1,53 +1,312 @@
-import google.generativeai as genai
+import argparse
+import asyncio
+import hashlib
+import json
 import os
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from google.genai import types
 
-API_KEY = os.environ.get("GEMINI_API_KEY")
-genai.configure(api_key=API_KEY)
+import gemini_client
+import telemetry
+from answer_cache import AnswerCache
+from gemini_client import CHARS_PER_TOKEN, estimate_tokens
+
+# 再試行・RPM / TPM の制御は共有クライアント (gemini_client.py) が行う
+client = gemini_client.default_client()
+
+MODEL_NAME = "gemini-2.0-flash"
+SAFETY_CONFIG = types.GenerateContentConfig(
+    safety_settings=[types.SafetySetting(category="HARM_CATEGORY_HARASSMENT", threshold="BLOCK_NONE")]
+)
 
 # --- ファイルアップロード ---
-def upload_files(dir_path="data"):
-    uploaded_files = []
-    for file in Path(dir_path).glob("*"):
-        print(f"Uploading: {file}")
-        uploaded = genai.upload_file(path=str(file))
-        uploaded_files.append(uploaded)
-    return uploaded_files
-
-# --- 質問処理（429 の自動リトライ対応）---
-def ask_gemini(question, file_refs):
-    model = genai.GenerativeModel("gemini-2.0-flash")
-
-    while True:
-        try:
-            result = model.generate_content(
-                [question] + file_refs,
-                safety_settings={"HARASSMENT": "BLOCK_NONE"},
-            )
-            return result.text
-
-        except Exception as e:
-            if "RESOURCE_EXHAUSTED" in str(e):
-                print("Quota error. Waiting 40s…")
-                time.sleep(40)
-                continue
+UPLOAD_MANIFEST = "upload_manifest.json"
+UPLOAD_WORKERS = 4
+# 期限切れ直前のファイルは使わずに上げ直す (アップロード済みファイルは 48 時間で消える)
+EXPIRY_MARGIN = 3600
+# count_tokens が使えないときの概算 (画像 1 枚、PDF は 1 ページあたりのトークン数)
+MEDIA_TOKENS = 258
+_PDF_PAGE_RE = re.compile(rb"/Type\s*/Page(?![s\w])")
+
+class UploadedFile:
+    """マニフェストから復元したアップロード済みファイル (genai の File と同じ属性名)"""
+
+    def __init__(self, name, uri, mime_type, display_name, expiration, tokens=None):
+        self.name = name
+        self.uri = uri
+        self.mime_type = mime_type
+        self.display_name = display_name
+        self.expiration = expiration
+        self.tokens = tokens   # 質問に添付したときの入力トークン数 (count_tokens の結果)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_genai(cls, f):
+        return cls(f.name, f.uri, f.mime_type, f.display_name, f.expiration_time.timestamp())
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def load_upload_manifest(path=UPLOAD_MANIFEST):
+    try:
+        return json.loads(Path(path).read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def save_upload_manifest(manifest, path=UPLOAD_MANIFEST):
+    tmp = Path(path + ".tmp")
+    tmp.write_text(json.dumps(manifest, ensure_ascii=False, indent=1), encoding="utf-8")
+    os.replace(tmp, path)
+
+def fallback_file_tokens(path, mime_type):
+    """count_tokens が失敗したときの概算。テキストは文字数から、画像は 1 枚、PDF は 1 ページあたり MEDIA_TOKENS"""
+    if mime_type.startswith("text/") or mime_type == "application/json":
+        return path.stat().st_size // CHARS_PER_TOKEN + 1
+    if mime_type == "application/pdf":
+        return MEDIA_TOKENS * max(1, len(_PDF_PAGE_RE.findall(path.read_bytes())))
+    return MEDIA_TOKENS
+
+def count_file_tokens(file, uploaded):
+    """
+    アップロード済みファイルを質問に添付したときのトークン数 (TPM の予算に数える分)。
+    PDF や画像はバイト数よりずっと少なく数えられるので、API の count_tokens で数える。
+    """
+    try:
+        return client.count_tokens([gemini_client.file_part(uploaded)], model=MODEL_NAME).total_tokens
+    except Exception as e:
+        print(f"⚠ {file} のトークン数を数えられないため概算します: {e}")
+        return fallback_file_tokens(file, uploaded.mime_type or "")
+
+def upload_one(file, digest, manifest_entry):
+    """
+    1 ファイル分のアップロードと、添付したときのトークン数の計測 (結果はマニフェストに残る)。
+    """
+    uploaded, is_new = _upload_or_reuse(file, digest, manifest_entry)
+    if uploaded.tokens is None:
+        uploaded.tokens = count_file_tokens(file, uploaded)
+    return uploaded, is_new
+
+def _upload_or_reuse(file, digest, manifest_entry):
+    """
+    内容ハッシュをファイル名 (files/<hash>) にするので、
+    前回の実行がマニフェスト保存前に中断していても既存のファイルを再利用できる。
+    """
+    if manifest_entry is not None and manifest_entry["expiration"] - time.time() > EXPIRY_MARGIN:
+        return UploadedFile(**manifest_entry), False
+
+    name = f"files/{digest[:40]}"
+    try:
+        existing = client.get_file(name)
+        if existing.expiration_time.timestamp() - time.time() > EXPIRY_MARGIN:
+            return UploadedFile.from_genai(existing), False
+        client.delete_file(name)
+    except Exception:
+        pass   # まだアップロードされていない
+
+    print(f"Uploading: {file}")
+    uploaded = client.upload(file, name=name, display_name=file.name)
+    return UploadedFile.from_genai(uploaded), True
+
+@telemetry.traced("upload_files")
+def upload_files(dir_path="data", manifest_path=UPLOAD_MANIFEST, workers=UPLOAD_WORKERS):
+    """
+    data/ のファイルを並行でアップロードする。
+    内容ハッシュ → URI / 有効期限 / トークン数 をマニフェストに記録し、
+    変更が無く期限内のファイルはアップロードし直さない。
+    """
+    files = sorted(p for p in Path(dir_path).glob("*") if p.is_file())
+    manifest = load_upload_manifest(manifest_path)
+    digests = {file: file_digest(file) for file in files}
+    span = telemetry.current_span()
+    span.set(files=len(files))
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(upload_one, file, digests[file], manifest.get(digests[file])): file
+            for file in files
+        }
+        for future in as_completed(futures):
+            file = futures[future]
+            uploaded, is_new = future.result()
+            if is_new:
+                span.add("uploaded")
+                span.add("bytes", file.stat().st_size)
             else:
-                return f"Error: {e}"
+                span.add("reused")
+                print(f"Reusing: {file} ({uploaded.uri})")
+            results[file] = uploaded
+            manifest[digests[file]] = uploaded.to_dict()
+            save_upload_manifest(manifest, manifest_path)
 
-if __name__ == "__main__":
-    files = upload_files("data")
-    file_refs = [f"file:{f.uri}" for f in files]
+    return [results[file] for file in files]
+
+# --- データの版（回答キャッシュのキー）---
+def data_version(dir_path="data"):
+    """data/ 内のファイル名と内容のハッシュ。ファイルが変わると過去の回答は無効になる"""
+    h = hashlib.sha1()
+    for file in sorted(p for p in Path(dir_path).glob("*") if p.is_file()):
+        h.update(file.name.encode("utf-8"))
+        h.update(hashlib.sha1(file.read_bytes()).digest())
+    return f"{MODEL_NAME}:{h.hexdigest()}"
+
+# --- 質問処理（429 などの再試行はクライアント側）---
+@telemetry.traced("ask_gemini")
+async def ask_gemini(question, file_refs, answer_cache=None, file_tokens=0):
+    span = telemetry.current_span()
+    prompt_tokens = estimate_tokens(question) + file_tokens
+    span.set(prompt_tokens=prompt_tokens)
+
+    if answer_cache is not None:
+        cached = answer_cache.get(question)
+        if cached is not None:
+            span.set(cached=True)
+            return cached
 
-    questions = Path("questions.txt").read_text().splitlines()
-    output = []
+    try:
+        result = await client.agenerate(
+            [question] + file_refs,
+            model=MODEL_NAME,
+            config=SAFETY_CONFIG,
+            tokens=prompt_tokens,
+        )
+    except Exception as e:
+        span.fail(e)
+        return f"Error: {e}"
 
-    for q in questions:
-        if not q.strip():
+    usage = getattr(result, "usage_metadata", None)
+    span.set(response_tokens=getattr(usage, "candidates_token_count", None)
+             or estimate_tokens(result.text))
+    if answer_cache is not None:
+        answer_cache.put(question, result.text)
+    return result.text
+
+# --- 出力 ---
+def format_answer(q, a):
+    return f"## Q: {q}\n\n{a}\n\n---\n"
+
+class OrderedWriter:
+    """完了順に届く回答を、質問の順番どおりに出力ファイルへ追記していく"""
+
+    def __init__(self, path, count):
+        self.f = open(path, "w", encoding="utf-8")
+        self.results = [None] * count
+        self.next_index = 0
+
+    def add(self, index, text):
+        self.results[index] = text
+        while self.next_index < len(self.results) and self.results[self.next_index] is not None:
+            if self.next_index > 0:
+                self.f.write("\n")
+            self.f.write(self.results[self.next_index])
+            self.results[self.next_index] = ""
+            self.next_index += 1
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+# --- まとめて実行（並行）---
+async def run_questions(questions, file_refs, output_path, answer_cache=None,
+                        concurrency=8, file_tokens=0):
+    """
+    質問を並行に送り (RPM / TPM の予算はクライアントが守る)、質問の順番どおりに output_path へ書き出す。
+    回答キャッシュ (SQLite) はこのイベントループのスレッドだけで扱う。
+    """
+    writer = OrderedWriter(output_path, len(questions))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def ask(i, q):
+        async with semaphore:
+            return i, await ask_gemini(q, file_refs, None, file_tokens)
+
+    pending = []
+    for i, q in enumerate(questions):
+        cached = answer_cache.get(q) if answer_cache is not None else None
+        if cached is not None:
+            writer.add(i, format_answer(q, cached))
             continue
+        pending.append(ask(i, q))
+
+    for future in asyncio.as_completed(pending):
+        i, a = await future
+        q = questions[i]
         print(f"Q: {q}")
-        a = ask_gemini(q, file_refs)
-        output.append(f"## Q: {q}\n\n{a}\n\n---\n")
+        if answer_cache is not None and not a.startswith("Error:"):
+            answer_cache.put(q, a)
+        writer.add(i, format_answer(q, a))
+
+    writer.close()
+
+# --- Batch API（非同期の一括ジョブ）---
+def run_batch_api(questions, files, output_path, poll_interval=30):
+    """
+    Gemini Batch API に全質問を 1 つのジョブとして投入し、完了を待って書き出す。
+    料金が安く RPM 制限も受けないが、結果が返るまで数分〜数時間かかる。
+    ジョブの作成と状態の確認は共有クライアント経由なので、一時的なエラーは再試行される。
+    """
+    file_parts = [{"file_data": {"file_uri": f.uri, "mime_type": f.mime_type}} for f in files]
+    inline_requests = [
+        {"contents": [{"role": "user", "parts": [{"text": q}] + file_parts}]}
+        for q in questions
+    ]
+
+    job = client.create_batch(inline_requests, model=MODEL_NAME, config={"display_name": "gemini-uploader"})
+    print(f"Batch job created: {job.name}")
+
+    done_states = {"JOB_STATE_SUCCEEDED", "JOB_STATE_FAILED", "JOB_STATE_CANCELLED", "JOB_STATE_EXPIRED"}
+    while job.state.name not in done_states:
+        time.sleep(poll_interval)
+        job = client.get_batch(job.name)
+        print(f"Batch job state: {job.state.name}")
+
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch job {job.name} ended with {job.state.name}: {job.error}")
+
+    writer = OrderedWriter(output_path, len(questions))
+    for i, (q, r) in enumerate(zip(questions, job.dest.inlined_responses)):
+        a = r.response.text if r.response is not None else f"Error: {r.error}"
+        writer.add(i, format_answer(q, a))
+    writer.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="questions.txt の質問を data/ のファイルについて Gemini に聞く")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に送る質問数")
+    parser.add_argument("--rpm", type=int, default=15, help="1 分あたりの最大リクエスト数")
+    parser.add_argument("--tpm", type=int, default=1_000_000, help="1 分あたりの最大入力トークン数")
+    parser.add_argument("--batch-api", action="store_true", help="Gemini Batch API で一括処理する")
+    args = parser.parse_args()
+
+    if client is None:
+        print("❌ APIキーが見つかりません。環境変数に GEMINI_API_KEY または GOOGLE_API_KEY を設定してください。")
+        exit()
+    client.set_limits(args.rpm, args.tpm)
+
+    files = upload_files("data")
+    file_refs = [gemini_client.file_part(f) for f in files]
+
+    questions = [q for q in Path("questions.txt").read_text().splitlines() if q.strip()]
+
+    if args.batch_api:
+        run_batch_api(questions, files, "gemini_output.md")
+    else:
+        answer_cache = AnswerCache(corpus_version=data_version("data"))
+        asyncio.run(run_questions(
+            questions, file_refs, "gemini_output.md",
+            answer_cache=answer_cache,
+            concurrency=args.concurrency,
+            file_tokens=sum(f.tokens for f in files),
+        ))
+        answer_cache.close()
+    client.close()
 
-    Path("gemini_output.md").write_text("\n".join(output), encoding="utf-8")
     print("Done: gemini_output.md")
@@ -0,0 +1,286 @@
+# hybrid_search.py
+"""
+BM25 (rag_index) とベクトル検索 (vector_store) を組み合わせたハイブリッド検索。
+
+GAS の質問では SpreadsheetApp.getActiveRange のような API 名の完全一致が重要で、
+埋め込みだけの検索はこれが苦手。そこで
+
+  1. BM25 とベクトル検索でそれぞれ候補を CANDIDATES_PER_K * k 件ずつ取り、
+  2. Reciprocal Rank Fusion (RRF) で 1 つの順位にまとめ、
+  3. 任意で軽量なローカル再ランク (IdentifierReranker) をかける
+
+1 回の検索には時間の予算 (budget_ms) を設定でき、超えそうな段階は飛ばす。
+BM25 は必ず実行し、ベクトル検索は質問の埋め込みが予算内に返らなければ使わず、
+再ランクは過去の所要時間から見て予算が足りなければ行わない。
+どの段階を飛ばしたかは search() が結果と一緒に返す trace に入る。
+
+使い方:
+    python hybrid_search.py "SpreadsheetApp.getActiveRange の使い方"
+    python hybrid_search.py --embedder hashing --budget-ms 200 "質問文"
+"""
+import argparse
+import re
+import sys
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import rag_index
+
+# ---------------------------
+# 定数
+# ---------------------------
+RRF_K = 60                 # RRF の定数 (順位 r の重みは 1 / (RRF_K + r))
+CANDIDATES_PER_K = 4       # 各検索から取る候補数 (k の何倍か)
+DEFAULT_BUDGET_MS = 300    # 1 回の検索の時間の予算
+RERANK_WEIGHT = 1.0 / RRF_K   # 再ランクの特徴量 1.0 が、片方の検索で 1 位になるのと同程度
+EMBED_WORKERS = 4          # 質問の埋め込みを並行に行うスレッド数 (rag_server.RETRIEVAL_WORKERS に合わせる)
+
+# SpreadsheetApp.getActiveRange / getValues() / Range.setValues など
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_$][\w$]*(?:\.[A-Za-z_$][\w$]*)*")
+_CAMEL_CASE_RE = re.compile(r"[a-z0-9][A-Z]|^[A-Z][a-z]+[A-Z]")
+
+
+def query_identifiers(query: str) -> set[str]:
+    """質問文に含まれる API 名らしき語 (camelCase またはドット区切り) を部品ごとに返す"""
+    identifiers = set()
+    for m in _IDENTIFIER_RE.finditer(query):
+        word = m.group()
+        if "." not in word and not _CAMEL_CASE_RE.search(word):
+            continue
+        identifiers.update(part for part in word.split(".") if part)
+    return identifiers
+
+
+def rrf_fuse(rankings: list[list[int]], k: int = RRF_K) -> list[tuple[float, int]]:
+    """
+    複数の順位リスト (chunk_id のリスト、良い順) を Reciprocal Rank Fusion でまとめる。
+    スコアの尺度が違う検索同士でも、順位だけを使うのでそのまま合わせられる。
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(((score, chunk_id) for chunk_id, score in scores.items()),
+                  key=lambda item: (-item[0], item[1]))
+
+
+# ---------------------------
+# 再ランク
+# ---------------------------
+class Reranker(ABC):
+    """再ランクの共通インターフェース。score() は候補ごとの加点 (0 以上) を返す"""
+
+    name = ""
+
+    @abstractmethod
+    def score(self, query: str, chunks: list[dict]) -> list[float]:
+        """chunks と同じ順に、各候補の加点を返す"""
+
+
+class IdentifierReranker(Reranker):
+    """
+    API 名の一致と質問語の網羅率で加点する、モデルを使わない再ランク。
+
+      - メソッド名が質問中の識別子と一致     +1.0
+      - クラス名が質問中の識別子と一致       +0.5
+      - 識別子が本文にそのまま (大文字小文字も一致して) 出てくる  +0.3 (1 語ごと、最大 +0.6)
+      - 質問のトークンのうち本文に出てくる割合  +0.5 × 割合
+    """
+
+    name = "identifier"
+
+    def score(self, query, chunks):
+        identifiers = query_identifiers(query)
+        query_tokens = set(rag_index.tokenize(query))
+        scores = []
+        for chunk in chunks:
+            s = 0.0
+            method = (chunk.get("method") or "").split("(")[0]
+            if method and method in identifiers:
+                s += 1.0
+            if chunk.get("class") and chunk["class"] in identifiers:
+                s += 0.5
+            text = chunk["text"]
+            s += min(0.6, 0.3 * sum(1 for ident in identifiers if ident in text))
+            if query_tokens:
+                chunk_tokens = set(rag_index.tokenize(text))
+                s += 0.5 * len(query_tokens & chunk_tokens) / len(query_tokens)
+            scores.append(s)
+        return scores
+
+
+RERANKERS = {
+    "identifier": IdentifierReranker,
+}
+
+
+def get_reranker(name: str = "identifier", **kwargs) -> Reranker:
+    try:
+        return RERANKERS[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"未知の再ランク方式です: {name} (選択肢: {', '.join(RERANKERS)})")
+
+
+# ---------------------------
+# 時間の予算
+# ---------------------------
+class LatencyBudget:
+    """1 回の検索の締め切り。budget_ms が None なら無制限"""
+
+    def __init__(self, budget_ms=None):
+        self.started = time.perf_counter()
+        self.deadline = None if budget_ms is None else self.started + budget_ms / 1000
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started) * 1000
+
+    def remaining(self):
+        """残り秒数 (無制限なら None、締め切りを過ぎていれば 0)"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.perf_counter())
+
+    def allows(self, expected_seconds: float) -> bool:
+        """expected_seconds かかる処理を締め切りまでに終えられそうか"""
+        remaining = self.remaining()
+        return remaining is None or remaining > expected_seconds
+
+
+# ---------------------------
+# ハイブリッド検索
+# ---------------------------
+class HybridRetriever:
+    """
+    BM25 + ベクトル検索 + 再ランクをまとめた検索器。
+    store / embedder を省略すると BM25 だけ、reranker を省略すると再ランクなしになる。
+    search() は BM25Index.search() と同じ (score, chunk) のリストと、
+    段階ごとの所要時間・飛ばした段階を入れた trace (dict) の組を返す。
+    複数のスレッドから同時に search() を呼べる (rag_server.py の検索スレッド)。
+    """
+
+    def __init__(self, index: rag_index.BM25Index, store=None, embedder=None,
+                 reranker: Reranker = None, budget_ms=DEFAULT_BUDGET_MS,
+                 candidates_per_k: int = CANDIDATES_PER_K, workers: int = EMBED_WORKERS):
+        self.index = index
+        self.store = store if embedder is not None else None
+        self.embedder = embedder
+        self.reranker = reranker
+        self.budget_ms = budget_ms
+        self.candidates_per_k = candidates_per_k
+        # 質問の埋め込み (API 呼び出しのこともある) は締め切りで打ち切れるよう別スレッドで行う。
+        # 遅い埋め込みが後続の質問を待たせないよう、検索を呼ぶスレッドと同じ数だけ用意する
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query-embed") \
+            if self.store is not None else None
+        self._rerank_seconds = 0.0   # 再ランク 1 回あたりの所要時間 (指数移動平均)
+        # 検索方式の名前 (回答キャッシュの版に含める)
+        self.name = "+".join(["bm25"] + [c.name for c in (self.embedder, reranker) if c is not None])
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _vector_ranking(self, query, n, budget, trace):
+        future = self._executor.submit(self.embedder.embed, [query], "query")
+        try:
+            qvec = future.result(timeout=budget.remaining())[0]
+        except TimeoutError:
+            future.cancel()
+            trace["skipped"].append("vector")
+            return None
+        except Exception as e:
+            print(f"⚠ 質問の埋め込みに失敗したため BM25 のみで検索します: {e}", file=sys.stderr)
+            trace["skipped"].append("vector")
+            return None
+        return [chunk_id for _score, chunk_id in self.store.search(qvec, k=n)]
+
+    def search(self, query: str, k: int = 8, budget_ms=...) -> tuple[list[tuple[float, dict]], dict]:
+        """
+        上位 k 件の (score, chunk) のリストと trace を返す。budget_ms を省略するとインスタンスの既定値。
+        trace は {"skipped": [飛ばした段階], "bm25_ms": ..., "total_ms": ...} の形。
+        """
+        budget = LatencyBudget(self.budget_ms if budget_ms is ... else budget_ms)
+        n = k * self.candidates_per_k
+        trace = {"skipped": []}
+
+        # --- BM25 (予算に関係なく必ず実行する) ---
+        rankings = [[chunk_id for _score, chunk_id in self.index.search_ids(query, k=n)]]
+        trace["bm25_ms"] = budget.elapsed_ms()
+
+        # --- ベクトル検索 ---
+        if self.store is not None:
+            ranking = self._vector_ranking(query, n, budget, trace)
+            if ranking is not None:
+                rankings.append(ranking)
+            trace["vector_ms"] = budget.elapsed_ms()
+
+        fused = rrf_fuse(rankings)[:n]
+
+        # --- 再ランク ---
+        if self.reranker is not None and fused:
+            if budget.allows(self._rerank_seconds):
+                started = time.perf_counter()
+                bonus = self.reranker.score(query, [self.index.chunks[i] for _s, i in fused])
+                fused = sorted(
+                    ((score + RERANK_WEIGHT * b, chunk_id) for (score, chunk_id), b in zip(fused, bonus)),
+                    key=lambda item: (-item[0], item[1]),
+                )
+                seconds = time.perf_counter() - started
+                self._rerank_seconds = seconds if not self._rerank_seconds else \
+                    0.8 * self._rerank_seconds + 0.2 * seconds
+                trace["rerank_ms"] = budget.elapsed_ms()
+            else:
+                trace["skipped"].append("rerank")
+
+        trace["total_ms"] = budget.elapsed_ms()
+        return [(score, self.index.chunks[chunk_id]) for score, chunk_id in fused[:k]], trace
+
+
+def build_retriever(index: rag_index.BM25Index, embedder_name=None, rerank: bool = True,
+                    budget_ms=DEFAULT_BUDGET_MS, int8: bool = False, workers: int = EMBED_WORKERS,
+                    **embedder_kwargs) -> HybridRetriever:
+    """
+    設定から HybridRetriever を作る。embedder_name を指定するとベクトルストアを
+    読み込み (無ければ構築し)、ベクトル検索も使う。
+    workers は search() を同時に呼ぶスレッドの数 (質問の埋め込みを並行に行う数)。
+    """
+    store = embedder = None
+    if embedder_name is not None:
+        import vector_store
+
+        embedder = vector_store.get_embedder(embedder_name, **embedder_kwargs)
+        cache = vector_store.EmbeddingCache() if embedder.cacheable else None
+        try:
+            store = vector_store.load_or_build_store(
+                index, embedder, dtype="int8" if int8 else "float32", cache=cache,
+            )
+        finally:
+            if cache is not None:
+                cache.close()
+    reranker = get_reranker() if rerank else None
+    return HybridRetriever(index, store, embedder, reranker, budget_ms, workers=workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BM25 + ベクトルのハイブリッド検索")
+    parser.add_argument("query", nargs="+", help="検索する質問文")
+    parser.add_argument("--embedder", default=None,
+                        help="ベクトル検索に使う埋め込みバックエンド (省略時は BM25 のみ)")
+    parser.add_argument("--no-rerank", action="store_true", help="再ランクを行わない")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help="1 回の検索の時間の予算 (ミリ秒)")
+    parser.add_argument("-k", type=int, default=5, help="表示する件数")
+    args = parser.parse_args()
+
+    retriever = build_retriever(rag_index.load_or_build_index(), args.embedder,
+                                rerank=not args.no_rerank, budget_ms=args.budget_ms)
+    try:
+        q = " ".join(args.query)
+        results, trace = retriever.search(q, k=args.k)
+        for score, chunk in results:
+            print(f"\n[{score:.4f}] {chunk['source']}")
+            print(chunk["text"][:300])
+        skipped = f" (省略: {', '.join(trace['skipped'])})" if trace["skipped"] else ""
+        print(f"\n⏱ {trace['total_ms']:.1f} ms{skipped}", file=sys.stderr)
+    finally:
+        retriever.close()
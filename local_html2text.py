@@ -1,9 +1,271 @@
-import os
+import argparse
+import contextlib
 import glob
-from bs4 import BeautifulSoup
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import BeautifulSoup, NavigableString
+
+import telemetry
+
+# 変換済みファイルの記録 (TXT フォルダ内に置く)
+MANIFEST_FILENAME = ".convert_manifest.json"
+MANIFEST_VERSION = 1
+
+# --- 本文抽出モード (extract="main") の設定 ---
+# 本文の候補 (先に見つかったものを使う)
+MAIN_CONTENT_SELECTORS = [".devsite-article-body", "article", "main", "[role=main]"]
+# 本文内でも不要な要素
+BOILERPLATE_TAGS = [
+    "script", "style", "noscript", "template", "svg", "button", "nav", "footer", "aside",
+    "devsite-feedback", "devsite-hats-survey", "devsite-thumb-rating", "devsite-toc",
+]
+BOILERPLATE_SELECTORS = [".nocontent", ".material-icons", "[aria-hidden=true]"]
+BLOCK_TAGS = [
+    "p", "div", "section", "li", "ul", "ol", "dl", "dt", "dd", "tr", "table", "br", "hr",
+    "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "devsite-code",
+]
+# 文書頻度で定型文とみなす条件: この割合以上の文書に現れる、この文字数以上の行
+BOILERPLATE_DOC_RATIO = 0.6
+BOILERPLATE_MIN_LINE_CHARS = 20
+BOILERPLATE_MIN_DOCS = 10
+
+
+def pick_parser():
+    """lxml が使えれば高速な lxml パーサ、無ければ標準の html.parser を使う"""
+    try:
+        import lxml  # noqa: F401
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+
+def txt_filename(html_file, html_folder):
+    """
+    HTML のパスから出力 TXT ファイル名を作る。
+    ほとんどのページが index.html なので、フォルダ階層を '-' でつないで一意にする。
+    例: gas_docs_html/apps-script/reference/base/blob/index.html
+        → apps-script-reference-base-blob-index.txt
+    """
+    rel = os.path.relpath(html_file, html_folder)
+    base = os.path.splitext(rel)[0]
+    return base.replace(os.sep, "-").replace("/", "-") + ".txt"
+
+
+def element_text(root):
+    """
+    要素 root 以下をテキスト化する (root の木は書き換えられる)。
+    定型的な要素を除き、コードブロックは改行とインデントを保ったまま、
+    表は 1 行 = 1 行で出力する。
+
+    Returns:
+        list[str]: 空行を除いた行のリスト
+    """
+    for tag in root.find_all(BOILERPLATE_TAGS) + root.select(", ".join(BOILERPLATE_SELECTORS)):
+        if not tag.decomposed:
+            tag.decompose()
+
+    # コードブロックは 1 つの文字列に置き換え、空白の正規化の対象から外す
+    preserved = set()
+    for pre in root.find_all("pre"):
+        code = NavigableString("\n" + pre.get_text() + "\n")
+        pre.replace_with(code)
+        preserved.add(id(code))
+
+    # HTML ソース上の改行や連続空白は 1 つの空白にまとめる
+    for string in root.find_all(string=True):
+        if id(string) in preserved:
+            continue
+        collapsed = " ".join(string.split())
+        if string[:1].isspace():
+            collapsed = " " + collapsed
+        if string[-1:].isspace() and collapsed != " ":
+            collapsed += " "
+        string.replace_with(collapsed)
+
+    for cell in root.find_all(["td", "th"]):
+        if cell.find_next_sibling(["td", "th"]) is not None:
+            cell.insert_after(" | ")
+    for tag in root.find_all(BLOCK_TAGS):
+        tag.insert_before("\n")
+        tag.insert_after("\n")
+
+    lines = [line.rstrip() for line in root.get_text().split("\n")]
+    lines = [line[1:] if line.startswith(" ") and not line.startswith("  ") else line for line in lines]
+    return [line for line in lines if line.strip()]
+
+
+def page_title(soup):
+    """記事タイトルは本文の外にあるので <title> ("Class Range | Apps Script | ...") から取る"""
+    if soup.title is None:
+        return ""
+    return soup.title.get_text().split("|")[0].strip()
+
+
+def main_content(soup):
+    """ページ本文 (devsite の記事本文など) の要素"""
+    for selector in MAIN_CONTENT_SELECTORS:
+        root = soup.select_one(selector)
+        if root is not None:
+            return root
+    return soup.body or soup
+
+
+def extract_main_text(soup):
+    """
+    ページ本文 (devsite の記事本文など) だけをテキスト化する。
+    ナビゲーション・フッター・フィードバック欄などを除き、
+    コードブロックは改行とインデントを保ったまま、表は 1 行 = 1 行で出力する。
+    """
+    root = main_content(soup)
+    title_text = page_title(soup)
+    lines = element_text(root)
+
+    if title_text and (not lines or lines[0].strip() != title_text):
+        lines.insert(0, title_text)
+    return "\n".join(lines) + "\n"
+
+
+def html_to_text(html, parser, extract="full"):
+    soup = BeautifulSoup(html, parser)
+    if extract == "main":
+        return extract_main_text(soup)
+    return soup.get_text(separator="\n")
+
+
+def find_boilerplate(texts):
+    """
+    多くの文書に共通して現れる行 (テンプレート由来の定型文) を返す。
+    BOILERPLATE_DOC_RATIO 以上の文書に現れる、ある程度長い行が対象。
+    """
+    texts = list(texts)
+    if len(texts) < BOILERPLATE_MIN_DOCS:
+        return set()
+
+    doc_freq = {}
+    for text in texts:
+        for line in {line.strip() for line in text.splitlines()}:
+            if len(line) >= BOILERPLATE_MIN_LINE_CHARS:
+                doc_freq[line] = doc_freq.get(line, 0) + 1
+
+    threshold = len(texts) * BOILERPLATE_DOC_RATIO
+    return {line for line, count in doc_freq.items() if count >= threshold}
+
+
+def strip_boilerplate(text, boilerplate):
+    if not boilerplate:
+        return text
+    lines = [line for line in text.splitlines() if line.strip() not in boilerplate]
+    return "\n".join(lines) + "\n"
+
+
+def write_txt(txt_path, text):
+    with open(txt_path, "w", encoding="utf-8") as out:
+        out.write(text)
+
+
+def convert_one(html_file, txt_path, parser, extract="full", boilerplate=None):
+    """
+    1 ファイル分の変換（ワーカープロセスで実行される）。
+    個別 TXT はワーカー側で書き出し、結合ファイル用にテキストを返す。
+    txt_path が None の場合は書き出さずにテキストだけ返す。
+
+    Returns:
+        tuple: (html_file, text, error)。失敗時は text が None。
+    """
+    try:
+        with open(html_file, "r", encoding="utf-8") as f:
+            text = html_to_text(f.read(), parser, extract)
+
+        if boilerplate:
+            text = strip_boilerplate(text, boilerplate)
+
+        if txt_path is not None:
+            write_txt(txt_path, text)
 
-def convert_html_folder(html_folder, txt_folder, merged_filename):
-    """HTML フォルダ → TXT フォルダ → 結合ファイル を生成する関数"""
+        return html_file, text, None
+
+    except Exception as e:
+        return html_file, None, str(e)
+
+
+def file_sha1(path):
+    """ファイル内容の SHA-1 (16 進文字列)"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """前回の変換結果を記録したマニフェストを読み込む。無い・壊れている場合は None"""
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"⚠ マニフェストを読み込めません。全ファイルを変換します: {e}")
+        return None
+
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def merged_header(html_file):
+    return f"\n\n===== FILE: {html_file} =====\n\n"
+
+
+def read_old_segment(old_merged, entry, txt_folder, html_file):
+    """
+    変更の無いファイルの結合用セグメント (ヘッダー + 本文) を返す。
+    前回の結合ファイルから記録済みのバイト範囲をそのまま切り出し、
+    それができない場合は個別 TXT から組み立て直す。
+    """
+    header = merged_header(html_file).encode("utf-8")
+
+    if old_merged is not None and "offset" in entry:
+        old_merged.seek(entry["offset"])
+        segment = old_merged.read(entry["length"])
+        if segment.startswith(header) and len(segment) == entry["length"]:
+            return segment
+
+    with open(os.path.join(txt_folder, entry["txt"]), "r", encoding="utf-8") as f:
+        return header + f.read().encode("utf-8")
+
+
+def finish_deferred(results, txt_paths, boilerplate):
+    """全件抽出後に定型文を除いて個別 TXT を書き出す (結果の順序は保つ)"""
+    for (html_file, text, error), txt_path in zip(results, txt_paths):
+        if error is None:
+            text = strip_boilerplate(text, boilerplate)
+            write_txt(txt_path, text)
+        yield html_file, text, error
+
+
+@telemetry.traced("html2text")
+def convert_html_folder(html_folder, txt_folder, merged_filename, workers=None, incremental=True,
+                        extract="full"):
+    """
+    HTML フォルダ → TXT フォルダ → 結合ファイル を生成する関数
+
+    workers: 変換に使うプロセス数。None なら CPU コア数、1 なら逐次処理。
+    incremental: True なら TXT フォルダのマニフェストを参照し、
+                 新規・変更された HTML だけを変換する。
+    extract: "full" はページ全体のテキスト、"main" は本文だけを抽出し、
+             多くのページに共通する定型文の行を取り除く。
+    """
 
     if not os.path.isdir(html_folder):
         print(f"⚠ HTML フォルダが見つかりません: {html_folder}")
@@ -11,42 +273,180 @@ def convert_html_folder(html_folder, txt_folder, merged_filename):
 
     os.makedirs(txt_folder, exist_ok=True)
 
-    html_files = glob.glob(os.path.join(html_folder, "**/*.html"), recursive=True)
+    # 結合ファイルの順序が毎回同じになるようにソートしておく
+    html_files = sorted(glob.glob(os.path.join(html_folder, "**/*.html"), recursive=True))
     if not html_files:
         print(f"⚠ HTML ファイルがありません: {html_folder}")
         return False
 
-    print(f"📁 HTML → TXT 変換開始: {html_folder} → {txt_folder}")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    parser = pick_parser()
+
+    print(f"📁 HTML → TXT 変換開始: {html_folder} → {txt_folder} "
+          f"(parser={parser}, extract={extract}, workers={workers})")
     merged_path = os.path.join(txt_folder, merged_filename)
+    manifest_path = os.path.join(txt_folder, MANIFEST_FILENAME)
 
-    with open(merged_path, "w", encoding="utf-8") as merged_out:
+    # --- 前回の変換結果との比較 ---
+    old_entries = {}
+    boilerplate = None
+    manifest = load_manifest(manifest_path) if incremental else None
+    if manifest is not None:
+        if (
+            manifest.get("parser") == parser and
+            manifest.get("merged") == merged_filename and
+            manifest.get("extract", "full") == extract
+        ):
+            old_entries = manifest["files"]
+            # 定型文の判定は全件変換時に決めたものを使い回す
+            if extract == "main":
+                boilerplate = frozenset(manifest.get("boilerplate", []))
+        else:
+            print("ℹ 変換設定が変わったため全ファイルを再変換します")
 
-        for html_file in html_files:
-            try:
-                with open(html_file, "r", encoding="utf-8") as f:
-                    soup = BeautifulSoup(f.read(), "html.parser")
-                    text = soup.get_text(separator="\n")
+    entries = {}
+    changed = []
+    for html_file in html_files:
+        key = html_file.replace(os.sep, "/")
+        st = os.stat(html_file)
+        txt_name = txt_filename(html_file, html_folder)
+        old = old_entries.get(key)
+        txt_exists = old is not None and os.path.exists(os.path.join(txt_folder, old["txt"]))
+
+        # サイズと更新時刻が同じならハッシュ計算も省略する
+        if txt_exists and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+            entries[key] = dict(old)
+            continue
+
+        digest = file_sha1(html_file)
+        if txt_exists and old["sha1"] == digest:
+            entry = dict(old)
+            entry.update(size=st.st_size, mtime=st.st_mtime)
+            entries[key] = entry
+            continue
+
+        entries[key] = {"sha1": digest, "size": st.st_size, "mtime": st.st_mtime, "txt": txt_name}
+        changed.append(html_file)
+
+    # --- 消えたページの出力を削除 ---
+    removed = [key for key in old_entries if key not in entries]
+    current_txts = {entry["txt"] for entry in entries.values()}
+    for key in removed:
+        txt_name = old_entries[key]["txt"]
+        if txt_name in current_txts:
+            continue
+        try:
+            os.remove(os.path.join(txt_folder, txt_name))
+            print(f"🗑 削除: {txt_name} ({key})")
+        except FileNotFoundError:
+            pass
 
-                # 出力 TXT ファイル名
-                base = os.path.splitext(os.path.basename(html_file))[0]
-                txt_path = os.path.join(txt_folder, base + ".txt")
+    new_manifest = {
+        "version": MANIFEST_VERSION,
+        "parser": parser,
+        "merged": merged_filename,
+        "extract": extract,
+        "files": entries,
+    }
+    if boilerplate is not None:
+        new_manifest["boilerplate"] = sorted(boilerplate)
 
-                with open(txt_path, "w", encoding="utf-8") as out:
-                    out.write(text)
+    span = telemetry.current_span()
+    span.set(folder=html_folder, files=len(html_files), changed=len(changed), removed=len(removed))
+
+    if old_entries and not changed and not removed and os.path.exists(merged_path):
+        save_manifest(manifest_path, new_manifest)
+        print(f"✅ 変更なし: {merged_path}")
+        return True
+
+    print(f"🔁 変換対象: {len(changed)} / {len(html_files)} ファイル (削除 {len(removed)})")
+
+    # --- 変更ファイルの変換と結合ファイルの組み立て ---
+    changed_set = set(changed)
+    txt_paths = [os.path.join(txt_folder, entries[h.replace(os.sep, "/")]["txt"]) for h in changed]
+    tmp_path = merged_path + ".tmp"
+
+    # 本文抽出モードで定型文がまだ分からない (全件変換) 場合は、
+    # いったん全ページを抽出して文書頻度を数えてから書き出す
+    deferred = extract == "main" and boilerplate is None
+    args = (
+        changed,
+        [None] * len(changed) if deferred else txt_paths,
+        [parser] * len(changed),
+        [extract] * len(changed),
+        [boilerplate] * len(changed),
+    )
 
-                merged_out.write(f"\n\n===== FILE: {html_file} =====\n\n")
-                merged_out.write(text)
+    with contextlib.ExitStack() as stack:
+        if workers <= 1 or len(changed) <= 1:
+            results = map(convert_one, *args)
+        else:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            results = executor.map(convert_one, *args, chunksize=4)
 
+        if deferred:
+            results = list(results)
+            boilerplate = find_boilerplate(text for _, text, error in results if error is None)
+            print(f"🧹 定型文として除外する行: {len(boilerplate)}")
+            results = iter(finish_deferred(results, txt_paths, boilerplate))
+            new_manifest["boilerplate"] = sorted(boilerplate)
+
+        old_merged = None
+        if old_entries and os.path.exists(merged_path):
+            old_merged = stack.enter_context(open(merged_path, "rb"))
+        merged_out = stack.enter_context(open(tmp_path, "wb"))
+
+        # 変更の無いファイルは前回の結合ファイルからバイト列を切り出してつなぎ、
+        # 変更されたファイルだけ新しいテキストに差し替える。
+        # map の結果は入力順に届くので、ソート順のまま結合ファイルへ流し込める。
+        offset = 0
+        for html_file in html_files:
+            key = html_file.replace(os.sep, "/")
+            entry = entries[key]
+
+            if html_file in changed_set:
+                _, text, error = next(results)
+                if error is not None:
+                    print(f"❌ エラー ({html_file}): {error}")
+                    span.add("errors")
+                    # マニフェストに残さず、次回また変換を試みる
+                    del entries[key]
+                    continue
+                segment = (merged_header(html_file) + text).encode("utf-8")
                 print(f"✔ 変換: {html_file}")
+            else:
+                segment = read_old_segment(old_merged, entry, txt_folder, html_file)
+
+            merged_out.write(segment)
+            entry["offset"] = offset
+            entry["length"] = len(segment)
+            offset += len(segment)
 
-            except Exception as e:
-                print(f"❌ エラー ({html_file}): {e}")
+    os.replace(tmp_path, merged_path)
+    save_manifest(manifest_path, new_manifest)
+    span.set(output_bytes=offset)
 
     print(f"🎉 完了: 結合ファイル作成 → {merged_path}")
     return True
 
 
 def main():
+    arg_parser = argparse.ArgumentParser(description="HTML → TXT 変換スクリプト")
+    arg_parser.add_argument(
+        "--workers", type=int, default=None,
+        help="変換に使うプロセス数 (既定: CPU コア数, 1 で逐次処理)"
+    )
+    arg_parser.add_argument(
+        "--extract", choices=["full", "main"], default="full",
+        help="full: ページ全体のテキスト, main: 本文のみ (ナビゲーションや定型文を除く)"
+    )
+    arg_parser.add_argument(
+        "--full", action="store_true",
+        help="マニフェストを無視して全ファイルを再変換する"
+    )
+    args = arg_parser.parse_args()
+
     print("\n============================")
     print("📄 HTML → TXT 変換スクリプト開始")
     print("============================\n")
@@ -55,14 +455,20 @@ def main():
     convert_html_folder(
         html_folder="gas_docs_html",
         txt_folder="gas_docs_txt",
-        merged_filename="gas_all.txt"
+        merged_filename="gas_all.txt",
+        workers=args.workers,
+        incremental=not args.full,
+        extract=args.extract
     )
 
     # Gemini API
     convert_html_folder(
         html_folder="gemini_api_docs_html",
         txt_folder="gemini_api_docs_txt",
-        merged_filename="gemini_all.txt"
+        merged_filename="gemini_all.txt",
+        workers=args.workers,
+        incremental=not args.full,
+        extract=args.extract
     )
 
     print("\n🚀 全処理完了\n")
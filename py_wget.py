@@ -1,23 +1,116 @@
 # py_wget_playwright.py
+import argparse
+import asyncio
 import os
 import time
 from urllib.parse import urljoin, urlparse
+
+import requests
 from bs4 import BeautifulSoup
 from playwright.sync_api import sync_playwright
 
+import telemetry
+from crawl_state import (
+    DEFAULT_DB_PATH, CrawlState, conditional_get, content_sha1, response_validators, static_html
+)
+
+USER_AGENT = "Mozilla/5.0 (compatible; py_wget/1.0)"
+
+
+def local_file_path(url, output_dir):
+    """URL から保存先のローカルパスを作る (ディレクトリ形式は index.html を補う)"""
+    parsed = urlparse(url)
+    local_path = parsed.path.lstrip("/")
+
+    if local_path.endswith("/"):
+        local_path += "index.html"
+    elif not os.path.splitext(local_path)[1]:
+        local_path += "/index.html"
+
+    return os.path.join(output_dir, local_path)
+
+
+def save_html(html, file_path):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(html)
+    print(f"  保存先: {file_path}")
 
-def recursive_download(start_url, output_dir, allowed_domain, wait_time=1):
+
+def read_local_html(file_path):
+    with open(file_path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def store_page(state, url, html, file_path, headers=None):
+    """
+    取得した HTML を保存し、クロール状態に記録する値 (etag, last_modified, sha1) を返す。
+    headers は HTML を取得したレスポンスのヘッダー (requests / Playwright のどちらでもよい)。
+    前回と内容が同じならファイルは書き換えない (変換側の差分判定を無駄に起こさない)。
+    """
+    sha1 = content_sha1(html)
+    if os.path.exists(file_path) and state.is_unchanged(url, sha1):
+        print("  変更なし")
+        telemetry.count("crawl_pages", result="unchanged")
+    else:
+        save_html(html, file_path)
+        telemetry.count("crawl_pages", result="saved")
+    telemetry.current_span().add("chars", len(html))
+
+    etag, last_modified = response_validators(headers)
+    return etag, last_modified, sha1
+
+
+def extract_links(html, current_url, start_url, allowed_domain):
+    """ページ内のリンクのうち、クロール対象 (start_url 配下の HTML) の URL を返す"""
+    soup = BeautifulSoup(html, "lxml")
+    links = set()
+
+    for link in soup.find_all("a", href=True):
+        href = link["href"]
+
+        new_url = urljoin(current_url, href)
+        new_url = new_url.split("#")[0]
+
+        parsed_new = urlparse(new_url)
+        ext = os.path.splitext(parsed_new.path)[1]
+
+        if (
+            parsed_new.netloc == allowed_domain and
+            new_url.startswith(start_url) and
+            (ext == "" or ext == ".html")
+        ):
+            links.add(new_url)
+
+    return links
+
+
+@telemetry.traced("crawl")
+def recursive_download(start_url, output_dir, allowed_domain, wait_time=1, state_path=DEFAULT_DB_PATH):
     """
     Playwright を使って JS レンダリング済み HTML を再帰ダウンロード。
     wget --recursive の HTML 版に相当。
-    """
 
-    urls_to_visit = {start_url}
-    visited_urls = set()
+    訪問状態は state_path の SQLite に保存され、中断した場合は次回そこから再開する。
+    前回の ETag / Last-Modified があるページだけ条件付き GET で確認し、
+    304 ならブラウザで開かず、200 でも本文入りの HTML ならその本文を使う。
+    それ以外はブラウザで 1 回だけ開き、ETag / Last-Modified もその応答から取る。
+    """
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
+    state = CrawlState(state_path)
+    run_id, resumed = state.begin_run(start_url)
+    urls_to_visit = set(state.pending(start_url))
+    visited_urls = state.visited(run_id)
+    if resumed:
+        print(f"↩ 前回の中断地点から再開します (訪問済み {len(visited_urls)} 件, "
+              f"未訪問 {len(urls_to_visit)} 件)")
+
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+
     with sync_playwright() as pw:
         browser = pw.chromium.launch(headless=True)
         page = browser.new_page()
@@ -30,71 +123,264 @@ def recursive_download(start_url, output_dir, allowed_domain, wait_time=1):
 
             print(f"訪問中: {current_url}")
             visited_urls.add(current_url)
+            file_path = local_file_path(current_url, output_dir)
 
-            try:
-                page.goto(current_url, timeout=30000)  # 30秒
-                page.wait_for_load_state("networkidle")
-                html = page.content()
-            except Exception as e:
-                print(f"  エラー: スキップします ({e})")
-                continue
+            # 前回の検証子が無いページは、GET してもブラウザで開き直すことが多いので直接ブラウザで開く
+            status, resp = "error", None
+            headers = state.conditional_headers(current_url, file_path)
+            if headers:
+                try:
+                    status, resp = conditional_get(session, current_url, headers)
+                except requests.RequestException:
+                    pass
 
-            soup = BeautifulSoup(html, "lxml")
+            html = static_html(resp) if status == "ok" else None
+            if status == "not_modified":
+                print("  変更なし (304)")
+                telemetry.count("crawl_pages", result="not_modified")
+                html = read_local_html(file_path)
+                info = (None, None, None)
+            elif html is not None:
+                info = store_page(state, current_url, html, file_path, resp.headers)
+            else:
+                try:
+                    response = page.goto(current_url, timeout=30000)  # 30秒
+                    page.wait_for_load_state("networkidle")
+                    html = page.content()
+                except Exception as e:
+                    print(f"  エラー: スキップします ({e})")
+                    telemetry.count("crawl_pages", result="error")
+                    state.mark_visited(start_url, current_url, run_id)
+                    continue
 
-            parsed = urlparse(current_url)
-            local_path = parsed.path.lstrip("/")
+                info = store_page(state, current_url, html, file_path,
+                                  response.headers if response is not None else None)
 
-            if local_path.endswith("/"):
-                local_path += "index.html"
-            elif not os.path.splitext(local_path)[1]:
-                local_path += "/index.html"
+            # --- 再帰リンク探索 ---
+            # リンクを先にフロンティアへ記録してから訪問済みにする (中断しても取りこぼさない)
+            new_urls = extract_links(html, current_url, start_url, allowed_domain) - visited_urls - urls_to_visit
+            state.add_urls(start_url, new_urls)
+            urls_to_visit |= new_urls
+            state.mark_visited(start_url, current_url, run_id, *info)
 
-            file_path = os.path.join(output_dir, local_path)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            time.sleep(wait_time)
 
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(html)
-            print(f"  保存先: {file_path}")
+        browser.close()
 
-            # --- 再帰リンク探索 ---
-            for link in soup.find_all("a", href=True):
-                href = link["href"]
+    state.finish_run(start_url)
+    state.close()
+    session.close()
+    print("\nダウンロード完了！")
 
-                new_url = urljoin(current_url, href)
-                new_url = new_url.split("#")[0]
 
-                parsed_new = urlparse(new_url)
-                ext = os.path.splitext(parsed_new.path)[1]
+# ---------------------------
+# 非同期クローラー
+# ---------------------------
+class TokenBucket:
+    """
+    ホスト単位のアクセス間隔制御。
+    rate 件/秒でトークンが補充され、最大 capacity 件までまとめて送れる。
+    """
 
-                if (
-                    parsed_new.netloc == allowed_domain and
-                    new_url.startswith(start_url) and
-                    new_url not in visited_urls and
-                    (ext == "" or ext == ".html")
-                ):
-                    urls_to_visit.add(new_url)
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
-            time.sleep(wait_time)
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-        browser.close()
 
-    print("\nダウンロード完了！")
+@telemetry.traced("crawl")
+async def async_recursive_download(
+    start_url, output_dir, allowed_domain,
+    concurrency=8, rate=4.0, burst=4, http_fast_path=True, state_path=DEFAULT_DB_PATH
+):
+    """
+    recursive_download の並行版。
+
+    concurrency 個のワーカーがそれぞれ専用のブラウザコンテキストを持ち、
+    ホストごとのトークンバケット (rate 件/秒, 最大 burst 件) でアクセス間隔を守る。
+    http_fast_path が True なら、まず通常の HTTP GET で取得し、
+    本文が含まれていればブラウザを使わずに保存する。
+    HTTP 取得は前回の ETag / Last-Modified 付きの条件付きリクエストで行い、
+    304 のページはローカルの保存済み HTML を使う。http_fast_path が False のときは
+    recursive_download と同じく、検証子が無いページには HTTP で問い合わせずにブラウザで開く。
+    """
+    from playwright.async_api import async_playwright
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    state = CrawlState(state_path)
+    run_id, resumed = state.begin_run(start_url)
+    pending = state.pending(start_url)
+    visited = state.visited(run_id)
+    if resumed:
+        print(f"↩ 前回の中断地点から再開します (訪問済み {len(visited)} 件, 未訪問 {len(pending)} 件)")
+
+    queue = asyncio.Queue()
+    seen_urls = visited | set(pending)
+    for url in pending:
+        queue.put_nowait(url)
+
+    buckets = {}
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    stats = {"http": 0, "browser": 0, "not_modified": 0, "error": 0}
+
+    async with async_playwright() as pw:
+        browser = None
+        browser_lock = asyncio.Lock()
+
+        async def get_browser():
+            # 全ページが HTTP で取れる場合はブラウザを起動しない
+            nonlocal browser
+            async with browser_lock:
+                if browser is None:
+                    browser = await pw.chromium.launch(headless=True)
+            return browser
+
+        async def fetch_http(url, file_path):
+            # SQLite はイベントループのスレッドからだけ触り、HTTP だけをスレッドで行う
+            headers = state.conditional_headers(url, file_path)
+            if not headers and not http_fast_path:
+                # 本文はどのみちブラウザで取るので、304 になりえないページに GET は送らない
+                return "skipped", None, None
+
+            def get():
+                status, resp = conditional_get(session, url, headers)
+                html = static_html(resp) if status == "ok" and http_fast_path else None
+                return status, resp, html
+            return await asyncio.to_thread(get)
+
+        async def worker():
+            page = None
+            try:
+                while True:
+                    url = await queue.get()
+                    try:
+                        host = urlparse(url).netloc
+                        bucket = buckets.setdefault(host, TokenBucket(rate, burst))
+                        await bucket.acquire()
+                        print(f"訪問中: {url}")
+                        file_path = local_file_path(url, output_dir)
+
+                        try:
+                            status, resp, html = await fetch_http(url, file_path)
+                        except requests.RequestException as e:
+                            print(f"  HTTP 取得失敗、ブラウザで再試行します ({e})")
+                            status, resp, html = "error", None, None
+
+                        if status == "not_modified":
+                            print("  変更なし (304)")
+                            stats["not_modified"] += 1
+                            telemetry.count("crawl_pages", result="not_modified")
+                            html = await asyncio.to_thread(read_local_html, file_path)
+                            info = (None, None, None)
+                        elif html is not None:
+                            stats["http"] += 1
+                            info = store_page(state, url, html, file_path, resp.headers)
+                        else:
+                            if page is None:
+                                context = await (await get_browser()).new_context()
+                                page = await context.new_page()
+                            response = await page.goto(url, timeout=30000)
+                            await page.wait_for_load_state("networkidle")
+                            html = await page.content()
+                            stats["browser"] += 1
+                            info = store_page(state, url, html, file_path,
+                                              response.headers if response is not None else None)
+
+                        links = await asyncio.to_thread(extract_links, html, url, start_url, allowed_domain)
+                        new_urls = links - seen_urls
+                        seen_urls |= new_urls
+                        state.add_urls(start_url, new_urls)
+                        state.mark_visited(start_url, url, run_id, *info)
+                        for new_url in new_urls:
+                            queue.put_nowait(new_url)
+
+                    except Exception as e:
+                        stats["error"] += 1
+                        telemetry.count("crawl_pages", result="error")
+                        print(f"  エラー: スキップします ({url}: {e})")
+                        state.mark_visited(start_url, url, run_id)
+                    finally:
+                        queue.task_done()
+            finally:
+                if page is not None:
+                    await page.context.close()
+
+        workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+        await queue.join()
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        if browser is not None:
+            await browser.close()
+
+    state.finish_run(start_url)
+    state.close()
+    session.close()
+    telemetry.current_span().set(**stats)
+    print(f"\nダウンロード完了！ (HTTP: {stats['http']}, ブラウザ: {stats['browser']}, "
+          f"変更なし: {stats['not_modified']}, エラー: {stats['error']})")
+
+
+def download(start_url, output_dir, allowed_domain, args):
+    if args.use_async:
+        asyncio.run(async_recursive_download(
+            start_url=start_url,
+            output_dir=output_dir,
+            allowed_domain=allowed_domain,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            http_fast_path=not args.browser_only
+        ))
+    else:
+        recursive_download(
+            start_url=start_url,
+            output_dir=output_dir,
+            allowed_domain=allowed_domain
+        )
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ドキュメント HTML の再帰ダウンロード")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="並行クローラーを使う")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="並行ワーカー数 (--async 時)")
+    parser.add_argument("--rate", type=float, default=4.0,
+                        help="ホストあたりの最大リクエスト数/秒 (--async 時)")
+    parser.add_argument("--browser-only", action="store_true",
+                        help="HTTP での高速取得を使わず常にブラウザで描画する (--async 時)")
+    args = parser.parse_args()
 
     print("\n--- Google Apps Script ドキュメント ---")
-    recursive_download(
+    download(
         start_url="https://developers.google.com/apps-script/reference/",
         output_dir="gas_docs_html",
-        allowed_domain="developers.google.com"
+        allowed_domain="developers.google.com",
+        args=args
     )
 
     print("\n" + "=" * 60 + "\n")
 
     print("--- Gemini API ドキュメント ---")
-    recursive_download(
+    download(
         start_url="https://ai.google.dev/gemini-api/docs/",
         output_dir="gemini_api_docs_html",
-        allowed_domain="ai.google.dev"
+        allowed_domain="ai.google.dev",
+        args=args
     )
@@ -1,75 +1,234 @@
-import os
-from google import genai
+import argparse
+from google.genai import types
+
+import gemini_client
+import rag_index
+import telemetry
+from answer_cache import AnswerCache
+from context_cache import GeminiContextCache
+from hybrid_search import DEFAULT_BUDGET_MS, EMBED_WORKERS, HybridRetriever, build_retriever, get_reranker
 
 # ---------------------------
-# API キー読み込み
+# API クライアント (GOOGLE_API_KEY / GEMINI_API_KEY から作る、プロセスで共有のもの)
 # ---------------------------
-api_key = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
-
-if not api_key:
-    print("❌ APIキーが見つかりません。環境変数に GEMINI_API_KEY または GOOGLE_API_KEY を設定してください。")
-    exit()
-
-client = genai.Client(api_key=api_key)
+# キーが無くても import はできるようにする (rag_server.py をスタブのモデルで動かす場合など)
+client = gemini_client.default_client()
 
 # ---------------------------
-# RAG 文書読み込み
+# RAG インデックス読み込み
 # ---------------------------
-DOC_PATH = "gas_docs_txt/gas_all.txt"
+# コーパス全体ではなく、質問に関連する上位 TOP_K チャンクだけをプロンプトに入れる
+TOP_K = 8
 
-if not os.path.exists(DOC_PATH):
-    print(f"❌ RAG ドキュメントが見つかりません: {DOC_PATH}")
+if not rag_index.list_source_files():
+    print(f"❌ RAG ドキュメントが見つかりません: {', '.join(rag_index.DOC_DIRS)}")
     print("HTML → TXT 変換（local_html2text.py）を実行しましたか？")
     exit()
 
-with open(DOC_PATH, "r", encoding="utf-8") as f:
-    GAS_TEXT_DATA = f.read()
+INDEX = rag_index.load_or_build_index()
+# 既定は BM25 + 再ランク。configure_retrieval() でベクトル検索を加えられる
+RETRIEVER = HybridRetriever(INDEX, reranker=get_reranker())
+
+
+def configure_retrieval(embedder_name=None, rerank=True, budget_ms=DEFAULT_BUDGET_MS, index=None,
+                        workers=EMBED_WORKERS):
+    """
+    検索方式を切り替える (embedder_name を指定すると BM25 + ベクトルのハイブリッド検索)。
+    index を指定すると、そのインデックスから検索する (benchmark.py が別のコーパスで使う)。
+    workers は検索を同時に呼ぶスレッドの数 (rag_server.py の --retrieval-workers)。
+    """
+    global INDEX, RETRIEVER
+    if index is not None:
+        INDEX = index
+    kwargs = {"client": client} if embedder_name == "gemini" and client is not None else {}
+    RETRIEVER.close()
+    RETRIEVER = build_retriever(INDEX, embedder_name, rerank=rerank, budget_ms=budget_ms,
+                                workers=workers, **kwargs)
+
+
+def build_context(question: str, k: int = TOP_K) -> tuple[str, dict]:
+    """質問に関連するチャンクを出典付きで連結する。検索の trace (HybridRetriever.search() を参照) も返す"""
+    results, trace = RETRIEVER.search(question, k=k)
+    parts = []
+    for _score, chunk in results:
+        parts.append(f"--- 出典: {chunk['source']} ---\n{chunk['text']}")
+    return "\n\n".join(parts), trace
 
 
 # ---------------------------
 # RAG 回答生成
 # ---------------------------
-def answer_with_rag(question: str) -> str:
-    prompt = f"""
-あなたは Google Apps Script 専門アシスタントです。
+MODEL = "gemini-2.0-flash"
+
+SYSTEM_INSTRUCTION = """あなたは Google Apps Script 専門アシスタントです。
 
-以下は GAS の公式ドキュメントから自動生成されたテキストデータです。
-これを参考にして、ユーザーの質問にできるだけ正確に答えてください。
+以下は GAS の公式ドキュメントから、質問に関連する部分を抜粋したテキストデータです。
+これを参考にして、ユーザーの質問にできるだけ正確に答えてください。"""
+
+
+def build_request(question: str, context_cache=None):
+    """
+    generate_content に渡す (contents, config) を作る。
+
+    context_cache (context_cache.ContextCache) が指定されていれば、
+    システム指示 + ドキュメント部分をキャッシュし、質問文だけを送る。
+    同じチャンクの組が選ばれた 2 回目以降はドキュメントを再送しない。
+    """
+    with telemetry.span("retrieval") as span:
+        context, trace = build_context(question)
+        span.set(context_chars=len(context), skipped=",".join(trace["skipped"]))
+    return build_prompt(question, context, context_cache)
+
+
+def build_prompt(question: str, context: str, context_cache=None):
+    """検索済みの context から (contents, config) を作る (build_request() の後半)"""
+    cache_name = None
+    if context_cache is not None:
+        cache_name = context_cache.get(MODEL, SYSTEM_INSTRUCTION, f"【ドキュメント】\n{context}")
+
+    if cache_name is not None:
+        prompt = f"""
+【質問】
+{question}
+
+【回答】
+"""
+        return prompt, types.GenerateContentConfig(cached_content=cache_name)
+
+    prompt = f"""
+{SYSTEM_INSTRUCTION}
 
 【ドキュメント】
-{GAS_TEXT_DATA}
+{context}
 
 【質問】
 {question}
 
 【回答】
 """
+    return prompt, None
+
+
+def corpus_version() -> str:
+    """回答キャッシュのキーに使う版 (モデル + インデックスの元になったファイル群 + 検索方式)"""
+    return f"{MODEL}:{INDEX.fingerprint}:{RETRIEVER.name}"
+
+
+def token_counts(prompt: str, text: str, usage=None) -> tuple[int, int]:
+    """(入力, 出力) のトークン数。usage_metadata が無ければ文字数からの概算"""
+    prompt_tokens = getattr(usage, "prompt_token_count", None) or gemini_client.estimate_tokens(prompt)
+    response_tokens = getattr(usage, "candidates_token_count", None) or gemini_client.estimate_tokens(text)
+    return prompt_tokens, response_tokens
+
+
+@telemetry.traced("answer_with_rag")
+def answer_with_rag(question: str, context_cache=None, answer_cache=None) -> str:
+    span = telemetry.current_span()
+    if answer_cache is not None:
+        cached = answer_cache.get(question)
+        span.set(answer_cache_hit=cached is not None)
+        if cached is not None:
+            return cached
+
+    prompt, config = build_request(question, context_cache)
+    span.set(context_cached=config is not None)
 
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt
-    )
+    with telemetry.span("model", model=MODEL) as model_span:
+        response = client.generate(prompt, model=MODEL, config=config)
+        prompt_tokens, response_tokens = token_counts(prompt, response.text or "", response.usage_metadata)
+        model_span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
 
+    if answer_cache is not None and response.text:
+        answer_cache.put(question, response.text)
     return response.text
 
 
+def stream_answer_with_rag(question: str, context_cache=None, answer_cache=None):
+    """回答を生成されたそばから少しずつ返すジェネレーター"""
+    with telemetry.span("stream_answer_with_rag") as span:
+        if answer_cache is not None:
+            cached = answer_cache.get(question)
+            span.set(answer_cache_hit=cached is not None)
+            if cached is not None:
+                yield cached
+                return
+
+        prompt, config = build_request(question, context_cache)
+        span.set(context_cached=config is not None)
+
+        parts = []
+        usage = None
+        with telemetry.span("model", model=MODEL) as model_span:
+            for chunk in client.stream(prompt, model=MODEL, config=config):
+                usage = chunk.usage_metadata or usage
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+            prompt_tokens, response_tokens = token_counts(prompt, "".join(parts), usage)
+            model_span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+
+        if answer_cache is not None and parts:
+            answer_cache.put(question, "".join(parts))
+
+
 # ---------------------------
-# メイン処理（API 使用は1回のみ）
+# メイン処理
 # ---------------------------
 if __name__ == "__main__":
-    print("質問を入力してください（Enterのみで終了）:")
-
-    while True:
-        question = input(">> ")
+    parser = argparse.ArgumentParser(description="GAS ドキュメント RAG")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="回答を最後にまとめて表示する")
+    parser.add_argument("--cache", action="store_true",
+                        help="Gemini のコンテキストキャッシュでドキュメント部分を使い回す")
+    parser.add_argument("--no-answer-cache", action="store_true",
+                        help="過去の回答を再利用しない")
+    parser.add_argument("--similarity", type=float, default=None,
+                        help="この類似度 (0〜1) 以上の過去の質問の回答も再利用する")
+    parser.add_argument("--embedder", default=None,
+                        help="BM25 と併用するベクトル検索の埋め込みバックエンド (hashing / gemini)")
+    parser.add_argument("--no-rerank", action="store_true", help="検索結果の再ランクを行わない")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS,
+                        help="1 回の検索の時間の予算 (ミリ秒)。超えそうな段階は省略する")
+    args = parser.parse_args()
+
+    if client is None:
+        print("❌ APIキーが見つかりません。環境変数に GEMINI_API_KEY または GOOGLE_API_KEY を設定してください。")
+        exit()
+
+    if args.embedder is not None or args.no_rerank or args.budget_ms != DEFAULT_BUDGET_MS:
+        configure_retrieval(args.embedder, rerank=not args.no_rerank, budget_ms=args.budget_ms)
+
+    context_cache = GeminiContextCache(client) if args.cache else None
+    answer_cache = None
+    if not args.no_answer_cache:
+        answer_cache = AnswerCache(corpus_version=corpus_version(), similarity=args.similarity)
 
-        if question.strip() == "":
-            print("終了します。")
-            break
-
-        print("\n--- 回答 ---")
+    print("質問を入力してください（Enterのみで終了）:")
 
-        try:
-            answer = answer_with_rag(question)
-            print(answer)
-        except Exception as e:
-            print("❌ エラー:", e)
+    try:
+        while True:
+            question = input(">> ")
+
+            if question.strip() == "":
+                print("終了します。")
+                break
+
+            print("\n--- 回答 ---")
+
+            try:
+                if args.no_stream:
+                    answer = answer_with_rag(question, context_cache, answer_cache)
+                    print(answer)
+                else:
+                    for text in stream_answer_with_rag(question, context_cache, answer_cache):
+                        print(text, end="", flush=True)
+                    print()
+            except Exception as e:
+                print("❌ エラー:", e)
+    finally:
+        RETRIEVER.close()
+        if context_cache is not None:
+            context_cache.close()
+        if answer_cache is not None:
+            answer_cache.close()
+        client.close()
@@ -0,0 +1,290 @@
+# rag_index.py
+"""
+変換済みドキュメント (gas_docs_txt / gemini_api_docs_txt) をチャンクに分割し、
+BM25 の転置インデックスをディスク上に構築・保存するモジュール。
+保存形式は corpus_pack のパック形式で、読み込みは mmap するだけなので速く、
+複数のプロセスで同じファイルを開いてもメモリは共有される。
+Apps Script リファレンスは元の HTML (gas_docs_html) があれば、gas_chunker で
+クラス・メソッド単位に分割したチャンクを使う。
+
+query_rag.py はこのインデックスから質問に関連する上位 k 件のチャンクだけを
+取り出してプロンプトに入れる（コーパス全体を毎回送らない）。
+
+使い方:
+    python rag_index.py            # インデックスを (再) 構築
+    python rag_index.py "質問文"    # 検索結果を確認
+    python rag_index.py --compress zstd   # チャンク本文を圧縮して (再) 構築
+"""
+import argparse
+import glob
+import hashlib
+import heapq
+import math
+import os
+import re
+
+from corpus_pack import COMPRESSIONS, PackFile, write_pack
+
+# ---------------------------
+# 定数
+# ---------------------------
+DOC_DIRS = ["gas_docs_txt", "gemini_api_docs_txt"]
+# 結合ファイルは個別ファイルと内容が重複するので索引対象外
+MERGED_FILENAMES = {"gas_all.txt", "gemini_all.txt"}
+
+INDEX_DIR = "rag_index"
+# チャンク本文と転置インデックスをまとめたパック形式 (corpus_pack)。mmap で開くので起動が速い
+INDEX_PATH = os.path.join(INDEX_DIR, "bm25.pack")
+INDEX_FORMAT_VERSION = 3
+# TXT フォルダの代わりに、元の HTML を構造に沿って分割して索引するもの
+STRUCTURED_SOURCES = {"gas_docs_txt": "gas_docs_html"}
+
+CHUNK_CHARS = 1500     # 1 チャンクのおおよその最大文字数
+CHUNK_OVERLAP = 200    # 前チャンク末尾から持ち越す文字数
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_WORD_RE = re.compile(r"[A-Za-z][A-Za-z0-9_]*|\d+")
+# getActiveRange → get / active / range
+_CAMEL_RE = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+")
+# ひらがな・カタカナ・漢字の連続 (日本語の質問向けに bi-gram 化する)
+_CJK_RE = re.compile(r"[぀-ヿ㐀-鿿]+")
+
+
+# ---------------------------
+# トークン化 / チャンク分割
+# ---------------------------
+def tokenize(text: str) -> list[str]:
+    """
+    英数字の単語（小文字化）、camelCase の分割結果、日本語の bi-gram を返す。
+
+    HTML → TXT 変換後のテキストでは "get\\nActive\\nRange()" のように
+    識別子が改行で分断されていることがあるため、camelCase の部分語も索引する。
+    """
+    tokens = []
+    for m in _WORD_RE.finditer(text):
+        word = m.group()
+        tokens.append(word.lower())
+        parts = _CAMEL_RE.findall(word)
+        if len(parts) > 1:
+            tokens.extend(p.lower() for p in parts)
+
+    for m in _CJK_RE.finditer(text):
+        s = m.group()
+        if len(s) == 1:
+            tokens.append(s)
+        else:
+            tokens.extend(s[i:i + 2] for i in range(len(s) - 1))
+    return tokens
+
+
+def chunk_text(text: str, max_chars: int = CHUNK_CHARS, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    """空行を除いた行単位でテキストを max_chars 前後のチャンクに分割する"""
+    lines = [line.strip() for line in text.splitlines()]
+    lines = [line for line in lines if line]
+
+    chunks = []
+    current = []
+    size = 0
+    for line in lines:
+        if current and size + len(line) + 1 > max_chars:
+            chunks.append("\n".join(current))
+            # 末尾の数行を次のチャンクへ持ち越す（境界で文脈が切れないように）
+            carried = []
+            carried_size = 0
+            for prev in reversed(current):
+                if carried_size + len(prev) + 1 > overlap:
+                    break
+                carried.insert(0, prev)
+                carried_size += len(prev) + 1
+            current = carried
+            size = carried_size
+        current.append(line)
+        size += len(line) + 1
+
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def list_source_files(doc_dirs=DOC_DIRS, structured=True) -> list[str]:
+    """
+    索引対象のファイル一覧（ソート済み）。
+    structured が True なら、STRUCTURED_SOURCES の TXT フォルダは元の HTML に置き換える。
+    """
+    files = []
+    for doc_dir in doc_dirs:
+        html_dir = STRUCTURED_SOURCES.get(doc_dir)
+        if structured and html_dir and os.path.isdir(html_dir):
+            from gas_chunker import list_html_files
+            files.extend(list_html_files(html_dir))
+            continue
+        for path in glob.glob(os.path.join(doc_dir, "*.txt")):
+            if os.path.basename(path) in MERGED_FILENAMES:
+                continue
+            files.append(path.replace(os.sep, "/"))
+    return sorted(files)
+
+
+def corpus_fingerprint(files: list[str]) -> str:
+    """ファイルのパス・サイズ・更新時刻から、コーパスの版を表す文字列を作る"""
+    parts = []
+    for path in files:
+        st = os.stat(path)
+        parts.append(f"{path}:{st.st_size}:{int(st.st_mtime)}")
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+
+# ---------------------------
+# BM25 インデックス
+# ---------------------------
+class BM25Index:
+    """
+    チャンク本文と転置インデックス (term → [[chunk_id, tf], ...]) を保持する。
+    build() はメモリ上のリスト・dict で、load() はパックファイルを mmap した
+    同じ形のビュー (corpus_pack.PackedChunks など) で持つ。
+    """
+
+    def __init__(self, chunks, postings, doc_lengths, fingerprint="", avg_length=None):
+        # [{"source": str, "text": str, ...}, ...]
+        # HTML から作ったチャンクは url / service / class / method などのメタデータも持つ
+        self.chunks = chunks
+        self.postings = postings          # {term: [[chunk_id, tf], ...]}
+        self.doc_lengths = doc_lengths    # [トークン数, ...]
+        self.fingerprint = fingerprint
+        if avg_length is None:
+            n = len(doc_lengths)
+            avg_length = (sum(doc_lengths) / n) if n else 0.0
+        self.avg_length = avg_length
+        self.compression = None           # load() したパックのチャンク本文の圧縮形式
+
+    # --- 構築 ---
+    @classmethod
+    def build(cls, files: list[str], fingerprint: str = "") -> "BM25Index":
+        chunks = []
+        postings = {}
+        doc_lengths = []
+
+        # HTML はページの構造に沿って分割する (重複ページは gas_chunker 側で除かれる)
+        html_files = [path for path in files if path.endswith(".html")]
+        html_chunks = {}
+        if html_files:
+            from gas_chunker import chunk_files
+            html_chunks = dict(chunk_files(html_files))
+
+        for path in files:
+            if path in html_chunks:
+                file_chunks = html_chunks[path]
+                if file_chunks is None:
+                    continue
+            else:
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        file_chunks = [{"source": path, "text": c} for c in chunk_text(f.read())]
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"⚠ 読み込みをスキップ ({path}): {e}")
+                    continue
+
+            for chunk in file_chunks:
+                chunk_id = len(chunks)
+                chunks.append(chunk)
+
+                tokens = tokenize(chunk["text"])
+                doc_lengths.append(len(tokens))
+                tf = {}
+                for t in tokens:
+                    tf[t] = tf.get(t, 0) + 1
+                for t, count in tf.items():
+                    postings.setdefault(t, []).append([chunk_id, count])
+
+        return cls(chunks, postings, doc_lengths, fingerprint)
+
+    # --- 保存 / 読み込み ---
+    def save(self, path: str = INDEX_PATH, compression=None) -> None:
+        """パック形式で保存する。compression ("zlib" / "zstd") を指定するとチャンク本文をブロックごとに圧縮"""
+        meta = {
+            "version": INDEX_FORMAT_VERSION,
+            "fingerprint": self.fingerprint,
+            "avg_length": self.avg_length,
+        }
+        write_pack(path, self.chunks, self.postings, self.doc_lengths, meta, compression)
+
+    @classmethod
+    def load(cls, path: str = INDEX_PATH) -> "BM25Index":
+        """パックファイルを mmap で開く (チャンクは検索で使われたときに初めてデコードされる)"""
+        pack = PackFile(path)
+        if pack.meta.get("version") != INDEX_FORMAT_VERSION:
+            raise ValueError(f"インデックスの形式が古いです: {path}")
+        index = cls(pack.chunks, pack.postings, pack.doc_lengths,
+                    pack.meta["fingerprint"], pack.meta["avg_length"])
+        index.compression = pack.compression
+        return index
+
+    # --- 検索 ---
+    def search(self, query: str, k: int = 8) -> list[tuple[float, dict]]:
+        """BM25 スコア上位 k 件を (score, chunk) のリストで返す"""
+        return [(score, self.chunks[chunk_id]) for score, chunk_id in self.search_ids(query, k)]
+
+    def search_ids(self, query: str, k: int = 8) -> list[tuple[float, int]]:
+        """BM25 スコア上位 k 件を (score, chunk_id) のリストで返す"""
+        n = len(self.chunks)
+        if n == 0:
+            return []
+
+        scores = {}
+        for term in set(tokenize(query)):
+            plist = self.postings.get(term)
+            if not plist:
+                continue
+            idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+            for chunk_id, tf in plist:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[chunk_id] / self.avg_length)
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        top = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [(score, chunk_id) for chunk_id, score in top]
+
+
+def load_or_build_index(path: str = INDEX_PATH, doc_dirs=DOC_DIRS, compression=None) -> BM25Index:
+    """
+    保存済みインデックスを読み込む。無い場合やコーパスが更新されている場合は
+    再構築して保存する。compression (チャンク本文の圧縮形式) を指定した場合は、
+    保存済みのパックの形式が違えばそれも再構築する (None なら保存済みの形式のまま使う)。
+    """
+    files = list_source_files(doc_dirs)
+    fingerprint = corpus_fingerprint(files)
+
+    if os.path.exists(path):
+        try:
+            index = BM25Index.load(path)
+            if index.fingerprint != fingerprint:
+                print("🔄 ドキュメントが更新されているためインデックスを再構築します")
+            elif compression is not None and index.compression != compression:
+                print(f"🔄 圧縮形式を変更するためインデックスを再構築します "
+                      f"({index.compression or 'なし'} → {compression})")
+            else:
+                return index
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠ インデックスを読み込めません。再構築します: {e}")
+
+    print(f"📚 インデックス構築中: {len(files)} ファイル")
+    index = BM25Index.build(files, fingerprint)
+    index.save(path, compression)
+    print(f"✔ インデックス保存: {path} ({len(index.chunks)} チャンク)")
+    # 保存したファイルを mmap で開き直し、構築時のリストや dict は手放す
+    return BM25Index.load(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RAG 用 BM25 インデックス")
+    parser.add_argument("query", nargs="*", help="検索する質問文 (省略時は構築のみ)")
+    parser.add_argument("--compress", choices=[c for c in COMPRESSIONS if c], default=None,
+                        help="チャンク本文をブロックごとに圧縮する (保存済みの形式と違えば再構築する)")
+    args = parser.parse_args()
+
+    idx = load_or_build_index(compression=args.compress)
+    if args.query:
+        q = " ".join(args.query)
+        for score, chunk in idx.search(q, k=5):
+            print(f"\n[{score:.2f}] {chunk['source']}")
+            print(chunk["text"][:300])
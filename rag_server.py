@@ -0,0 +1,430 @@
+# rag_server.py
+"""
+RAG の回答 (query_rag.py) を HTTP で提供する asyncio サーバー。
+
+1 プロセスでチームの同時利用をさばくため、
+
+  - モデルの呼び出しは 1 つの共有クライアント (接続プールを持つ) から非同期に行い、
+    同時に送るリクエスト数は --max-concurrency までに抑える
+  - 検索 (BM25 / ベクトル / 再ランク) は CPU を使うのでスレッドプールで実行し、
+    イベントループを止めない
+  - 同じ質問 (answer_cache.normalize_question で正規化して同じもの) が処理中なら
+    新たにモデルを呼ばず、処理中の回答を共有する (ストリーミングでも途中から合流できる)
+  - 回答はモデルが生成したそばから chunked 転送で返せる
+
+モデルのクライアントは ModelClient を実装したものに差し替えられる。
+--stub を付けると API を呼ばない StubModelClient で起動する (API キー無しでの動作確認や、
+合流・同時実行数の上限の様子を手元で見るとき用)。
+
+エンドポイント:
+    POST /ask      {"question": "...", "stream": false}
+                   → {"answer": "...", "coalesced": false}
+                   stream が true なら text/plain の chunked レスポンスで少しずつ返す
+    GET  /health   → {"status": "ok", ...統計}
+    GET  /metrics  → Prometheus 形式の計測値 (telemetry.py。計測が有効なときだけ値が入る)
+
+使い方:
+    python rag_server.py --port 8080
+    python rag_server.py --stub --port 8080
+    curl -s localhost:8080/ask -d '{"question": "getValues の戻り値は？"}'
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import sys
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import query_rag
+import telemetry
+from answer_cache import DEFAULT_DB_PATH, AnswerCache, normalize_question
+from gemini_client import GeminiClient
+
+# ---------------------------
+# 定数
+# ---------------------------
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+MAX_CONCURRENCY = 16         # 同時に処理するモデル呼び出しの上限
+RETRIEVAL_WORKERS = 4        # 検索を実行するスレッド数
+MAX_BODY_BYTES = 64 * 1024   # リクエスト本文の上限
+KEEP_ALIVE_TIMEOUT = 30      # keep-alive の接続で次のリクエストを待つ秒数
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+# ---------------------------
+# モデルのクライアント
+# ---------------------------
+class ModelClient(ABC):
+    """モデル呼び出しの共通インターフェース。stream() は生成された文字列を少しずつ返す非同期イテレーター"""
+
+    name = ""
+
+    @abstractmethod
+    def stream(self, prompt: str, config=None):
+        """生成された文字列を少しずつ返す非同期イテレーター (async def + yield で実装する)"""
+
+    async def close(self) -> None:
+        """接続プールなどを閉じる"""
+
+
+class GeminiModelClient(ModelClient):
+    """
+    gemini_client.GeminiClient の非同期 API を使う実装。クライアントはサーバー全体で 1 つを共有し、
+    再試行と RPM / TPM の予算もそちらで扱う。
+    """
+
+    def __init__(self, client: GeminiClient, model: str = query_rag.MODEL):
+        self.client = client
+        self.model = model
+        self.name = model
+
+    async def stream(self, prompt, config=None):
+        async for chunk in self.client.astream(prompt, model=self.model, config=config):
+            if chunk.text:
+                yield chunk.text
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class StubModelClient(ModelClient):
+    """
+    API を呼ばないスタブ。latency 秒待ってから、プロンプトの要約を
+    chunk_delay 秒ごとに少しずつ返す (rag_server.py --stub で使う)。
+    """
+
+    name = "stub"
+
+    def __init__(self, latency: float = 0.5, chunk_delay: float = 0.02, chunks: int = 10):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunks = chunks
+        self.calls = 0
+
+    async def stream(self, prompt, config=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        sources = prompt.count("--- 出典:")
+        text = f"（スタブ回答）プロンプト {len(prompt)} 文字、出典 {sources} 件を受け取りました。"
+        step = max(1, len(text) // self.chunks)
+        for start in range(0, len(text), step):
+            if start:
+                await asyncio.sleep(self.chunk_delay)
+            yield text[start:start + step]
+
+
+# ---------------------------
+# 処理中の回答 (同じ質問で共有する)
+# ---------------------------
+class InflightAnswer:
+    """生成中の回答。producer が append() し、何人でも parts() で最初から順に読める"""
+
+    def __init__(self):
+        self.parts_so_far = []
+        self.done = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def append(self, text):
+        self.parts_so_far.append(text)
+        self._notify()
+
+    def finish(self, error=None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def parts(self):
+        i = 0
+        while True:
+            while i < len(self.parts_so_far):
+                yield self.parts_so_far[i]
+                i += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+    async def text(self) -> str:
+        return "".join([part async for part in self.parts()])
+
+
+# ---------------------------
+# 回答サービス
+# ---------------------------
+class RagService:
+    """
+    answer_with_rag() の非同期版。検索・プロンプト作成は query_rag の関数を
+    スレッドプールで呼び、モデルの呼び出しは model_client で行う。
+    """
+
+    def __init__(self, model_client: ModelClient, answer_cache: AnswerCache = None,
+                 max_concurrency: int = MAX_CONCURRENCY, retrieval_workers: int = RETRIEVAL_WORKERS):
+        self.model_client = model_client
+        self.answer_cache = answer_cache   # SQLite なのでイベントループのスレッドからだけ使う
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.retrieval_pool = ThreadPoolExecutor(max_workers=retrieval_workers,
+                                                 thread_name_prefix="retrieval")
+        self.inflight = {}   # 正規化した質問 → InflightAnswer
+        self._tasks = set()  # 実行中の生成タスク (参照を持っておかないと途中で回収される)
+        self.stats = {"requests": 0, "coalesced": 0, "cache_hits": 0, "model_calls": 0, "errors": 0}
+
+    async def close(self):
+        self.retrieval_pool.shutdown(wait=False, cancel_futures=True)
+        await self.model_client.close()
+        if self.answer_cache is not None:
+            self.answer_cache.close()
+
+    def ask(self, question: str) -> tuple[InflightAnswer, bool]:
+        """質問の回答 (生成中のものを含む) と、既存の処理に合流したかどうかを返す"""
+        self.stats["requests"] += 1
+        key = normalize_question(question)
+        entry = self.inflight.get(key)
+        if entry is not None:
+            self.stats["coalesced"] += 1
+            telemetry.count("rag_server_requests", coalesced="true")
+            return entry, True
+        telemetry.count("rag_server_requests", coalesced="false")
+
+        entry = InflightAnswer()
+        self.inflight[key] = entry
+        # クライアントが切断しても、合流した他のリクエストのために最後まで生成する
+        task = asyncio.get_running_loop().create_task(self._produce(key, question, entry))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return entry, False
+
+    @telemetry.traced("rag_server.answer")
+    async def _produce(self, key, question, entry):
+        span = telemetry.current_span()
+        try:
+            if self.answer_cache is not None:
+                cached = self.answer_cache.get(question)
+                span.set(answer_cache_hit=cached is not None)
+                if cached is not None:
+                    self.stats["cache_hits"] += 1
+                    entry.append(cached)
+                    entry.finish()
+                    return
+
+            loop = asyncio.get_running_loop()
+            # 検索のスパンがこのスパンの子になるよう、コンテキストを引き継いでスレッドで実行する
+            prompt, config = await loop.run_in_executor(
+                self.retrieval_pool, contextvars.copy_context().run, query_rag.build_request, question
+            )
+
+            async with self.semaphore:
+                self.stats["model_calls"] += 1
+                with telemetry.span("model", model=self.model_client.name) as model_span:
+                    async for text in self.model_client.stream(prompt, config):
+                        entry.append(text)
+                    answer = "".join(entry.parts_so_far)
+                    prompt_tokens, response_tokens = query_rag.token_counts(prompt, answer)
+                    model_span.set(prompt_tokens=prompt_tokens, response_tokens=response_tokens)
+
+            if self.answer_cache is not None and entry.parts_so_far:
+                self.answer_cache.put(question, "".join(entry.parts_so_far))
+            entry.finish()
+        except asyncio.CancelledError as e:
+            # 終了時などに取り消された場合も、合流して待っているリクエストを起こしてから抜ける
+            entry.finish(e)
+            raise
+        except Exception as e:
+            self.stats["errors"] += 1
+            span.fail(e)
+            print(f"❌ 回答の生成に失敗 ({question[:40]}): {e}", file=sys.stderr)
+            entry.finish(e)
+        finally:
+            self.inflight.pop(key, None)
+
+
+# ---------------------------
+# HTTP
+# ---------------------------
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+async def read_request(reader):
+    """HTTP/1.1 のリクエストを 1 つ読む。接続が閉じられたら None"""
+    request_line = await reader.readline()
+    if not request_line.strip():
+        return None
+    try:
+        method, target, version = request_line.decode("latin-1").split()
+    except ValueError:
+        raise HttpError(400, "不正なリクエスト行です")
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HttpError(400, "不正な Content-Length です")
+    if length < 0:
+        raise HttpError(400, "不正な Content-Length です")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, "リクエスト本文が大きすぎます")
+    body = await reader.readexactly(length) if length else b""
+    return method, urlsplit(target).path, version, headers, body
+
+
+def _head(status, content_type, keep_alive, extra=()):
+    lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+             f"Content-Type: {content_type}",
+             f"Connection: {'keep-alive' if keep_alive else 'close'}",
+             *extra]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer, status, obj, keep_alive=True):
+    body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    writer.write(_head(status, "application/json; charset=utf-8", keep_alive,
+                       [f"Content-Length: {len(body)}"]) + body)
+    await writer.drain()
+
+
+async def send_stream(writer, parts, keep_alive=True):
+    """parts (非同期イテレーター) の文字列を chunked 転送で送る"""
+    writer.write(_head(200, "text/plain; charset=utf-8", keep_alive, ["Transfer-Encoding: chunked"]))
+    try:
+        async for text in parts:
+            data = text.encode("utf-8")
+            writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+            await writer.drain()
+    except Exception as e:
+        # ヘッダーは送信済みなので、本文の末尾にエラーを付けて終える
+        data = f"\n❌ エラー: {e}".encode("utf-8")
+        writer.write(f"{len(data):x}\r\n".encode("latin-1") + data + b"\r\n")
+    writer.write(b"0\r\n\r\n")
+    await writer.drain()
+
+
+class RagServer:
+    def __init__(self, service: RagService):
+        self.service = service
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), KEEP_ALIVE_TIMEOUT)
+                except HttpError as e:
+                    await send_json(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                try:
+                    await self.route(writer, method, path, body, keep_alive)
+                except HttpError as e:
+                    await send_json(writer, e.status, {"error": str(e)}, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, writer, method, path, body, keep_alive):
+        if path == "/health":
+            stats = dict(self.service.stats, inflight=len(self.service.inflight),
+                         model=self.service.model_client.name)
+            await send_json(writer, 200, {"status": "ok", **stats}, keep_alive)
+            return
+        if path == "/metrics":
+            body = telemetry.prometheus_text().encode("utf-8")
+            writer.write(_head(200, "text/plain; version=0.0.4; charset=utf-8", keep_alive,
+                               [f"Content-Length: {len(body)}"]) + body)
+            await writer.drain()
+            return
+        if path != "/ask":
+            raise HttpError(404, f"{path} はありません")
+        if method != "POST":
+            raise HttpError(405, "POST で送ってください")
+
+        try:
+            payload = json.loads(body or b"{}")
+            question = str(payload["question"]).strip()
+        except (ValueError, KeyError, TypeError):
+            raise HttpError(400, '本文は {"question": "..."} の JSON にしてください')
+        if not question:
+            raise HttpError(400, "question が空です")
+
+        entry, coalesced = self.service.ask(question)
+        if payload.get("stream"):
+            await send_stream(writer, entry.parts(), keep_alive)
+            return
+        try:
+            answer = await entry.text()
+        except Exception as e:
+            await send_json(writer, 500, {"error": str(e)}, keep_alive)
+            return
+        await send_json(writer, 200, {"answer": answer, "coalesced": coalesced}, keep_alive)
+
+
+async def serve(service: RagService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT):
+    server = await asyncio.start_server(RagServer(service).handle_connection, host, port)
+    print(f"🚀 RAG サーバー起動: http://{host}:{port} (モデル: {service.model_client.name})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GAS ドキュメント RAG の HTTP サーバー")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--stub", action="store_true", help="API を呼ばないスタブのモデルで起動する")
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="スタブが回答を始めるまでの秒数")
+    parser.add_argument("--max-concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="同時に処理するモデル呼び出しの上限")
+    parser.add_argument("--retrieval-workers", type=int, default=RETRIEVAL_WORKERS,
+                        help="検索を実行するスレッド数")
+    parser.add_argument("--no-answer-cache", action="store_true", help="過去の回答を再利用しない")
+    parser.add_argument("--embedder", default=None,
+                        help="BM25 と併用するベクトル検索の埋め込みバックエンド (hashing / gemini)")
+    args = parser.parse_args()
+
+    if args.stub:
+        model_client = StubModelClient(latency=args.stub_latency)
+    elif query_rag.client is None:
+        print("❌ APIキーが見つかりません。環境変数に GEMINI_API_KEY または GOOGLE_API_KEY を設定するか、--stub を付けてください。")
+        exit()
+    else:
+        model_client = GeminiModelClient(query_rag.client)
+
+    if args.embedder is not None:
+        query_rag.configure_retrieval(args.embedder, workers=args.retrieval_workers)
+    answer_cache = None
+    if not args.no_answer_cache:
+        # スタブの回答で本物の回答キャッシュを上書きしないよう、スタブではメモリ上のキャッシュを使う
+        answer_cache = AnswerCache(":memory:" if args.stub else DEFAULT_DB_PATH,
+                                   corpus_version=query_rag.corpus_version())
+
+    service = RagService(model_client, answer_cache, args.max_concurrency, args.retrieval_workers)
+    try:
+        asyncio.run(serve(service, args.host, args.port))
+    except KeyboardInterrupt:
+        print("終了します。")
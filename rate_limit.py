@@ -0,0 +1,114 @@
+# rate_limit.py
+"""
+Gemini API 呼び出しの流量制御と再試行の共通部品。
+
+  - RateLimiter : 直近 60 秒のリクエスト数 (RPM) / トークン数 (TPM) を予算内に抑える
+                  (スレッドからは acquire()、asyncio からは acquire_async() で、同じ予算を共有できる)
+  - retry_delay : 429 などの一時的なエラーの後に待つ秒数 (サーバーのヒント優先)
+
+gemini_client.py (生成・埋め込み・アップロードの共通クライアント) から使う。
+"""
+import asyncio
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import telemetry
+
+# 一時的なエラーとして再試行するもの (google.genai の APIError.code / .status で判定する。
+# メッセージの文字列では判定しない: ファイル名や URI に "429" を含む 404 などを再試行しないため)
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_STATUSES = {"RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL"}
+# エラーメッセージ中のサーバー側の再試行ヒント ("Please retry in 12.3s" / "retry_delay { seconds: 40 }")
+RETRY_HINT_RES = [
+    re.compile(r"retry in ([\d.]+)\s*s", re.IGNORECASE),
+    re.compile(r"retry_delay\s*\{\s*seconds:\s*(\d+)"),
+]
+
+
+class RateLimiter:
+    """
+    直近 60 秒のリクエスト数 (RPM) とトークン数 (TPM) を予算内に抑える。
+    429 を受けたら pause() で全スレッドの送信をまとめて止める。
+    """
+
+    def __init__(self, rpm, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.lock = threading.Lock()
+        self.events = deque()   # (送信時刻, トークン数)
+        self.tokens_in_window = 0
+        self.paused_until = 0.0
+
+    def _reserve(self, tokens):
+        """予算内なら送信を記録して 0 を、そうでなければ待つべき秒数を返す"""
+        with self.lock:
+            now = time.monotonic()
+            while self.events and self.events[0][0] <= now - 60:
+                self.tokens_in_window -= self.events.popleft()[1]
+
+            if now < self.paused_until:
+                return self.paused_until - now
+            if len(self.events) >= self.rpm:
+                return max(self.events[0][0] + 60 - now, 0.01)
+            if self.tpm and self.events and self.tokens_in_window + tokens > self.tpm:
+                return max(self.events[0][0] + 60 - now, 0.01)
+            self.events.append((now, tokens))
+            self.tokens_in_window += tokens
+            return 0.0
+
+    def acquire(self, tokens=0):
+        waited = 0.0
+        while (wait := self._reserve(tokens)) > 0:
+            time.sleep(wait)
+            waited += wait
+        _record_wait(waited)
+
+    async def acquire_async(self, tokens=0):
+        """acquire() の asyncio 版 (待つ間イベントループを止めない)"""
+        waited = 0.0
+        while (wait := self._reserve(tokens)) > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        _record_wait(waited)
+
+    def try_acquire(self, tokens=0) -> bool:
+        """待たずに送れるときだけ送信を記録して True を返す"""
+        return self._reserve(tokens) == 0
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def _record_wait(waited):
+    if waited:
+        telemetry.count("rate_limit_waits")
+        telemetry.count("rate_limit_wait_seconds", waited)
+        telemetry.current_span().add("rate_limit_wait_seconds", waited)
+
+
+def is_retryable(error):
+    """API エラーの HTTP ステータスコード (または gRPC のステータス名) が一時的なものか"""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS_CODES
+    return getattr(error, "status", None) in RETRYABLE_STATUSES
+
+
+def is_quota_error(error):
+    """429 RESOURCE_EXHAUSTED (RPM / TPM の超過) か"""
+    return getattr(error, "code", None) == 429 or getattr(error, "status", None) == "RESOURCE_EXHAUSTED"
+
+
+def retry_delay(error, attempt):
+    """サーバーの再試行ヒントがあればそれを、無ければ指数バックオフ + ジッター"""
+    message = str(error)
+    for pattern in RETRY_HINT_RES:
+        m = pattern.search(message)
+        if m:
+            return float(m.group(1)) + random.uniform(0, 1)
+    base = min(2 ** attempt, 60)
+    return base + random.uniform(0, base / 2)
@@ -0,0 +1,343 @@
+# telemetry.py
+"""
+各スクリプト共通の計測 (スパンとカウンター)。
+
+処理の区間を span() で囲むと、所要時間と属性 (バイト数・トークン数・再試行回数など) が記録される。
+スパンは入れ子にでき (contextvars で親を追う)、count() で名前付きのカウンターを増やせる。
+
+  - JSONL      : 終わったスパンを 1 行ずつ追記する。カウンターと集計はプロセス終了時に 1 行
+  - Prometheus : /metrics でテキスト形式の集計 (スパンの所要時間のヒストグラム・属性の合計・カウンター)
+
+どちらも設定しなければ計測は無効で、span() は何もしないオブジェクトを返すだけなので、
+計測を入れたままでもほとんど遅くならない。設定は configure() か環境変数で行う:
+
+    RAG_TELEMETRY_JSONL=telemetry.jsonl python query_rag.py
+    RAG_TELEMETRY_PORT=9464 python rag_server.py     # http://localhost:9464/metrics
+
+使い方:
+    with telemetry.span("retrieval", k=8) as sp:
+        ...
+        sp.set(prompt_tokens=1234)
+
+    @telemetry.traced("upload_files")
+    def upload_files(...): ...
+"""
+import atexit
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# スパンの所要時間のヒストグラムの区切り (秒)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+METRIC_PREFIX = "rag_"
+
+_current = contextvars.ContextVar("telemetry_span", default=None)
+_ids = itertools.count(1)
+_NAME_RE = re.compile(r"[^a-zA-Z0-9_]")
+
+
+class _Registry:
+    """集計値とエクスポーターの状態 (プロセスに 1 つ)"""
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.counters = {}   # (名前, ((ラベル, 値), ...)) → 値
+        self.spans = {}      # スパン名 → {"count", "sum", "errors", "buckets", "attrs"}
+        self.jsonl = None
+        self.server = None
+
+    def record_span(self, span):
+        with self.lock:
+            stats = self.spans.get(span.name)
+            if stats is None:
+                stats = self.spans[span.name] = {
+                    "count": 0, "sum": 0.0, "errors": 0,
+                    "buckets": [0] * len(DURATION_BUCKETS), "attrs": {},
+                }
+            stats["count"] += 1
+            stats["sum"] += span.duration
+            if span.status != "ok":
+                stats["errors"] += 1
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if span.duration <= bound:
+                    stats["buckets"][i] += 1
+                    break
+            for key, value in span.attrs.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    stats["attrs"][key] = stats["attrs"].get(key, 0) + value
+
+            if self.jsonl is not None:
+                self.jsonl.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def add(self, name, value, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+_registry = _Registry()
+
+
+# ---------------------------
+# スパン
+# ---------------------------
+class Span:
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.span_id = next(_ids)
+        parent = _current.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.status = "ok"
+        self.started_at = time.time()
+        self.duration = 0.0
+        self._started = None
+        self._token = None
+
+    def set(self, **attrs):
+        """属性を設定する (数値の属性はスパン名ごとに合計される)"""
+        self.attrs.update(attrs)
+
+    def add(self, key, value=1):
+        """数値の属性に value を足す"""
+        self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def fail(self, error):
+        """例外にならない失敗 (エラーを文字列で返す関数など) を記録する"""
+        self.status = "error"
+        self.attrs["error"] = str(error)
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self._started
+        if exc_type is not None and not issubclass(exc_type, GeneratorExit):
+            self.status = "error"
+            self.attrs.setdefault("error", f"{exc_type.__name__}: {exc}")
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # ジェネレーターが別のコンテキストで閉じられた場合
+            pass
+        _registry.record_span(self)
+        return False
+
+    def to_dict(self):
+        return {
+            "type": "span",
+            "ts": round(self.started_at, 6),
+            "trace": self.trace_id,
+            "span": self.span_id,
+            "parent": self.parent_id,
+            "pid": os.getpid(),
+            "name": self.name,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "attrs": self.attrs,
+        }
+
+
+class _NoopSpan:
+    """計測が無効なときの span()。何も記録しない"""
+
+    name = ""
+    attrs = {}
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, key, value=1):
+        pass
+
+    def fail(self, error):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, **attrs):
+    """with で囲んだ区間をスパンとして記録する"""
+    if not _registry.enabled:
+        return _NOOP
+    return Span(name, attrs)
+
+
+def current_span():
+    """実行中のスパン (無ければ何もしないスパン)。呼び出し元の関数から属性を足すのに使う"""
+    if not _registry.enabled:
+        return _NOOP
+    return _current.get() or _NOOP
+
+
+def count(name: str, value=1, **labels):
+    """カウンター name (ラベル付き) に value を足す"""
+    if _registry.enabled:
+        _registry.add(name, value, labels)
+
+
+def traced(name: str = None, **attrs):
+    """関数 (async 関数も可) の呼び出し全体をスパンにするデコレーター"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name, **attrs):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(span_name, **attrs):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# ---------------------------
+# エクスポート
+# ---------------------------
+def snapshot() -> dict:
+    """カウンターとスパンの集計の写し"""
+    with _registry.lock:
+        counters = [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(_registry.counters.items())
+        ]
+        spans = {
+            name: {"count": s["count"], "sum_seconds": round(s["sum"], 6),
+                   "errors": s["errors"], "attrs": dict(s["attrs"])}
+            for name, s in sorted(_registry.spans.items())
+        }
+    return {"counters": counters, "spans": spans}
+
+
+def _metric_name(name):
+    return METRIC_PREFIX + _NAME_RE.sub("_", name)
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    parts = []
+    for key, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{_NAME_RE.sub("_", key)}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def prometheus_text() -> str:
+    """Prometheus のテキスト形式 (version 0.0.4) の集計"""
+    lines = []
+    with _registry.lock:
+        seen = set()
+        for (name, labels), value in sorted(_registry.counters.items()):
+            metric = _metric_name(name) + "_total"
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_labels(labels)} {value}")
+
+        if _registry.spans:
+            metric = METRIC_PREFIX + "span_duration_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, s in sorted(_registry.spans.items()):
+                cumulative = 0
+                for bound, n in zip(DURATION_BUCKETS, s["buckets"]):
+                    cumulative += n
+                    le = "+Inf" if bound == math.inf else repr(float(bound))
+                    lines.append(f'{metric}_bucket{_labels([("span", name), ("le", le)])} {cumulative}')
+                lines.append(f'{metric}_sum{_labels([("span", name)])} {s["sum"]}')
+                lines.append(f'{metric}_count{_labels([("span", name)])} {s["count"]}')
+
+            lines.append(f"# TYPE {METRIC_PREFIX}span_errors_total counter")
+            for name, s in sorted(_registry.spans.items()):
+                lines.append(f'{METRIC_PREFIX}span_errors_total{_labels([("span", name)])} {s["errors"]}')
+
+            attr_metrics = {}
+            for name, s in sorted(_registry.spans.items()):
+                for key, value in s["attrs"].items():
+                    attr_metrics.setdefault(_metric_name("span_" + key) + "_total", []).append((name, value))
+            for metric, values in sorted(attr_metrics.items()):
+                lines.append(f"# TYPE {metric} counter")
+                for name, value in values:
+                    lines.append(f'{metric}{_labels([("span", name)])} {value}')
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def flush():
+    with _registry.lock:
+        if _registry.jsonl is not None:
+            _registry.jsonl.flush()
+
+
+def _finish():
+    """プロセス終了時に、カウンターとスパンの集計を JSONL に 1 行書いて閉じる"""
+    if _registry.jsonl is None:
+        return
+    line = dict(type="metrics", ts=round(time.time(), 6), pid=os.getpid(), argv=sys.argv, **snapshot())
+    with _registry.lock:
+        _registry.jsonl.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+        _registry.jsonl.close()
+        _registry.jsonl = None
+
+
+def configure(jsonl_path: str = None, prometheus_port: int = None, host: str = "127.0.0.1") -> None:
+    """計測を有効にし、JSONL の出力先や Prometheus のポートを設定する"""
+    _registry.enabled = True
+    if jsonl_path and _registry.jsonl is None:
+        _registry.jsonl = open(jsonl_path, "a", encoding="utf-8")
+        atexit.register(_finish)
+    if prometheus_port is not None and _registry.server is None:
+        _registry.server = ThreadingHTTPServer((host, prometheus_port), _MetricsHandler)
+        threading.Thread(target=_registry.server.serve_forever, daemon=True,
+                         name="telemetry-metrics").start()
+        print(f"📈 メトリクス: http://{host}:{_registry.server.server_address[1]}/metrics", file=sys.stderr)
+
+
+def enabled() -> bool:
+    return _registry.enabled
+
+
+# 環境変数で指定されていれば、import した時点で有効にする
+if os.getenv("RAG_TELEMETRY_JSONL") or os.getenv("RAG_TELEMETRY_PORT"):
+    configure(os.getenv("RAG_TELEMETRY_JSONL") or None,
+              int(os.environ["RAG_TELEMETRY_PORT"]) if os.getenv("RAG_TELEMETRY_PORT") else None)
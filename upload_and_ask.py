@@ -1,12 +1,12 @@
-import google.generativeai as genai
-import time
 import magic   # ファイルMIME判定
-import os
+
+import gemini_client
 
 # -------------------------------
-# 1. Gemini APIキー設定
+# 1. Gemini クライアント (GOOGLE_API_KEY / GEMINI_API_KEY から作る共有のもの)
 # -------------------------------
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+client = gemini_client.default_client()
+MODEL_NAME = "gemini-2.0-flash"
 
 
 # -------------------------------
@@ -17,12 +17,12 @@ def upload_file_to_gemini(filepath: str):
 
     mime = magic.from_file(filepath, mime=True)
 
-    uploaded_file = genai.files.upload(
-        file=filepath,
+    uploaded_file = client.upload(
+        filepath,
         mime_type=mime
     )
 
-    print(f"✅ アップロード完了: file_id={uploaded_file.file_id}")
+    print(f"✅ アップロード完了: name={uploaded_file.name}")
     return uploaded_file
 
 
@@ -31,15 +31,14 @@ def upload_file_to_gemini(filepath: str):
 # -------------------------------
 def ask_question_with_file(gemini_file, question: str):
 
-    model = genai.GenerativeModel("gemini-2.0-flash")
-
     print("🤖 回答生成中...")
 
-    response = model.generate_content(
+    response = client.generate(
         [
-            gemini_file,
+            gemini_client.file_part(gemini_file),
             question
-        ]
+        ],
+        model=MODEL_NAME
     )
 
     return response.text
@@ -49,6 +48,10 @@ def ask_question_with_file(gemini_file, question: str):
 # 4. メイン処理
 # -------------------------------
 if __name__ == "__main__":
+    if client is None:
+        print("❌ APIキーが見つかりません。環境変数に GOOGLE_API_KEY または GEMINI_API_KEY を設定してください。")
+        exit()
+
     filepath = input("解析したいファイルのパスを入力してください: ")
 
     file_obj = upload_file_to_gemini(filepath)
@@ -0,0 +1,551 @@
+# vector_store.py
+"""
+ドキュメントチャンクの埋め込みベクトルをディスクに保存し、近傍検索するモジュール。
+
+rag_index.py の BM25 インデックスと同じチャンク (同じ chunk_id の順) を埋め込み、
+NumPy の行列として rag_index/vectors/ に保存する。検索時は np.load(mmap_mode="r")
+でメモリマップするので、起動時に全ベクトルを読み込まない。
+
+  - 保存形式 : float32、または行ごとのスケール付き int8 (サイズ 1/4)
+  - 完全検索 : ブロック単位の行列積によるコサイン類似度の総当たり
+  - 近似検索 : 球面 k-means で作る IVF (転置ファイル) 索引。
+               行数が IVF_MIN_ROWS 以上のときに使い、nprobe 個のクラスタだけを調べる
+  - 埋め込み : EMBEDDERS に登録したバックエンドを名前で選ぶ。
+               "hashing" は API を使わない決定的な埋め込み (既定値。API キー無しでもベクトル検索が動く)
+  - API 呼び出し: "gemini" は gemini_client.GeminiClient の embed を通すので、
+               再試行・RPM / TPM の予算は生成の呼び出しと共有される
+  - キャッシュ: API の埋め込みは (モデル, チャンク本文のハッシュ) ごとに
+               EmbeddingCache (SQLite) に保存し、ドキュメント更新後の再構築では
+               新しいチャンク・変更されたチャンクだけを埋め込む
+
+使い方:
+    python vector_store.py                      # ベクトルストアを (再) 構築
+    python vector_store.py "質問文"              # 検索結果を確認
+    python vector_store.py --embedder gemini "質問文"
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+import gemini_client
+import rag_index
+from gemini_client import estimate_tokens
+
+# ---------------------------
+# 定数
+# ---------------------------
+STORE_DIR = os.path.join(rag_index.INDEX_DIR, "vectors")
+STORE_FORMAT_VERSION = 1
+
+HASHING_DIM = 1024          # ハッシュ埋め込みの次元数
+SEARCH_BLOCK_ROWS = 65536   # 総当たり検索で一度に掛け合わせる行数 (メモリ使用量の上限)
+IVF_MIN_ROWS = 20000        # これ以上の行数なら IVF 索引を作って近似検索する
+IVF_ITERATIONS = 10         # k-means の反復回数
+IVF_DEFAULT_NPROBE = 8      # 検索時に調べるクラスタ数
+
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite"
+EMBED_CONCURRENCY = 4       # 同時に送る埋め込みリクエスト数
+EMBED_RPM = 1500            # 埋め込み API の 1 分あたりの最大リクエスト数
+
+
+# ---------------------------
+# 埋め込みバックエンド
+# ---------------------------
+class Embedder(ABC):
+    """
+    埋め込みバックエンドの共通インターフェース。
+    embed() は L2 正規化済みの float32 行列 (len(texts), dim) を返す。
+    """
+
+    name = ""
+    dim = 0
+    max_batch = 256            # 1 回の embed() に渡すテキスト数の上限
+    max_batch_tokens = None    # 1 回の embed() に渡す概算トークン数の上限 (None なら無制限)
+    cacheable = False          # EmbeddingCache に保存する価値があるか (API 呼び出しなら True)
+
+    @abstractmethod
+    def embed(self, texts: list[str], task: str = "document") -> np.ndarray:
+        """task は "document" (索引するチャンク) または "query" (質問文)"""
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+
+class HashingEmbedder(Embedder):
+    """
+    rag_index.tokenize() のトークンを特徴量ハッシュで固定次元に写す埋め込み。
+    API を使わず、同じ入力には常に同じベクトルを返す (crc32 を使うので実行ごとに変わらない)。
+    """
+
+    def __init__(self, dim: int = HASHING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+        self._slots = {}   # token -> (次元, 符号)
+
+    def _slot(self, token):
+        slot = self._slots.get(token)
+        if slot is None:
+            h = zlib.crc32(token.encode("utf-8"))
+            slot = (h % self.dim, 1.0 if (h >> 31) & 1 else -1.0)
+            self._slots[token] = slot
+        return slot
+
+    def embed(self, texts, task="document"):
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tf = {}
+            for t in rag_index.tokenize(text):
+                tf[t] = tf.get(t, 0) + 1
+            for t, count in tf.items():
+                col, sign = self._slot(t)
+                matrix[row, col] += sign * (1.0 + math.log(count))
+        return normalize_rows(matrix)
+
+
+class GeminiEmbedder(Embedder):
+    """Gemini の埋め込みモデルを gemini_client.GeminiClient.embed 経由で使う実装"""
+
+    max_batch = 100            # 1 リクエストで送れるテキスト数の上限
+    max_batch_tokens = 20000
+    cacheable = True
+
+    def __init__(self, client=None, model: str = "text-embedding-004", dim: int = 768):
+        if client is None:
+            client = gemini_client.default_client()
+            if client is None:
+                raise ValueError("GOOGLE_API_KEY (または GEMINI_API_KEY) が設定されていません")
+        self.client = client
+        self.model = model
+        self.dim = dim
+        self.name = f"gemini-{model}-{dim}"
+
+    def embed(self, texts, task="document"):
+        from google.genai import types
+
+        task_type = "RETRIEVAL_QUERY" if task == "query" else "RETRIEVAL_DOCUMENT"
+        vectors = []
+        for start in range(0, len(texts), self.max_batch):
+            result = self.client.embed(
+                texts[start:start + self.max_batch],
+                model=self.model,
+                config=types.EmbedContentConfig(task_type=task_type, output_dimensionality=self.dim),
+            )
+            vectors.extend(e.values for e in result.embeddings)
+        return normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.dim))
+
+
+EMBEDDERS = {
+    "hashing": HashingEmbedder,
+    "gemini": GeminiEmbedder,
+}
+
+
+def get_embedder(name: str = "hashing", **kwargs) -> Embedder:
+    try:
+        return EMBEDDERS[name](**kwargs)
+    except KeyError:
+        raise ValueError(f"未知の埋め込みバックエンドです: {name} (選択肢: {', '.join(EMBEDDERS)})")
+
+
+# ---------------------------
+# 量子化 / IVF
+# ---------------------------
+def quantize_int8(matrix: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """行ごとに最大絶対値が 127 になるよう int8 に量子化し、(値, スケール) を返す"""
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    values = np.round(matrix / scales[:, None]).astype(np.int8)
+    return values, scales.astype(np.float32)
+
+
+def train_ivf(matrix: np.ndarray, nlist: int, iterations: int = IVF_ITERATIONS, seed: int = 0):
+    """
+    球面 k-means で nlist 個のクラスタに分け、IVF 索引を作る。
+
+    Returns:
+        tuple: (centroids, order, offsets)
+            クラスタ i に属する行番号は order[offsets[i]:offsets[i + 1]]
+    """
+    rng = np.random.default_rng(seed)
+    centroids = matrix[rng.choice(len(matrix), size=nlist, replace=False)].astype(np.float32)
+
+    for _ in range(iterations):
+        assign = _nearest_centroid(matrix, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, matrix)
+        filled = np.bincount(assign, minlength=nlist) > 0
+        # 空になったクラスタは前回の中心をそのまま使う
+        centroids[filled] = normalize_rows(sums[filled])
+
+    assign = _nearest_centroid(matrix, centroids)
+    order = np.argsort(assign, kind="stable").astype(np.int32)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+    return centroids, order, offsets
+
+
+def _nearest_centroid(matrix, centroids):
+    assign = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), SEARCH_BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + SEARCH_BLOCK_ROWS], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def _top_k(scores: np.ndarray, ids: np.ndarray, k: int) -> list[tuple[float, int]]:
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        scores, ids = scores[part], ids[part]
+    order = np.argsort(-scores, kind="stable")
+    return [(float(scores[i]), int(ids[i])) for i in order]
+
+
+def _save_array(path: str, array: np.ndarray) -> None:
+    """
+    .npy を一時ファイルに書いてから置き換える。既存のファイルを上書きすると、
+    それを np.load(mmap_mode="r") で開いている検索側のプロセスが SIGBUS で落ちる
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+# ---------------------------
+# ベクトルストア
+# ---------------------------
+class VectorStore:
+    """
+    ディスク上のベクトル行列 (メモリマップ) と、あれば IVF 索引を保持する。
+    行番号は rag_index.BM25Index.chunks の chunk_id と一致する。
+    """
+
+    def __init__(self, path: str = STORE_DIR):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_FORMAT_VERSION:
+            raise ValueError(f"ベクトルストアの形式が古いです: {path}")
+
+        self.path = path
+        self.meta = meta
+        self.embedder_name = meta["embedder"]
+        self.fingerprint = meta["fingerprint"]
+        self.dtype = meta["dtype"]
+
+        if self.dtype == "int8":
+            self.vectors = np.load(os.path.join(path, "vectors.i8.npy"), mmap_mode="r")
+            self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r")
+        else:
+            self.vectors = np.load(os.path.join(path, "vectors.f32.npy"), mmap_mode="r")
+            self.scales = None
+
+        self.centroids = self.order = self.offsets = None
+        if meta.get("ivf"):
+            self.centroids = np.load(os.path.join(path, "ivf_centroids.npy"))
+            self.order = np.load(os.path.join(path, "ivf_order.npy"), mmap_mode="r")
+            self.offsets = np.load(os.path.join(path, "ivf_offsets.npy"))
+
+    def __len__(self):
+        return len(self.vectors)
+
+    # --- 構築 ---
+    @classmethod
+    def build(cls, matrix: np.ndarray, embedder_name: str, fingerprint: str = "",
+              path: str = STORE_DIR, dtype: str = "float32", ivf=None) -> "VectorStore":
+        """
+        埋め込み済みの行列を保存して VectorStore を返す。
+        ivf が None の場合は行数が IVF_MIN_ROWS 以上なら IVF 索引も作る。
+        """
+        os.makedirs(path, exist_ok=True)
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+
+        if dtype == "int8":
+            values, scales = quantize_int8(matrix)
+            _save_array(os.path.join(path, "vectors.i8.npy"), values)
+            _save_array(os.path.join(path, "scales.npy"), scales)
+        elif dtype == "float32":
+            _save_array(os.path.join(path, "vectors.f32.npy"), matrix)
+        else:
+            raise ValueError(f"未対応の dtype です: {dtype}")
+
+        if ivf is None:
+            ivf = len(matrix) >= IVF_MIN_ROWS
+        if ivf:
+            nlist = max(1, int(math.sqrt(len(matrix))))
+            centroids, order, offsets = train_ivf(matrix, nlist)
+            _save_array(os.path.join(path, "ivf_centroids.npy"), centroids)
+            _save_array(os.path.join(path, "ivf_order.npy"), order)
+            _save_array(os.path.join(path, "ivf_offsets.npy"), offsets)
+
+        meta = {
+            "version": STORE_FORMAT_VERSION,
+            "embedder": embedder_name,
+            "fingerprint": fingerprint,
+            "dtype": dtype,
+            "rows": len(matrix),
+            "dim": int(matrix.shape[1]) if matrix.ndim == 2 else 0,
+            "ivf": bool(ivf),
+        }
+        # meta.json を最後に書く (途中で止まった場合は読み込み時に作り直される)
+        tmp_path = os.path.join(path, "meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, os.path.join(path, "meta.json"))
+        return cls(path)
+
+    # --- 検索 ---
+    def _scores(self, rows, queries):
+        """rows (行番号のスライスまたは配列) と queries (m, dim) のコサイン類似度 (m, len(rows))"""
+        block = self.vectors[rows]
+        if self.scales is None:
+            return queries @ np.asarray(block, dtype=np.float32).T
+        return (queries @ block.astype(np.float32).T) * self.scales[rows]
+
+    def search_exact(self, queries: np.ndarray, k: int = 8) -> list[list[tuple[float, int]]]:
+        """総当たり検索。queries (m, dim) の各行について上位 k 件の (score, chunk_id) を返す"""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        best = [[] for _ in range(len(queries))]
+        for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+            stop = min(start + SEARCH_BLOCK_ROWS, len(self))
+            scores = self._scores(slice(start, stop), queries)
+            ids = np.arange(start, stop)
+            for q, row in enumerate(scores):
+                # ブロックごとの上位 k 件を前ブロックまでの上位 k 件とまとめる
+                merged = best[q] + _top_k(row, ids, k)
+                best[q] = sorted(merged, key=lambda item: -item[0])[:k]
+        return best
+
+    def search_ivf(self, queries: np.ndarray, k: int = 8, nprobe: int = IVF_DEFAULT_NPROBE):
+        """IVF 索引による近似検索。中心が近い nprobe 個のクラスタの行だけを調べる"""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(nprobe, len(self.centroids))
+        results = []
+        for query, cscores in zip(queries, queries @ self.centroids.T):
+            probe = np.argpartition(-cscores, nprobe - 1)[:nprobe]
+            ids = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+            ids.sort()   # メモリマップを前から順に読む
+            if len(ids) == 0:
+                results.append([])
+                continue
+            results.append(_top_k(self._scores(ids, query[None, :])[0], ids, k))
+        return results
+
+    def search(self, query: np.ndarray, k: int = 8, nprobe: int = IVF_DEFAULT_NPROBE,
+               exact: bool = False) -> list[tuple[float, int]]:
+        """
+        1 件の質問ベクトルで検索し、上位 k 件を (score, chunk_id) のリストで返す。
+        IVF 索引があれば近似検索、exact=True または索引が無ければ総当たり。
+        """
+        if len(self) == 0:
+            return []
+        if self.centroids is not None and not exact:
+            return self.search_ivf(query, k, nprobe)[0]
+        return self.search_exact(query, k)[0]
+
+
+# ---------------------------
+# 埋め込みキャッシュ / パイプライン
+# ---------------------------
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    (埋め込みモデル名, チャンク本文のハッシュ) → ベクトル の永続キャッシュ (SQLite)。
+    SQLite の接続はスレッド間で共有しないので、呼び出しは 1 つのスレッドから行う。
+    """
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT,
+                hash TEXT,
+                dim INTEGER,
+                vector BLOB,
+                created_at REAL,
+                PRIMARY KEY (model, hash)
+            )
+        """)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def get_many(self, model: str, hashes: list[str]) -> dict:
+        """キャッシュにあるものだけを {hash: ベクトル} で返す"""
+        found = {}
+        for start in range(0, len(hashes), 500):
+            part = hashes[start:start + 500]
+            rows = self.conn.execute(
+                f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(part))})",
+                [model, *part],
+            )
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, model: str, items) -> None:
+        """items: (hash, ベクトル) の列"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, dim, vector, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(model, h, len(v), np.asarray(v, dtype=np.float32).tobytes(), now) for h, v in items],
+            )
+
+
+def make_batches(texts: list[str], max_batch: int, max_batch_tokens=None) -> list[list[int]]:
+    """texts の添字を、件数とトークン数の上限いっぱいまで詰めたバッチに分ける"""
+    batches = []
+    current = []
+    tokens = 0
+    for i, text in enumerate(texts):
+        t = estimate_tokens(text)
+        if current and (
+            len(current) >= max_batch or
+            (max_batch_tokens is not None and tokens + t > max_batch_tokens)
+        ):
+            batches.append(current)
+            current = []
+            tokens = 0
+        current.append(i)
+        tokens += t
+    if current:
+        batches.append(current)
+    return batches
+
+
+def embed_chunks(embedder: Embedder, chunks: list[dict], cache: EmbeddingCache = None,
+                 concurrency: int = EMBED_CONCURRENCY) -> np.ndarray:
+    """
+    チャンク本文をまとめて埋め込み、(len(chunks), dim) の行列を返す。
+
+      - 同じ本文のチャンクは 1 回だけ埋め込む
+      - cache があれば、キャッシュ済みの本文は API に送らない
+      - 残りは embedder の上限いっぱいのバッチに詰め、concurrency 本まで並行して送る
+        (再試行と RPM / TPM の予算は embedder のクライアント側で扱う)
+    キャッシュへの保存はバッチが終わるごとに行うので、途中で止まっても次回はその続きから。
+    """
+    if not embedder.cacheable:
+        cache = None
+
+    hashes = [text_hash(c["text"]) for c in chunks]
+    unique = {}
+    for h, c in zip(hashes, chunks):
+        unique.setdefault(h, c["text"])
+
+    vectors = cache.get_many(embedder.name, list(unique)) if cache is not None else {}
+    missing = [h for h in unique if h not in vectors]
+    if cache is not None:
+        print(f"💾 埋め込みキャッシュ: {len(unique) - len(missing)} / {len(unique)} 件ヒット")
+
+    texts = [unique[h] for h in missing]
+    batches = make_batches(texts, embedder.max_batch, embedder.max_batch_tokens)
+    if batches:
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(batches)))) as pool:
+            futures = {
+                pool.submit(embedder.embed, [texts[i] for i in batch], "document"): batch
+                for batch in batches
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                batch = futures[future]
+                result = future.result()
+                items = [(missing[i], result[row]) for row, i in enumerate(batch)]
+                vectors.update(items)
+                if cache is not None:
+                    # SQLite はこのスレッドからだけ触る
+                    cache.put_many(embedder.name, items)
+                if len(batches) > 1 and (done % 10 == 0 or done == len(batches)):
+                    print(f"  埋め込み {done} / {len(batches)} バッチ")
+
+    matrix = np.zeros((len(chunks), embedder.dim), dtype=np.float32)
+    for row, h in enumerate(hashes):
+        matrix[row] = vectors[h]
+    return matrix
+
+
+def load_or_build_store(index: rag_index.BM25Index, embedder: Embedder,
+                        path: str = STORE_DIR, dtype: str = "float32",
+                        cache: EmbeddingCache = None,
+                        concurrency: int = EMBED_CONCURRENCY) -> VectorStore:
+    """
+    保存済みのベクトルストアを読み込む。無い場合、BM25 インデックスの版 (fingerprint) や
+    埋め込みバックエンド・形式が変わっている場合は再構築して保存する。
+    再構築時の埋め込みには cache / concurrency を使う (embed_chunks() を参照)。
+    """
+    if os.path.exists(os.path.join(path, "meta.json")):
+        try:
+            store = VectorStore(path)
+            if (
+                store.fingerprint == index.fingerprint and
+                store.embedder_name == embedder.name and
+                store.dtype == dtype and
+                len(store) == len(index.chunks)
+            ):
+                return store
+            print("🔄 ドキュメントまたは埋め込み設定が変わったためベクトルストアを再構築します")
+        except (OSError, ValueError, KeyError) as e:
+            print(f"⚠ ベクトルストアを読み込めません。再構築します: {e}")
+
+    print(f"🧮 埋め込み中: {len(index.chunks)} チャンク ({embedder.name})")
+    matrix = embed_chunks(embedder, index.chunks, cache, concurrency)
+    store = VectorStore.build(matrix, embedder.name, index.fingerprint, path, dtype)
+    print(f"✔ ベクトルストア保存: {path} ({len(store)} 行, {dtype}{', IVF' if store.centroids is not None else ''})")
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ドキュメントチャンクのベクトルストア")
+    parser.add_argument("query", nargs="*", help="検索する質問文 (省略時は構築のみ)")
+    parser.add_argument("--embedder", choices=sorted(EMBEDDERS), default="hashing",
+                        help="埋め込みバックエンド")
+    parser.add_argument("--int8", action="store_true", help="ベクトルを int8 で保存する")
+    parser.add_argument("--exact", action="store_true", help="IVF 索引があっても総当たりで検索する")
+    parser.add_argument("--concurrency", type=int, default=EMBED_CONCURRENCY,
+                        help="同時に送る埋め込みリクエスト数")
+    parser.add_argument("--rpm", type=int, default=EMBED_RPM, help="1 分あたりの最大リクエスト数")
+    parser.add_argument("--tpm", type=int, default=None, help="1 分あたりの最大入力トークン数")
+    parser.add_argument("--no-embedding-cache", action="store_true",
+                        help="埋め込みキャッシュを使わずにすべて埋め込み直す")
+    args = parser.parse_args()
+
+    idx = rag_index.load_or_build_index()
+    emb = get_embedder(args.embedder)
+    if isinstance(emb, GeminiEmbedder):
+        emb.client.set_limits(args.rpm, args.tpm)
+    emb_cache = None if args.no_embedding_cache else EmbeddingCache()
+    try:
+        vs = load_or_build_store(
+            idx, emb, dtype="int8" if args.int8 else "float32",
+            cache=emb_cache, concurrency=args.concurrency,
+        )
+    finally:
+        if emb_cache is not None:
+            emb_cache.close()
+
+    if args.query:
+        q = " ".join(args.query)
+        started = time.perf_counter()
+        qvec = emb.embed([q], task="query")[0]
+        hits = vs.search(qvec, k=5, exact=args.exact)
+        elapsed = (time.perf_counter() - started) * 1000
+        for score, chunk_id in hits:
+            chunk = idx.chunks[chunk_id]
+            print(f"\n[{score:.3f}] {chunk['source']}")
+            print(chunk["text"][:300])
+        print(f"\n⏱ {elapsed:.1f} ms", file=sys.stderr)